@@ -0,0 +1,374 @@
+"""
+과거 일기 재분석 백필 (중단 후 이어서 실행 가능)
+
+event_summary가 없거나 analysis 모양이 옛 형식인 일기를 골라 현재 분석 파이프라인으로 다시 분석합니다.
+진행 상황은 jobs 컬렉션(_id = "backfill:<name>")에 페이지 단위로 저장되므로,
+Ctrl+C로 멈춘 뒤 같은 --name으로 다시 실행하면 마지막 체크포인트부터 이어갑니다.
+
+실행 예:
+  cd backend && python backfill.py --name summary-2024 --concurrency 4 --budget 500
+  python backfill.py --name one-user --user alice --all
+  python backfill.py --name custom --filter '{"analysis_model": {"$exists": false}}'
+
+분석에 실패한 일기는 체크포인트가 지나가도 job 문서의 failed_ids 에 남습니다. 같은 --name(과 같은 필터)에
+--retry-failed 를 붙이면 그 일기들만 다시 분석합니다 (완료된 작업도 가능).
+  python backfill.py --name summary-2024 --retry-failed
+
+보관된(archived) 일기도 대상입니다. 본문/analysis 는 diary_archive 에서 합쳐 읽고, 분석 결과를 쓰기 전에 보관을 해제합니다.
+
+--clean-text: 전문 검색 색인용 clean_text 가 없는 일기(검색 기능 이전에 저장된 일기)만 채웁니다. Gemini 호출 없음.
+  보관된(archived) 일기는 본문을 diary_archive 에서 읽어 채웁니다. 채워진 일기는 다음 조회에서 빠지므로 그냥 다시 실행하면 이어집니다.
+  python backfill.py --clean-text [--user alice]
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+import main
+
+# 옛 데이터: 요약이 없거나, analysis가 현재 스키마(theme1~5)가 아닌 일기
+LEGACY_ANALYSIS_FILTER = {
+    "$or": [
+        {"event_summary": {"$in": [None, ""]}},
+        {"analysis.theme1": {"$exists": False}},
+    ]
+}
+PAGE_FIELDS = {
+    "user_id": 1, "title": 1, "content": 1, "is_temporary": 1, "entry_date": 1, "mood": 1, "big5_snapshot": 1,
+    "keywords_snapshot": 1, "event_summary": 1, "archived": 1
+}
+
+
+def build_filter(args) -> dict:
+    query = {"is_temporary": False, "content": {"$nin": [None, ""]}}
+    if not args.all:
+        query.update(LEGACY_ANALYSIS_FILTER)
+    if args.user:
+        query["user_id"] = args.user
+    if args.before:
+        query["entry_date"] = {"$lt": args.before}
+    if args.filter:
+        query.update(json.loads(args.filter))
+    return query
+
+
+def including_archived(query: dict) -> dict:
+    """
+    실제 조회 조건: 본문 조건을 '본문이 있거나 보관됨'으로 넓힘 (job 에 저장된 필터 문자열은 그대로).
+    보관된 일기는 content/analysis 가 diary_archive 에만 있어서 원래 조건으로는 모두 빠지는데, 대부분 이 백필이 노리는 옛 일기임
+    """
+    query = dict(query)
+    content = query.pop("content", None)
+    if content is None:
+        return query
+    return {"$and": [query, {"$or": [{"content": content}, {"archived": True}]}]}
+
+
+def is_legacy(diary: dict) -> bool:
+    return not diary.get("event_summary") or "theme1" not in (diary.get("analysis") or {})
+
+
+def load_page(cursor, legacy_only: bool) -> tuple:
+    """(조회한 원본 목록, 분석할 일기). 보관된 일기는 콜드 필드를 합친 뒤 본문/옛 형식 조건을 다시 확인"""
+    raw = list(cursor)
+    diaries = []
+    for diary in main.merge_archived_fields([dict(d) for d in raw]):
+        if diary.get("archived") and (not diary.get("content") or (legacy_only and not is_legacy(diary))):
+            continue
+        diaries.append(diary)
+    return raw, diaries
+
+
+def load_job(job_id: str, query: dict, reset: bool) -> dict:
+    query_key = json.dumps(query, sort_keys=True, default=str)
+    if reset:
+        main.job_collection.delete_one({"_id": job_id})
+    job = main.job_collection.find_one_and_update(
+        {"_id": job_id},
+        {"$setOnInsert": {
+            "type": "backfill", "status": "running", "query": query_key, "last_id": None,
+            "processed": 0, "updated": 0, "failed": 0, "stale": 0, "calls_used": 0, "failed_ids": [],
+            "started_at": datetime.utcnow()
+        }},
+        upsert=True,
+        return_document=main.pymongo.ReturnDocument.AFTER
+    )
+    if job["query"] != query_key:
+        raise SystemExit(f"ERROR: job '{job_id}' was started with a different filter ({job['query']}). Use --reset or a new --name.")
+    return job
+
+
+def build_update(diary: dict, analysis_result: dict, analysis_model: str, page_token: str):
+    """분석 결과 하나를 일기 업데이트(UpdateOne)와 새 임베딩으로 변환"""
+    new_fields = {
+        "event_summary": analysis_result.get("event_summary") or analysis_result.get("one_liner", ""),
+        "analysis": analysis_result.get("analysis"),
+        "recommend": analysis_result.get("recommend"),
+        "one_liner": analysis_result.get("one_liner"),
+        "big5_snapshot": analysis_result.get("big5") or {},
+        "keywords_snapshot": analysis_result.get("keywords") or [],
+        "analysis_model": analysis_model,
+        "analysis_status": "fresh",
+        "analyzed_at": datetime.utcnow(),
+        "backfill_run": page_token,
+    }
+    embedding = main.embed_text(main.diary_embedding_text({**diary, **new_fields}))
+    new_fields["embedding"] = main.embedding_to_binary(embedding)
+    new_fields["sync_seq"] = main.next_sync_seq(diary["user_id"])  # write_page 가 bulk_write 뒤 release
+    # 분석하는 동안 사용자가 본문을 고쳤다면 덮어쓰지 않음
+    op = UpdateOne({"_id": diary["_id"], "content": diary["content"]}, {"$set": new_fields})
+    return op, new_fields, embedding
+
+
+async def analyze_page(diaries, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    trait_cache = {}
+
+    async def analyze_one(diary):
+        user_id = diary["user_id"]
+        if user_id not in trait_cache:
+            profile = main.user_collection.find_one({"user_id": user_id}, {"top_traits": 1}) or {}
+            trait_cache[user_id] = profile.get("top_traits", [])
+        async with semaphore:
+            try:
+                return await main.get_gemini_analysis(diary["content"], trait_cache[user_id])
+            except Exception as e:
+                print(f"WARNING: [Backfill] {diary['_id']} failed: {e}")
+                return None, None
+
+    return await asyncio.gather(*(analyze_one(d) for d in diaries))
+
+
+def write_page(diaries, results, job_id: str) -> dict:
+    """성공한 결과를 bulk_write로 한 번에 쓰고, 실제 반영된 일기만 통계에 반영"""
+    ops, applied = [], {}
+    page_token = f"{job_id}:{ObjectId()}"
+    try:
+        for diary, (result, model) in zip(diaries, results):
+            if result:
+                if diary.get("archived"):
+                    # 콜드 필드를 먼저 원래 문서로 되돌려야 본문 조건이 맞고 새 분석이 옛 분석과 섞이지 않음
+                    main.unarchive_diary(diary["user_id"], diary["_id"])
+                op, new_fields, embedding = build_update(diary, result, model, page_token)
+                ops.append(op)
+                applied[diary["_id"]] = (diary, new_fields, embedding)
+        if ops:
+            main.diary_collection.bulk_write(ops, ordered=False)
+    finally:
+        # build_update 가 발급한 sync_seq 들의 진행 중 표시 해제 (쓰기가 끝난 뒤에야 커서가 넘어감)
+        for diary, _, _ in applied.values():
+            main.release_sync_seq(diary["user_id"])
+    if not ops:
+        return {"updated": 0, "stale": 0}
+
+    # 본문 조건에 걸려 건너뛴 일기에는 이번 페이지 표시가 없음 -> 통계에서도 제외
+    written_ids = {
+        doc["_id"] for doc in main.diary_collection.find({"_id": {"$in": list(applied)}, "backfill_run": page_token}, {"_id": 1})
+    }
+
+    trend_ops, keyword_delta = [], defaultdict(Counter)
+    for diary_id in written_ids:
+        diary, new_fields, embedding = applied[diary_id]
+        trend_ops += main.trend_rollup_ops(diary, -1) + main.trend_rollup_ops({**diary, "big5_snapshot": new_fields["big5_snapshot"]}, 1)
+        keyword_delta[diary["user_id"]].update(new_fields["keywords_snapshot"])
+        keyword_delta[diary["user_id"]].subtract(diary.get("keywords_snapshot") or [])
+        main.similarity_index.upsert(diary["user_id"], str(diary_id), embedding)
+    if trend_ops:
+        main.trend_collection.bulk_write(trend_ops, ordered=False)
+
+    user_ops = []
+    for user_id, delta in keyword_delta.items():
+        # trait_counts 증감 + 프롬프트용 trait_index / top_traits 를 같은 차이로 갱신
+        update = main.trait_delta_update(user_id, list(delta.elements()), list((-delta).elements()))
+        if update:
+            user_ops.append(UpdateOne({"user_id": user_id}, update))
+    if user_ops:
+        main.user_collection.bulk_write(user_ops, ordered=False)
+    for user_id in keyword_delta:
+        main.recompute_big5_profile(user_id)
+        main.user_stats_cache.invalidate(user_id)
+
+    return {"updated": len(written_ids), "stale": len(applied) - len(written_ids)}
+
+
+def fill_clean_text(diaries) -> int:
+    """clean_text 가 없는 일기 한 페이지를 채움. 그 사이 수정/저장이 clean_text 를 먼저 썼으면 건드리지 않음"""
+    ops = [
+        UpdateOne(
+            {"_id": diary["_id"], "clean_text": {"$exists": False}},
+            {"$set": {"clean_text": main.clean_diary_text(diary.get("content"))}}
+        )
+        for diary in diaries
+    ]
+    return main.diary_collection.bulk_write(ops, ordered=False).modified_count if ops else 0
+
+
+def run_clean_text_backfill(args):
+    query = {"clean_text": {"$exists": False}}
+    if args.user:
+        query["user_id"] = args.user
+    remaining = main.diary_collection.count_documents(query)
+    print(f"INFO: [Backfill] clean_text: {remaining} diaries to go")
+
+    page_size = args.page_size or 500
+    last_id, filled = None, 0
+    while True:
+        page_query = {**query, "_id": {"$gt": last_id}} if last_id else query
+        cursor = main.diary_collection.find(page_query, {"content": 1, "archived": 1}).sort("_id", 1).limit(page_size)
+        # 보관된 일기는 본문이 diary_archive 에만 있으므로 합쳐서 읽음
+        diaries = main.merge_archived_fields(cursor)
+        if not diaries:
+            break
+        filled += fill_clean_text(diaries)
+        last_id = diaries[-1]["_id"]
+        print(f"INFO: [Backfill] clean_text: {filled} filled | {max(0, remaining - filled)} left")
+        if args.pause:
+            time.sleep(args.pause)
+    print(f"INFO: [Backfill] clean_text finished ({filled} diaries)")
+
+
+def format_eta(seconds: float) -> str:
+    if seconds == float("inf"):
+        return "?"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+
+async def run_backfill(args):
+    query = build_filter(args)
+    job_id = f"backfill:{args.name}"
+    job = load_job(job_id, query, args.reset)
+    if job["status"] == "done":
+        print(f"INFO: [Backfill] {job_id} already finished. Use --reset to run again.")
+        return
+
+    def page_query():
+        scan = including_archived(query)
+        return {**scan, "_id": {"$gt": job["last_id"]}} if job["last_id"] else scan
+
+    remaining = main.diary_collection.count_documents(page_query())
+    print(f"INFO: [Backfill] {job_id}: {remaining} diaries to go (done so far: {job['processed']}, calls used: {job['calls_used']})")
+
+    started, processed_this_run = time.perf_counter(), 0
+    page_size = args.page_size or args.concurrency * 4
+    while True:
+        if args.budget and job["calls_used"] >= args.budget:
+            print(f"INFO: [Backfill] budget of {args.budget} analyses reached; paused at {job['last_id']}")
+            return
+        if main.model_router.healthy_key_ratio() < args.min_healthy_ratio:
+            print("WARNING: [Backfill] too many API keys are cooling down; paused (rerun later to resume)")
+            return
+
+        limit = page_size
+        if args.budget:
+            limit = min(limit, args.budget - job["calls_used"])
+        raw, diaries = load_page(main.diary_collection.find(page_query(), PAGE_FIELDS).sort("_id", 1).limit(limit), not args.all)
+        if not raw:
+            break
+
+        results = await analyze_page(diaries, args.concurrency) if diaries else []
+        outcome = write_page(diaries, results, job_id) if diaries else {"updated": 0, "stale": 0}
+        failed_ids = [diary["_id"] for diary, (result, _) in zip(diaries, results) if not result]
+        failed = len(failed_ids)
+
+        job["last_id"] = raw[-1]["_id"]
+        job["calls_used"] += len(diaries)
+        job["processed"] += len(raw)
+        # 체크포인트는 넘어가도 실패한 일기는 기록해 두고 --retry-failed 로 다시 분석
+        main.job_collection.update_one(
+            {"_id": job_id},
+            {"$set": {"last_id": job["last_id"], "updated_at": datetime.utcnow()},
+             "$inc": {"processed": len(raw), "calls_used": len(diaries), "failed": failed, **outcome},
+             "$addToSet": {"failed_ids": {"$each": failed_ids}}}
+        )
+
+        processed_this_run += len(raw)
+        remaining = max(0, remaining - len(raw))
+        rate = processed_this_run / max(time.perf_counter() - started, 1e-9)
+        print(
+            f"INFO: [Backfill] {job['processed']} done (+{outcome['updated']} updated, {failed} failed, {outcome['stale']} stale) "
+            f"| {rate:.2f} diaries/s | {remaining} left | ETA {format_eta(remaining / rate if rate else float('inf'))}"
+        )
+        if args.pause:
+            await asyncio.sleep(args.pause)
+
+    main.job_collection.update_one({"_id": job_id}, {"$set": {"status": "done", "finished_at": datetime.utcnow()}})
+    failed_left = len(main.job_collection.find_one({"_id": job_id}, {"failed_ids": 1}).get("failed_ids") or [])
+    print(f"INFO: [Backfill] {job_id} finished" + (f" ({failed_left} failed; rerun with --retry-failed)" if failed_left else ""))
+
+
+async def retry_failed(args):
+    """job 문서의 failed_ids 만 다시 분석. 성공했거나 더 이상 대상이 아닌(수정/삭제된) 일기는 목록에서 뺌"""
+    query = build_filter(args)
+    job_id = f"backfill:{args.name}"
+    job = load_job(job_id, query, reset=False)
+    failed_ids = job.get("failed_ids") or []
+    print(f"INFO: [Backfill] {job_id}: retrying {len(failed_ids)} failed diaries")
+
+    page_size = args.page_size or args.concurrency * 4
+    for start in range(0, len(failed_ids), page_size):
+        if args.budget and job["calls_used"] >= args.budget:
+            print(f"INFO: [Backfill] budget of {args.budget} analyses reached; retry paused")
+            return
+        if main.model_router.healthy_key_ratio() < args.min_healthy_ratio:
+            print("WARNING: [Backfill] too many API keys are cooling down; retry paused (rerun later to resume)")
+            return
+
+        chunk = failed_ids[start:start + page_size]
+        _, diaries = load_page(main.diary_collection.find({**including_archived(query), "_id": {"$in": chunk}}, PAGE_FIELDS), not args.all)
+        results = await analyze_page(diaries, args.concurrency) if diaries else []
+        outcome = write_page(diaries, results, job_id) if diaries else {"updated": 0, "stale": 0}
+        still_failed = {diary["_id"] for diary, (result, _) in zip(diaries, results) if not result}
+        settled = [diary_id for diary_id in chunk if diary_id not in still_failed]
+
+        job["calls_used"] += len(diaries)
+        main.job_collection.update_one(
+            {"_id": job_id},
+            {"$set": {"updated_at": datetime.utcnow()},
+             "$inc": {"calls_used": len(diaries), "failed": -len(settled), **outcome},
+             "$pullAll": {"failed_ids": settled}}
+        )
+        print(f"INFO: [Backfill] retry: +{outcome['updated']} updated, {len(still_failed)} still failing")
+        if args.pause:
+            await asyncio.sleep(args.pause)
+    print(f"INFO: [Backfill] {job_id} retry finished")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Re-analyze historical diaries (resumable)")
+    parser.add_argument("--name", help="job name; reuse it to resume")
+    parser.add_argument("--user", help="only this user_id")
+    parser.add_argument("--before", help="only diaries with entry_date < YYYY-MM-DD")
+    parser.add_argument("--all", action="store_true", help="re-analyze every final diary, not only legacy ones")
+    parser.add_argument("--filter", help="extra Mongo filter as JSON")
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--page-size", type=int, default=0, help="diaries per checkpoint (default: concurrency * 4)")
+    parser.add_argument("--budget", type=int, default=0, help="max diaries to send to Gemini over the whole job (0 = unlimited)")
+    parser.add_argument("--min-healthy-ratio", type=float, default=0.5, help="pause when fewer API keys than this are usable")
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to wait between pages")
+    parser.add_argument("--reset", action="store_true", help="discard the checkpoint and start over")
+    parser.add_argument("--clean-text", action="store_true", help="only fill the search field clean_text (no Gemini calls)")
+    parser.add_argument("--retry-failed", action="store_true", help="re-analyze only the diaries that failed in this job")
+    args = parser.parse_args()
+
+    if args.clean_text:
+        run_clean_text_backfill(args)
+        return
+    if not args.name:
+        parser.error("--name is required")
+
+    try:
+        asyncio.run(retry_failed(args) if args.retry_failed else run_backfill(args))
+    except KeyboardInterrupt:
+        print("INFO: [Backfill] interrupted; progress is saved up to the last finished page")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,130 @@
+"""
+키 장애 조치(failover) / 재시도 / 모델 강등을 재생(replay) 백엔드로 재현하는 벤치마크.
+
+실제 Gemini 없이 main.ReplayBackend 에 합성 녹화본(모델별 로그정규 지연)과 실패 스크립트를 넣고,
+시나리오마다 main.get_gemini_analysis 를 N번 실행해 성공률 / 지연 / 키별 호출 수 / 사용 모델을 비교합니다.
+같은 --seed 와 --concurrency 1 이면 결과가 매번 같습니다.
+
+실제 녹화본으로 돌리려면: 서버를 AI_BACKEND=record 로 띄워 ai_recordings.jsonl 을 만든 뒤 --recordings 로 지정.
+실행: cd backend && python benchmarks/bench_failover.py [--requests 40] [--latency-scale 0.1]
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+os.environ.setdefault("GENAI_API_KEY", "bench-key-1")
+os.environ.setdefault("GENAI_API_KEY_2", "bench-key-2")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+from standins import FAKE_ANALYSIS, use_in_memory_mongo  # noqa: E402
+
+use_in_memory_mongo()  # 분석 경로만 재므로 DB는 메모리 대역으로 충분
+import main  # noqa: E402
+
+SCENARIOS = {
+    "healthy": {"failures": []},
+    "key1_429_burst": {"failures": [{"key": 1, "error": "429", "from_call": 1, "to_call": 10}]},
+    "key2_403_always": {"failures": [{"key": 2, "error": "403"}]},
+    "all_keys_429_burst": {"failures": [{"error": "429", "from_call": 1, "to_call": 6}]},
+    "random_5pct_429": {"failures": [], "error_rate": 0.05},
+}
+MEDIAN_LATENCY_SEC = {main.ANALYSIS_MODEL_HEAVY: 4.0, main.ANALYSIS_MODEL_LIGHT: 1.2}
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def write_synthetic_recordings(path, seed, samples=50):
+    """모델별 분석 응답 + 로그정규 지연 분포 (지문은 맞지 않으므로 nearest 재생)"""
+    rng = random.Random(seed)
+    text = json.dumps({**FAKE_ANALYSIS, "big5": main.get_default_big5()})
+    with open(path, "w", encoding="utf-8") as f:
+        for model, median in MEDIAN_LATENCY_SEC.items():
+            for i in range(samples):
+                f.write(json.dumps({
+                    "fingerprint": f"synthetic-{model}-{i}", "model": model, "key": 1, "mime": "application/json",
+                    "status": "ok", "text": text, "latency": round(median * math.exp(rng.gauss(0, 0.35)), 3)
+                }) + "\n")
+
+
+async def run_scenario(name, script, args, recordings_path, script_dir):
+    script_path = os.path.join(script_dir, f"{name}.json")
+    with open(script_path, "w") as f:
+        json.dump({"seed": args.seed, **script}, f)
+
+    # 시나리오마다 키 상태 / 지연 통계를 초기화
+    backend = main.ReplayBackend(recordings_path, script_path, "nearest", args.latency_scale)
+    main.ai_backend = backend
+    main.model_router = main.ModelRouter(len(main.API_KEYS))
+    main.KEY_COOLDOWN_SEC = args.cooldown
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies, models = [], Counter()
+    rng = random.Random(args.seed)
+    texts = [" ".join(rng.choice(["walk", "rain", "friend", "work", "tired", "calm"]) for _ in range(rng.randint(20, 300))) for _ in range(args.requests)]
+
+    async def one(text):
+        async with semaphore:
+            started = time.perf_counter()
+            result, model = await main.get_gemini_analysis(text, [])
+            latencies.append(time.perf_counter() - started)
+            models[model if result else "FAILED"] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(t) for t in texts))
+    wall = time.perf_counter() - started
+    return {
+        "scenario": name,
+        "ok": args.requests - models.get("FAILED", 0),
+        "p50_s": round(statistics.median(latencies), 2),
+        "p95_s": round(percentile(latencies, 95), 2),
+        "wall_s": round(wall, 1),
+        "calls_per_key": dict(sorted(backend.calls_per_key.items())),
+        "models": dict(models),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--latency-scale", type=float, default=0.05, help="재생 지연 배율 (재시도 대기 시간은 배율과 무관)")
+    parser.add_argument("--cooldown", type=int, default=60, help="KEY_COOLDOWN_SEC")
+    parser.add_argument("--recordings", help="실제 녹화 파일 (기본: 합성 녹화본)")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), action="append")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        recordings_path = args.recordings
+        if not recordings_path:
+            recordings_path = os.path.join(tmp, "recordings.jsonl")
+            write_synthetic_recordings(recordings_path, args.seed)
+
+        rows = []
+        for name in args.scenario or SCENARIOS:
+            rows.append(asyncio.run(run_scenario(name, SCENARIOS[name], args, recordings_path, tmp)))
+
+    print(f"\nlatency scale x{args.latency_scale}, concurrency {args.concurrency}, {args.requests} requests per scenario")
+    print(f"{'scenario':<22}{'ok':>5}{'p50 s':>8}{'p95 s':>8}{'wall s':>8}  calls/key        models")
+    for row in rows:
+        print(f"{row['scenario']:<22}{row['ok']:>5}{row['p50_s']:>8}{row['p95_s']:>8}{row['wall_s']:>8}  "
+              f"{str(row['calls_per_key']):<16} {row['models']}")
+
+
+if __name__ == "__main__":
+    main_cli()
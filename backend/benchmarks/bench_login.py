@@ -0,0 +1,78 @@
+"""
+로그인 버스트가 동시에 들어오는 가벼운 읽기 요청의 p99 지연에 주는 영향 측정.
+
+- inline : 예전 방식처럼 이벤트 루프 안에서 bcrypt 검증
+- offload: main.verify_and_update_password_async (전용 스레드 풀)
+
+실행: cd backend && python benchmarks/bench_login.py [--logins 20] [--readers 50]
+(Mongo / Gemini 연결은 사용하지 않습니다)
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GENAI_API_KEY", "bench-dummy-key")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+import main  # noqa: E402
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def reader(latencies, stop_event, interval=0.005):
+    # /health 같은 가벼운 요청 흉내: 잠깐 쉬었다가 깨어나기까지 걸린 초과 시간을 기록
+    while not stop_event.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        latencies.append((time.perf_counter() - started - interval) * 1000)
+
+
+async def run(mode, hashed, logins, readers):
+    latencies = []
+    stop_event = asyncio.Event()
+    reader_tasks = [asyncio.create_task(reader(latencies, stop_event)) for _ in range(readers)]
+
+    async def login_once():
+        if mode == "inline":
+            main.verify_and_update_password("bench-password", hashed)
+        else:
+            await main.verify_and_update_password_async("bench-password", hashed)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(login_once() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+
+    stop_event.set()
+    await asyncio.gather(*reader_tasks)
+    return {
+        "mode": mode,
+        "login_burst_sec": round(elapsed, 3),
+        "read_p50_ms": round(statistics.median(latencies), 2),
+        "read_p99_ms": round(percentile(latencies, 99), 2),
+        "read_max_ms": round(max(latencies), 2),
+        "read_samples": len(latencies),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=20)
+    parser.add_argument("--readers", type=int, default=50)
+    args = parser.parse_args()
+
+    hashed = main.get_password_hash("bench-password")
+    print(f"bcrypt rounds={main.BCRYPT_ROUNDS}, hash workers={main.PASSWORD_HASH_WORKERS}")
+    for mode in ("inline", "offload"):
+        print(asyncio.run(run(mode, hashed, args.logins, args.readers)))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,139 @@
+"""
+헤비 유저의 일기 목록(/diaries) 직렬화 시간과 전송 바이트 벤치마크.
+
+- serialize : 같은 Mongo 문서 목록을 두 경로로 JSON 바이트로 만드는 시간
+    old  = _id 문자열 변환 루프 + FastAPI jsonable_encoder + 표준 json (이전 /diaries 경로)
+    new  = main.TimedJSONResponse (orjson, ObjectId/datetime 직접 인코딩)
+- wire      : 실제 앱에 Accept-Encoding 을 바꿔가며 /diaries 를 요청했을 때 본문 바이트와 응답 시간
+    (identity / gzip / br — br 은 brotli 패키지가 설치된 경우에만)
+
+실행: cd backend && python benchmarks/bench_serialization.py [--diaries 1500] [--repeat 20] [--mongo memory|local]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+os.environ.setdefault("GENAI_API_KEY", "bench-dummy-key")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+BENCH_USER = "bench-serialization"
+SECRET_KEY = "bench-serialization-secret"
+WORDS = ("today walked river friend work tired coffee rain happy worried sleep music "
+         "family deadline lunch quiet evening book run anxious grateful").split()
+
+
+def seed(main_module, diaries, seed_value=7):
+    """분석 결과까지 채워진 일기 N개를 가진 헤비 유저 (임베딩은 /diaries 에서 제외되므로 생략)"""
+    import random
+    from standins import FAKE_ANALYSIS
+    rng = random.Random(seed_value)
+    now = datetime.utcnow()
+    main_module.user_collection.insert_one({"user_id": BENCH_USER, "joined_at": now, "big5_scores": main_module.get_default_big5()})
+    docs = []
+    for i in range(diaries):
+        content = " ".join(rng.choice(WORDS) for _ in range(rng.randint(60, 250)))
+        day = now - timedelta(days=i)
+        docs.append({
+            "user_id": BENCH_USER, "title": f"day {i}", "content": content, "is_temporary": False,
+            "entry_date": day.strftime("%Y-%m-%d"), "created_at": day, "mood": rng.choice(["good", "calm", "sad"]),
+            "tags": ["daily"], "keywords_snapshot": FAKE_ANALYSIS["keywords"], "event_summary": FAKE_ANALYSIS["event_summary"],
+            "analysis": FAKE_ANALYSIS["analysis"], "recommend": FAKE_ANALYSIS["recommend"],
+            "big5": main_module.get_default_big5(), "sync_seq": i + 1,
+        })
+    main_module.diary_collection.insert_many(docs)
+
+
+def old_render(docs):
+    from fastapi.encoders import jsonable_encoder
+    diaries = []
+    for doc in docs:
+        doc = dict(doc)
+        doc["_id"] = str(doc["_id"])
+        diaries.append(doc)
+    content = jsonable_encoder({"diaries": diaries})
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def new_render(main_module, docs):
+    return main_module.TimedJSONResponse({"diaries": docs}).body
+
+
+def timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = func()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1000, len(body)
+
+
+async def measure_wire(main_module, token, encodings, repeat):
+    import httpx
+    rows = []
+    transport = httpx.ASGITransport(app=main_module.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+        for encoding in encodings:
+            samples, wire, applied = [], 0, None
+            for _ in range(repeat):
+                started = time.perf_counter()
+                response = await client.get("/diaries", headers={"Authorization": f"Bearer {token}", "Accept-Encoding": encoding})
+                samples.append(time.perf_counter() - started)
+                response.raise_for_status()
+                # httpx 는 본문 압축을 풀어서 주므로 전송 크기는 content-length 로 봄
+                applied = response.headers.get("content-encoding", "identity")
+                wire = int(response.headers.get("content-length", len(response.content)))
+            rows.append((encoding, applied, wire, statistics.median(samples) * 1000))
+    return rows
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--diaries", type=int, default=1500)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--mongo", choices=["local", "memory"], default="memory")
+    args = parser.parse_args()
+
+    os.environ["SECRET_KEY"] = SECRET_KEY
+    if args.mongo == "memory":
+        from standins import use_in_memory_mongo
+        use_in_memory_mongo()
+    import main
+    from jose import jwt
+    main.ensure_indexes()
+    main.diary_collection.delete_many({"user_id": BENCH_USER})
+    main.user_collection.delete_many({"user_id": BENCH_USER})
+    seed(main, args.diaries)
+    token = jwt.encode({"sub": BENCH_USER, "exp": datetime.utcnow() + timedelta(hours=1)}, main.SECRET_KEY, algorithm="HS256")
+
+    try:
+        docs = list(main.diary_collection.find({"user_id": BENCH_USER}, {"embedding": 0}).sort("entry_date", -1))
+        old_ms, old_bytes = timed(lambda: old_render(docs), args.repeat)
+        new_ms, new_bytes = timed(lambda: new_render(main, docs), args.repeat)
+        encodings = ["identity", "gzip"] + (["br"] if main.brotli else [])
+        wire = asyncio.run(measure_wire(main, token, encodings, max(3, args.repeat // 4)))
+    finally:
+        main.diary_collection.delete_many({"user_id": BENCH_USER})
+        main.user_collection.delete_many({"user_id": BENCH_USER})
+
+    print(f"\n/diaries for a user with {args.diaries} diaries (mongo {args.mongo}, median of {args.repeat})")
+    print(f"{'serialize':<28}{'ms':>9}{'bytes':>12}")
+    print(f"{'old (jsonable_encoder+json)':<28}{old_ms:>9.1f}{old_bytes:>12,}")
+    print(f"{'new (orjson)':<28}{new_ms:>9.1f}{new_bytes:>12,}   x{old_ms / new_ms:.1f} faster")
+    print(f"\n{'Accept-Encoding':<18}{'applied':<10}{'wire bytes':>12}{'ratio':>8}{'request ms':>12}")
+    identity_bytes = wire[0][2]
+    for requested, applied, size, ms in wire:
+        print(f"{requested:<18}{applied:<10}{size:>12,}{size / identity_bytes:>8.1%}{ms:>12.1f}")
+    if not main.brotli:
+        print("(brotli not installed: br is not offered, gzip is used instead)")
+
+
+if __name__ == "__main__":
+    main_cli()
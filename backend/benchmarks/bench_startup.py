@@ -0,0 +1,154 @@
+"""
+콜드 스타트 벤치마크: import 시간과 첫 요청까지 걸리는 시간(time-to-first-request).
+
+- import        : 새 파이썬 프로세스에서 `import main` 에 걸린 시간 (+ -X importtime 기준 무거운 모듈 상위 N개)
+- first request : uvicorn 프로세스를 띄운 순간부터 /health 가 처음 200을 돌려줄 때까지
+- ready         : 같은 기준으로 /ready 가 200이 될 때까지 (Mongo 접속 + 인덱스, Gemini SDK, bcrypt 워밍업 완료)
+
+슬립된 인스턴스가 깨어날 때와 같은 조건을 만들기 위해 매 회 새 프로세스를 띄웁니다.
+--mongo memory 면 서버 프로세스 안에서 mongomock 을 쓰므로 Mongo 없이도 돌아갑니다 (mongomock import 비용 포함).
+실행: cd backend && python benchmarks/bench_startup.py [--runs 5] [--mongo local|memory]
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+
+IMPORT_SNIPPET = """
+import sys, time
+sys.path.insert(0, {backend!r})
+started = time.perf_counter()
+import main
+print(round(time.perf_counter() - started, 4), "google.generativeai" in sys.modules)
+"""
+
+SERVER_SNIPPET = """
+import sys
+sys.path.insert(0, {backend!r})
+sys.path.insert(0, {bench!r})
+if {memory!r}:
+    from standins import use_in_memory_mongo
+    use_in_memory_mongo()
+import uvicorn
+uvicorn.run("main:app", host="127.0.0.1", port={port}, log_level="warning")
+"""
+
+
+def bench_env():
+    env = dict(os.environ)
+    env.setdefault("GENAI_API_KEY", "bench-dummy-key")
+    env.setdefault("MONGO_URI", "mongodb://localhost:27017")
+    env["REPORT_BATCH_ENABLED"] = "false"  # 워밍업 직후 배치가 도는 것을 막음
+    return env
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def status_of(url):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+
+def measure_import(env):
+    out = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET.format(backend=BACKEND_DIR)],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True
+    ).stdout.split()
+    return float(out[-2]), out[-1] == "True"
+
+
+def heaviest_imports(env, top):
+    """-X importtime 출력에서 누적 시간이 큰 최상위 패키지"""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_SNIPPET.format(backend=BACKEND_DIR)],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True
+    ).stderr
+    totals = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line[13:]:
+            continue
+        _, cumulative, name = [part.strip() for part in line[12:].split("|")]
+        if cumulative.isdigit() and "." not in name and not name.startswith("_") and name != "main":
+            totals[name] = max(totals.get(name, 0), int(cumulative))
+    return sorted(totals.items(), key=lambda item: -item[1])[:top]
+
+
+def measure_server(env, memory, timeout):
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-c", SERVER_SNIPPET.format(backend=BACKEND_DIR, bench=BENCH_DIR, memory=memory, port=port)],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    first_request = ready = None
+    try:
+        while time.perf_counter() - started < timeout:
+            if server.poll() is not None:
+                raise SystemExit(f"ERROR: server exited early:\n{server.stderr.read().decode()[-2000:]}")
+            if first_request is None and status_of(f"{base}/health") == 200:
+                first_request = time.perf_counter() - started
+            if first_request is not None and status_of(f"{base}/ready") == 200:
+                ready = time.perf_counter() - started
+                break
+            time.sleep(0.01)
+        components = {}
+        if ready is not None:
+            with urllib.request.urlopen(f"{base}/ready", timeout=1) as response:
+                components = json.loads(response.read())["components"]
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+    return first_request, ready, components
+
+
+def describe(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return "timeout"
+    return f"median {statistics.median(values):6.3f}s  min {min(values):6.3f}s  max {max(values):6.3f}s"
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--mongo", choices=["local", "memory"], default="memory")
+    parser.add_argument("--timeout", type=float, default=60.0, help="서버 1회당 최대 대기 시간(초)")
+    parser.add_argument("--top", type=int, default=8, help="표시할 무거운 import 개수")
+    args = parser.parse_args()
+    env = bench_env()
+
+    imports = [measure_import(env) for _ in range(args.runs)]
+    print(f"import main        {describe([seconds for seconds, _ in imports])}")
+    print(f"  google.generativeai loaded at import: {any(loaded for _, loaded in imports)}")
+    for name, micros in heaviest_imports(env, args.top):
+        print(f"  {name:<24}{micros / 1000:8.1f} ms")
+
+    runs = [measure_server(env, args.mongo == "memory", args.timeout) for _ in range(args.runs)]
+    print(f"first request      {describe([first for first, _, _ in runs])}   (process spawn -> /health 200)")
+    print(f"ready              {describe([ready for _, ready, _ in runs])}   (process spawn -> /ready 200)")
+    for name in sorted({name for _, _, components in runs for name in components}):
+        seconds = [c[name]["seconds"] for _, _, c in runs if c.get(name, {}).get("status") == "ok"]
+        print(f"  warm-up {name:<17}{describe(seconds)}")
+
+
+if __name__ == "__main__":
+    main_cli()
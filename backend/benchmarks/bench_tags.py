@@ -0,0 +1,98 @@
+"""
+태그가 많이 붙은 유저(일기 수천 개)에서 태그 작업 비용 비교.
+
+- legacy_delete : 예전 /user/tags 삭제 방식 (find_one + $unset/$inc + update_many 두 번, 트랜잭션 없음)
+- merge/rename  : main.run_tag_merge (bulk_write 한 번 + 카운트 update 한 번, 가능하면 트랜잭션)
+- recount       : main.recount_user_tags (집계 한 번) vs 파이썬에서 전체 일기를 읽어 세기
+
+MONGO_URI 의 실제 MongoDB가 필요합니다. 벤치용 유저(bench-tags-*)의 데이터만 만들고 끝나면 지웁니다.
+실행: cd backend && python benchmarks/bench_tags.py [--diaries 5000] [--tags 40]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GENAI_API_KEY", "bench-dummy-key")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+import main  # noqa: E402
+
+
+def seed(user_id, diaries, tags, rng):
+    main.user_collection.insert_one({"user_id": user_id, "user_tag_counts": {}, "sync_seq": 0})
+    names = [f"tag{i}" for i in range(tags)]
+    docs = [
+        {"user_id": user_id, "content": f"bench {i}", "is_temporary": False, "created_at": datetime.utcnow(),
+         "tags": rng.sample(names, rng.randint(1, 4))}
+        for i in range(diaries)
+    ]
+    main.diary_collection.insert_many(docs)
+    main.recount_user_tags(user_id)
+    return names
+
+
+def legacy_delete(user_id, tag):
+    user = main.user_collection.find_one({"user_id": user_id})
+    count_to_move = user.get("user_tag_counts", {}).get(tag, 0)
+    if count_to_move > 0:
+        main.user_collection.update_one(
+            {"user_id": user_id},
+            {"$unset": {f"user_tag_counts.{tag}": ""}, "$inc": {"user_tag_counts.unsorted": count_to_move}}
+        )
+    main.diary_collection.update_many({"user_id": user_id, "tags": tag}, {"$addToSet": {"tags": "unsorted"}})
+    main.diary_collection.update_many({"user_id": user_id, "tags": tag}, {"$pull": {"tags": tag}})
+
+
+def python_recount(user_id):
+    counter = Counter()
+    for doc in main.diary_collection.find({"user_id": user_id}, {"tags": 1, "_id": 0}):
+        counter.update(set(doc.get("tags") or []))
+    return dict(counter)
+
+
+def timed(label, fn):
+    started = time.perf_counter()
+    result = fn()
+    print(f"{label:<28} {(time.perf_counter() - started) * 1000:9.1f} ms")
+    return result
+
+
+def cleanup(user_id):
+    main.diary_collection.delete_many({"user_id": user_id})
+    main.user_collection.delete_many({"user_id": user_id})
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--diaries", type=int, default=5000)
+    parser.add_argument("--tags", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    main.ensure_indexes()  # (user_id, tags) 인덱스 포함 - 서버 lifespan 없이 실행하므로 직접 생성
+    rng = random.Random(args.seed)
+    user_id = f"bench-tags-{int(time.time())}"
+    print(f"user={user_id} diaries={args.diaries} tags={args.tags} transactions={main.tag_transactions_supported}")
+    try:
+        names = timed("seed + initial recount", lambda: seed(user_id, args.diaries, args.tags, rng))
+
+        timed("legacy delete", lambda: legacy_delete(user_id, names[0]))
+        timed("engine delete (merge)", lambda: main.run_tag_merge(user_id, [names[1]], main.DEFAULT_TAG))
+        timed("engine rename", lambda: main.run_tag_merge(user_id, [names[2]], "renamed"))
+        timed("engine merge (5 -> 1)", lambda: main.run_tag_merge(user_id, names[3:8], "merged"))
+
+        stored = main.user_collection.find_one({"user_id": user_id}, {"user_tag_counts": 1})["user_tag_counts"]
+        expected = timed("python recount", lambda: python_recount(user_id))
+        recounted = timed("aggregation recount", lambda: main.recount_user_tags(user_id))
+        print(f"counts consistent before recount: {stored == expected}, after: {recounted == expected}")
+    finally:
+        cleanup(user_id)
+
+
+if __name__ == "__main__":
+    main_cli()
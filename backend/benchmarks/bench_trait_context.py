@@ -0,0 +1,54 @@
+"""
+기록이 늘어날 때 분석 프롬프트의 'User Traits (Context)' 크기 비교.
+
+- all_traits: 예전 방식 (지금까지 나온 모든 키워드)
+- top_k     : main.update_trait_index 로 유지되는 상위 K개
+
+토큰 수는 대략치(문자 수 / 4)입니다.
+실행: cd backend && python benchmarks/bench_trait_context.py [--diaries 2000]
+"""
+import argparse
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GENAI_API_KEY", "bench-dummy-key")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+import main  # noqa: E402
+
+
+def approx_tokens(traits):
+    return len(", ".join(traits) or "None") // 4
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--diaries", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    all_traits = {}
+    trait_index = []
+    top_traits = []
+    now = datetime(2024, 1, 1)
+
+    print(f"{'diaries':>8} {'all_traits':>11} {'all_tokens':>11} {'top_k':>6} {'top_k_tokens':>13} {'index_size':>11}")
+    for i in range(1, args.diaries + 1):
+        # 하루 한 편, 새 키워드가 가끔 섞이면서 어휘가 계속 늘어나는 상황
+        now += timedelta(days=1)
+        keywords = [f"#Trait{rng.randint(0, 20 + i // 3)}" for _ in range(3)]
+        for k in keywords:
+            all_traits[k] = all_traits.get(k, 0) + 1
+        trait_index, top_traits = main.update_trait_index(trait_index, keywords, now)
+
+        if i in (10, 50, 100, 250, 500, 1000) or i == args.diaries:
+            print(f"{i:>8} {len(all_traits):>11} {approx_tokens(list(all_traits)):>11} "
+                  f"{len(top_traits):>6} {approx_tokens(top_traits):>13} {len(trait_index):>11}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,240 @@
+"""
+워커 수(1 -> N)에 따른 처리량 확장성 벤치마크 + 리더 임대 확인.
+
+워커 수마다 실제 uvicorn 서버를 `WEB_CONCURRENCY=N uvicorn ... --workers N` (main.py 상단의 멀티 워커 실행 방식)으로 띄우고,
+여러 부하 생성 프로세스가 같은 유저의 목록(/diaries) · 통계(/user/stats) · 유사 일기(/diaries/{id}/similar)를
+정해진 시간 동안 요청합니다. Gemini 는 호출하지 않으므로 파이썬 CPU 처리량이 워커 수에 따라 얼마나 늘어나는지를 봅니다.
+
+- --mongo local  : MONGO_URI 의 실제 MongoDB 를 모든 워커가 공유 (벤치 유저 데이터는 끝나면 지움).
+                   /ready 의 worker/leader 필드로 리더가 정확히 한 워커인지도 확인합니다.
+- --mongo memory : 워커마다 자기 mongomock 에 같은 데이터를 시드 (리더 확인은 의미 없음).
+코어 수보다 많은 워커는 선형으로 늘 수 없으므로 결과 표에 CPU 수를 함께 출력합니다.
+
+실행: cd backend && python benchmarks/bench_workers.py [--workers 1,2,4] [--duration 10] [--mongo local]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, BENCH_DIR)
+os.environ.setdefault("GENAI_API_KEY", "bench-dummy-key")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+BENCH_USER = "bench-workers"
+SECRET_KEY = "bench-workers-secret"
+WORDS = ("today walked river friend work tired coffee rain happy worried sleep music "
+         "family deadline lunch quiet evening book run anxious grateful").split()
+
+
+def seed(main_module, diaries, seed_value=7):
+    """벤치 유저와 일기(임베딩 포함)를 만듭니다. 이미 있으면 그대로 사용"""
+    import random
+    if main_module.user_collection.find_one({"user_id": BENCH_USER}):
+        return
+    rng = random.Random(seed_value)
+    now = datetime.utcnow()
+    main_module.user_collection.insert_one({
+        "user_id": BENCH_USER, "joined_at": now, "big5_scores": main_module.get_default_big5(),
+        "trait_counts": {"#Calm": 3}, "user_tag_counts": {"daily": diaries}, "sync_seq": diaries,
+    })
+    docs = []
+    for i in range(diaries):
+        content = " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 160)))
+        day = now - timedelta(days=i)
+        docs.append({
+            "user_id": BENCH_USER, "title": f"day {i}", "content": content, "is_temporary": False,
+            "entry_date": day.strftime("%Y-%m-%d"), "created_at": day, "mood": rng.choice(["good", "calm", "sad"]),
+            "tags": ["daily"], "keywords_snapshot": ["#Calm"], "event_summary": content[:80], "sync_seq": i + 1,
+            "embedding": main_module.embedding_to_binary(main_module.embed_text(content)),
+        })
+    main_module.diary_collection.insert_many(docs)
+
+
+def __getattr__(name):
+    # uvicorn 워커가 `bench_workers:app` 을 불러올 때만 앱을 만듭니다 (부하 생성 프로세스는 main 을 import 하지 않음)
+    if name != "app":
+        raise AttributeError(name)
+    if os.environ.get("BENCH_WORKERS_MONGO") == "memory":
+        from standins import use_in_memory_mongo
+        use_in_memory_mongo()
+    import main
+    if os.environ.get("BENCH_WORKERS_MONGO") == "memory":
+        seed(main, int(os.environ["BENCH_WORKERS_DIARIES"]))
+    return main.app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def get_json(url):
+    try:
+        with urllib.request.urlopen(url, timeout=2) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, None
+    except OSError:
+        return None, None
+
+
+def wait_until_ready(base, workers, timeout, settle=5.0):
+    """
+    워커들이 /ready 200 을 돌려줄 때까지 기다리며 서로 다른 worker 값을 모읍니다.
+    순차 요청은 한 워커에 몰리기 쉬워 동시에 여러 개씩 보내고, 첫 응답 뒤 settle 초 안에 못 본 워커는 포기합니다.
+    """
+    seen = {}
+    deadline = time.perf_counter() + timeout
+    with ThreadPoolExecutor(max_workers=workers * 4) as pool:
+        while time.perf_counter() < deadline:
+            for status, body in pool.map(get_json, [f"{base}/ready"] * workers * 4):
+                if status == 200:
+                    seen[body["worker"]] = body["leader"]
+            if len(seen) >= workers:
+                break
+            if seen:
+                deadline = min(deadline, time.perf_counter() + settle)
+            time.sleep(0.05)
+    return seen
+
+
+def client_process(base, token, diary_ids, duration, concurrency, queue):
+    import httpx
+
+    async def run():
+        latencies, errors = [], 0
+        paths = ["/diaries", "/user/stats"] + [f"/diaries/{i}/similar" for i in diary_ids[:4]]
+        async with httpx.AsyncClient(base_url=base, headers={"Authorization": f"Bearer {token}"}, timeout=30) as client:
+            deadline = time.perf_counter() + duration
+
+            async def worker(offset):
+                nonlocal errors
+                step = offset
+                while time.perf_counter() < deadline:
+                    started = time.perf_counter()
+                    try:
+                        response = await client.get(paths[step % len(paths)])
+                        ok = response.status_code == 200
+                    except httpx.HTTPError:
+                        ok = False
+                    step += 1
+                    if ok:
+                        latencies.append(time.perf_counter() - started)
+                    else:
+                        errors += 1
+
+            await asyncio.gather(*(worker(i) for i in range(concurrency)))
+        return latencies, errors
+
+    queue.put(asyncio.run(run()))
+
+
+def run_level(args, workers, token, diary_ids):
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers), BENCH_WORKERS_MONGO=args.mongo,
+               BENCH_WORKERS_DIARIES=str(args.diaries), SECRET_KEY=SECRET_KEY, REPORT_BATCH_ENABLED="false")
+    server_log = tempfile.TemporaryFile()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "bench_workers:app", "--app-dir", BENCH_DIR,
+         "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=server_log
+    )
+    try:
+        leaders = wait_until_ready(base, workers, args.startup_timeout)
+        if not leaders:
+            server_log.seek(0)
+            raise SystemExit(f"ERROR: server with {workers} workers never became ready:\n{server_log.read().decode()[-2000:]}")
+        if len(leaders) < workers:
+            # 연결이 한 워커에 몰려 다른 워커의 /ready 응답을 못 본 경우 (부하 중에는 분산됨)
+            print(f"WARNING: only {len(leaders)}/{workers} workers answered /ready")
+        if args.mongo == "local":
+            time.sleep(1)  # 첫 임대 갱신 주기가 돌 때까지
+            leaders = wait_until_ready(base, workers, args.startup_timeout)
+
+        queue = multiprocessing.Queue()
+        clients = [
+            multiprocessing.Process(target=client_process, args=(base, token, diary_ids, args.duration, args.concurrency, queue))
+            for _ in range(args.clients)
+        ]
+        for process in clients:
+            process.start()
+        latencies, errors = [], 0
+        for _ in clients:
+            lat, err = queue.get()
+            latencies += lat
+            errors += err
+        for process in clients:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        server_log.close()
+
+    return {
+        "workers": workers,
+        "rps": len(latencies) / args.duration,
+        "p50_ms": statistics.median(latencies) * 1000 if latencies else 0,
+        "errors": errors,
+        "leaders": sum(1 for leader in leaders.values() if leader) if args.mongo == "local" else None,
+        "seen": len(leaders),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,2,4", help="쉼표로 구분한 워커 수 목록")
+    parser.add_argument("--mongo", choices=["local", "memory"], default="memory")
+    parser.add_argument("--duration", type=float, default=10.0, help="워커 수마다 부하를 주는 시간(초)")
+    parser.add_argument("--clients", type=int, default=2, help="부하 생성 프로세스 수")
+    parser.add_argument("--concurrency", type=int, default=16, help="부하 생성 프로세스당 동시 요청 수")
+    parser.add_argument("--diaries", type=int, default=60)
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    args = parser.parse_args()
+    levels = [int(n) for n in args.workers.split(",")]
+
+    from jose import jwt
+    token = jwt.encode({"sub": BENCH_USER, "exp": datetime.utcnow() + timedelta(hours=1)}, SECRET_KEY, algorithm="HS256")
+
+    main_module = None
+    if args.mongo == "local":
+        import main as main_module
+        seed(main_module, args.diaries)
+        diary_ids = [str(d["_id"]) for d in main_module.diary_collection.find({"user_id": BENCH_USER}, {"_id": 1}).limit(4)]
+    else:
+        diary_ids = []  # 워커마다 시드한 ObjectId 가 달라서 유사 일기 요청은 생략
+
+    try:
+        rows = [run_level(args, workers, token, diary_ids) for workers in levels]
+    finally:
+        if main_module:
+            main_module.diary_collection.delete_many({"user_id": BENCH_USER})
+            main_module.user_collection.delete_many({"user_id": BENCH_USER})
+
+    base_rps = rows[0]["rps"] / rows[0]["workers"]
+    print(f"\ncpus {os.cpu_count()}, mongo {args.mongo}, {args.clients} client processes x {args.concurrency} concurrent, {args.duration}s per level")
+    print(f"{'workers':>8}{'req/s':>10}{'p50 ms':>9}{'errors':>8}{'efficiency':>12}{'leaders':>9}")
+    for row in rows:
+        efficiency = row["rps"] / (base_rps * row["workers"]) if base_rps else 0
+        leaders = "-" if row["leaders"] is None else f"{row['leaders']}/{row['seen']}"
+        print(f"{row['workers']:>8}{row['rps']:>10.1f}{row['p50_ms']:>9.1f}{row['errors']:>8}{efficiency:>11.0%}{leaders:>9}")
+
+
+if __name__ == "__main__":
+    main_cli()
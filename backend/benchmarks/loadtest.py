@@ -0,0 +1,288 @@
+"""
+실제 앱(main.app)을 대상으로 한 부하 테스트 + 기준선(baseline) 비교
+
+가상 유저마다 회원가입/로그인 후, 시드로 고정된 순서의 요청을 섞어서 보냅니다.
+  작성(/analyze-and-save) · 목록(/diaries) · 통계(/user/stats) · 챗봇(/chat/diary) · 음악(목록+스트리밍) · 재로그인
+Gemini 는 standins.FakeGemini (지연/오류 주입), Mongo 는 로컬 mongod 또는 메모리 대역(mongomock)을 씁니다.
+앱은 같은 프로세스 안에서 httpx ASGITransport 로 호출하므로 RSS 는 서버+부하 생성기 합계입니다.
+
+실행:
+  cd backend && python benchmarks/loadtest.py --mongo memory --users 20 --ops 40
+  python benchmarks/loadtest.py --mongo local --ai-latency-ms 1200 --ai-error-rate 0.05
+  python benchmarks/loadtest.py --mongo memory --save-baseline      # 현재 결과를 기준선으로 저장
+기준선: benchmarks/baselines/loadtest.json (프로필 이름별). 같은 머신에서 만든 기준선과 비교하세요.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+BASELINE_PATH = os.path.join(BENCH_DIR, "baselines", "loadtest.json")
+
+# 부하 테스트에서는 유저별 속도 제한 대신 서버 자체의 처리량을 봅니다 (환경 변수로 덮어쓰기 가능)
+for name in ("RATE_LIMIT_ANALYZE_BURST", "RATE_LIMIT_CHAT_BURST"):
+    os.environ.setdefault(name, "100000")
+os.environ.setdefault("GENAI_API_KEY", "bench-dummy-key")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+OP_WEIGHTS = {
+    "analyze": 0.15,
+    "diaries": 0.25,
+    "stats": 0.25,
+    "chat": 0.10,
+    "music": 0.15,
+    "login": 0.10,
+}
+WORDS = ("today walked river friend work tired coffee rain happy worried sleep music "
+         "family deadline lunch quiet evening book run anxious grateful").split()
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+class VirtualUser:
+    def __init__(self, client, index, run_id, seed, results):
+        self.client = client
+        self.user_id = f"load-{run_id}-{index}"
+        self.password = "load-test-password"
+        self.rng = random.Random(seed * 1000 + index)
+        self.results = results
+        self.headers = {}
+        self.diary_ids = []
+        self.music_url = None
+
+    async def timed(self, op, method, url, **kwargs):
+        started = time.perf_counter()
+        response = await self.client.request(method, url, **kwargs)
+        self.results[op].append((time.perf_counter() - started, response.status_code))
+        return response
+
+    async def login(self):
+        response = await self.timed("login", "POST", "/login", data={"username": self.user_id, "password": self.password})
+        if response.status_code == 200:
+            self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    async def setup(self):
+        response = await self.timed("signup", "POST", "/signup", json={"user_id": self.user_id, "password": self.password})
+        if response.status_code != 200:
+            await self.login()
+        else:
+            self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        upload = await self.client.post(
+            "/user/music/upload", headers=self.headers,
+            data={"title": "bench", "artist": "bench"},
+            files={"file": ("bench.mp3", os.urandom(256 * 1024), "audio/mpeg")}
+        )
+        if upload.status_code == 200:
+            self.music_url = upload.json()["music_url"]
+
+    def diary_text(self):
+        words = [self.rng.choice(WORDS) for _ in range(self.rng.randint(40, 400))]
+        return " ".join(words)
+
+    async def run_op(self, op):
+        if op == "analyze":
+            day = datetime(2025, 1, 1) + timedelta(days=self.rng.randint(0, 364))
+            response = await self.timed("analyze", "POST", "/analyze-and-save", headers=self.headers, json={
+                "content": self.diary_text(), "title": "load test", "entry_date": f"{day:%Y-%m-%d}",
+                "mood": self.rng.choice(["happy", "calm", "sad", "angry"]), "tags": [self.rng.choice(["work", "daily", "family"])]
+            })
+            if response.status_code == 200:
+                self.diary_ids.append(response.json()["diary_id"])
+        elif op == "chat" and self.diary_ids:
+            await self.timed("chat", "POST", "/chat/diary", headers=self.headers, json={
+                "diary_ids": self.diary_ids[-1:], "user_message": "How was my week?", "auto_context": True
+            })
+        elif op in ("diaries", "chat"):  # 아직 쓴 일기가 없으면 챗봇 대신 목록 조회
+            await self.timed("diaries", "GET", "/diaries", headers=self.headers)
+        elif op == "stats":
+            await self.timed("stats", "GET", "/user/stats", headers=self.headers)
+        elif op == "music":
+            await self.timed("music_list", "GET", "/user/music/list", headers=self.headers)
+            if self.music_url:
+                await self.timed("music_stream", "GET", self.music_url)
+        elif op == "login":
+            await self.login()
+
+    async def run(self, ops):
+        names, weights = zip(*OP_WEIGHTS.items())
+        for op in self.rng.choices(names, weights=weights, k=ops):
+            await self.run_op(op)
+
+
+async def run_load(args, app=None):
+    import httpx
+
+    if args.base_url:
+        client = httpx.AsyncClient(base_url=args.base_url, timeout=120)
+    else:
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://loadtest", timeout=120)
+
+    results = defaultdict(list)
+    run_id = f"{int(time.time())}"
+    users = [VirtualUser(client, i, run_id, args.seed, results) for i in range(args.users)]
+    async with client:
+        await asyncio.gather(*(u.setup() for u in users))
+        rss_before = current_rss_mb()
+        started = time.perf_counter()
+        await asyncio.gather(*(u.run(args.ops) for u in users))
+        elapsed = time.perf_counter() - started
+    return results, elapsed, rss_before
+
+
+def summarize(results, elapsed, rss_before):
+    ops = {}
+    total = 0
+    for op, samples in sorted(results.items()):
+        latencies = [s[0] * 1000 for s in samples]
+        statuses = defaultdict(int)
+        for _, code in samples:
+            statuses[str(code)] += 1
+        ops[op] = {
+            "count": len(samples),
+            "errors": sum(n for code, n in statuses.items() if not code.startswith("2")),
+            "statuses": dict(statuses),
+            "p50_ms": round(statistics.median(latencies), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+        }
+        if op != "signup":
+            total += len(samples)
+    return {
+        "throughput_rps": round(total / elapsed, 2),
+        "elapsed_sec": round(elapsed, 2),
+        "rss_start_mb": round(rss_before, 1),
+        "rss_end_mb": round(current_rss_mb(), 1),
+        "rss_peak_mb": round(peak_rss_mb(), 1),
+        "ops": ops,
+    }
+
+
+def print_report(summary, baseline, tolerance):
+    print(f"\nthroughput {summary['throughput_rps']} req/s over {summary['elapsed_sec']}s | "
+          f"RSS start {summary['rss_start_mb']}MB end {summary['rss_end_mb']}MB peak {summary['rss_peak_mb']}MB")
+    print(f"{'op':<14}{'count':>7}{'err':>6}{'p50':>10}{'p95':>10}{'p99':>10}   vs baseline p95")
+    regressions = []
+    for op, row in summary["ops"].items():
+        note = ""
+        base = (baseline or {}).get("ops", {}).get(op)
+        if base and base["p95_ms"]:
+            change = row["p95_ms"] / base["p95_ms"] - 1
+            note = f"{change:+.0%}"
+            if change > tolerance:
+                note += "  REGRESSION"
+                regressions.append(f"{op} p95 {base['p95_ms']}ms -> {row['p95_ms']}ms")
+        print(f"{op:<14}{row['count']:>7}{row['errors']:>6}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}   {note}")
+    if baseline:
+        change = summary["throughput_rps"] / baseline["throughput_rps"] - 1
+        print(f"throughput vs baseline: {change:+.0%}")
+        if change < -tolerance:
+            regressions.append(f"throughput {baseline['throughput_rps']} -> {summary['throughput_rps']} req/s")
+    return regressions
+
+
+def load_baselines():
+    if not os.path.exists(BASELINE_PATH):
+        return {}
+    with open(BASELINE_PATH) as f:
+        return json.load(f)
+
+
+def save_baseline(profile, summary, config):
+    baselines = load_baselines()
+    baselines[profile] = {
+        **summary,
+        "config": config,
+        "recorded_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "machine": f"{platform.system()} {platform.machine()} / Python {platform.python_version()} / {os.cpu_count()} cpu",
+    }
+    os.makedirs(os.path.dirname(BASELINE_PATH), exist_ok=True)
+    with open(BASELINE_PATH, "w") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"baseline '{profile}' saved to {BASELINE_PATH}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mongo", choices=["local", "memory"], default="memory", help="local = MONGO_URI 의 mongod, memory = mongomock")
+    parser.add_argument("--base-url", help="이미 떠 있는 서버를 대상으로 실행 (이 경우 Gemini/Mongo 대역은 서버 설정을 따름)")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--ops", type=int, default=40, help="가상 유저당 요청 수")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--ai-latency-ms", type=float, default=800)
+    parser.add_argument("--ai-jitter", type=float, default=0.3)
+    parser.add_argument("--ai-error-rate", type=float, default=0.02)
+    parser.add_argument("--profile", help="기준선 이름 (기본: <mongo>-u<users>-o<ops>)")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="p95/처리량 허용 변화율")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="앱 로그도 출력")
+    args = parser.parse_args()
+
+    app = None
+    fake = None
+    if not args.base_url:
+        if args.mongo == "memory":
+            from standins import use_in_memory_mongo
+            use_in_memory_mongo()
+        from standins import FakeGemini
+        import main
+        main.ensure_indexes()  # ASGITransport 는 lifespan 을 실행하지 않으므로 인덱스는 직접 생성
+        fake = FakeGemini(args.ai_latency_ms, args.ai_jitter, args.ai_error_rate, args.seed)
+        fake.install(main)
+        app = main.app
+
+    # 앱의 요청 로그/print 는 결과 표를 가리므로 기본으로 숨김
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else open(os.devnull, "w")):
+        results, elapsed, rss_before = asyncio.run(run_load(args, app))
+    summary = summarize(results, elapsed, rss_before)
+    if fake:
+        summary["fake_gemini"] = {"calls": fake.calls, "injected_errors": fake.errors}
+
+    profile = args.profile or f"{'remote' if args.base_url else args.mongo}-u{args.users}-o{args.ops}"
+    config = {k: getattr(args, k) for k in ("mongo", "users", "ops", "seed", "ai_latency_ms", "ai_jitter", "ai_error_rate")}
+    baseline = load_baselines().get(profile)
+    if baseline and baseline.get("config") != config:
+        print(f"WARNING: baseline '{profile}' was recorded with a different config; comparison skipped")
+        baseline = None
+
+    regressions = print_report(summary, baseline, args.tolerance)
+    if args.save_baseline:
+        save_baseline(profile, summary, config)
+    elif regressions:
+        print("\nRegressions:\n  " + "\n  ".join(regressions))
+        if args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
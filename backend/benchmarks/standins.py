@@ -0,0 +1,111 @@
+"""
+부하 테스트용 로컬 대역(stand-in)
+
+- FakeGemini : google.generativeai 의 GenerativeModel 자리에 끼워 넣는 가짜 모델.
+               지연 시간(로그정규 분포)과 429 오류 비율을 설정할 수 있고, 시드가 같으면 같은 순서로 재현됩니다.
+               main.call_gemini_with_fallback 의 키 순회 / 동시 호출 제한 / 모델 강등 로직은 그대로 탑니다.
+- use_in_memory_mongo : main 을 import 하기 전에 호출하면 MongoClient 를 mongomock 으로 바꿉니다.
+               (전문 검색($text) 등 일부 기능은 지원되지 않으므로 실제 수치는 로컬 mongod 로 재세요)
+"""
+import asyncio
+import json
+import math
+import os
+import random
+
+FAKE_ANALYSIS = {
+    "event_summary": "Walked along the river after work and talked with a friend.",
+    "analysis": {
+        "theme1": "A steady, restorative day.",
+        "theme2_title": "Small rituals",
+        "theme2": "Routine walks act as a reset.",
+        "theme3": "Social contact lifted the mood.",
+        "theme4": "Some lingering worry about work.",
+        "theme5": "Overall balanced.",
+    },
+    "recommend": {
+        "head": "Keep the evening walk",
+        **{f"method{i}": {"main": "Walk", "content": "Twenty minutes outside", "effect": "Lower stress"} for i in (1, 2, 3)},
+    },
+    "one_liner": "A calm day that ended well.",
+    "keywords": ["#Routine", "#Connection", "#Calm"],
+}
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGemini:
+    """latency_ms: 중앙값, jitter: 로그정규 sigma, error_rate: 호출당 429 확률"""
+    def __init__(self, latency_ms=800.0, jitter=0.3, error_rate=0.0, seed=7):
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+
+    def install(self, main_module):
+        fake = self
+        big5 = main_module.get_default_big5()
+
+        class FakeModel:
+            def __init__(self, model_name, generation_config=None, **kwargs):
+                self.model_name = model_name
+                self.response_type = (generation_config or {}).get("response_mime_type", "application/json")
+
+            async def generate_content_async(self, prompt_parts, **kwargs):
+                return await fake.respond(self.response_type, big5)
+
+        genai = main_module.load_genai()
+        genai.configure = lambda **kwargs: None
+        genai.GenerativeModel = FakeModel
+
+    async def respond(self, response_type, big5):
+        self.calls += 1
+        delay = self.latency_ms / 1000 * math.exp(self.rng.gauss(0, self.jitter))
+        failed = self.rng.random() < self.error_rate
+        await asyncio.sleep(delay)
+        if failed:
+            self.errors += 1
+            raise Exception("429 Resource has been exhausted (e.g. check quota).")
+        if response_type == "text/plain":
+            return FakeResponse("That sounds like a good day. || What made the walk feel different?")
+        return FakeResponse(json.dumps({**FAKE_ANALYSIS, "big5": big5}))
+
+
+def use_in_memory_mongo():
+    import mongomock
+    import mongomock.collection
+    import pymongo
+
+    pymongo.MongoClient = lambda *args, **kwargs: mongomock.MongoClient()
+    os.environ.setdefault("TAG_TRANSACTIONS", "off")  # mongomock은 세션 미지원
+
+    # 최신 pymongo의 UpdateOne 등은 mongomock.bulk_write와 호환되지 않으므로 개별 연산으로 풀어서 실행
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        class Result:
+            inserted_count = matched_count = modified_count = deleted_count = upserted_count = 0
+
+        result = Result()
+        for op in requests:
+            name = type(op).__name__
+            if name == "InsertOne":
+                self.insert_one(op._doc)
+                result.inserted_count += 1
+            elif name in ("UpdateOne", "UpdateMany"):
+                update = self.update_one if name == "UpdateOne" else self.update_many
+                res = update(op._filter, op._doc, upsert=op._upsert)
+                result.matched_count += res.matched_count
+                result.modified_count += res.modified_count
+            elif name == "ReplaceOne":
+                self.replace_one(op._filter, op._doc, upsert=op._upsert)
+            elif name == "DeleteOne":
+                result.deleted_count += self.delete_one(op._filter).deleted_count
+            elif name == "DeleteMany":
+                result.deleted_count += self.delete_many(op._filter).deleted_count
+        return result
+
+    mongomock.collection.Collection.bulk_write = bulk_write
@@ -1,28 +1,52 @@
 import json
 import certifi
 import pymongo
-import google.generativeai as genai
+from pymongo import UpdateOne, UpdateMany
 import re
 import time
 from datetime import datetime, timedelta
-from fastapi import FastAPI, HTTPException, BackgroundTasks, UploadFile, File, Form, Response, Depends, status
+from fastapi import FastAPI, HTTPException, BackgroundTasks, UploadFile, File, Form, Response, Depends, Query, Header, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
 from typing import Optional, List, Dict
-from collections import Counter
+from collections import Counter, defaultdict
 import os
 from dotenv import load_dotenv
+import bson
 from bson import ObjectId
 from bson.binary import Binary
 from passlib.context import CryptContext # 비밀번호 해싱
 from jose import JWTError, jwt # JWT 토큰
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
+import asyncio
 from fastapi import Request
-from starlette.middleware.base import BaseHTTPMiddleware
-import requests # [추가] HTTP 요청용
 import threading # [추가] 백그라운드 실행용
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import difflib
+import zlib
+import base64
+from collections import OrderedDict, deque
+import numpy as np
+import orjson
+import gzip
+from fastapi.responses import JSONResponse, StreamingResponse
+from contextlib import asynccontextmanager, contextmanager
+from starlette.concurrency import run_in_threadpool
+from pymongo import monitoring
+from prometheus_client import Counter as MetricCounter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST, REGISTRY
+import uuid
+import sys
+import random
+import secrets
+import contextvars
+import socket
+import mimetypes
+try:
+    import brotli  # 선택 사항: 없으면 gzip만 사용
+except ImportError:
+    brotli = None
 
 load_dotenv() # .env 파일 로드
 
@@ -41,9 +65,126 @@ SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-should-be-very-secure") #
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 # 토큰 만료 시간 (24시간)
 
+# 비밀번호 해싱 설정 (bcrypt 비용 계수 / 해싱 전용 스레드 수)
+# 비용 계수를 바꾸면 기존 유저는 다음 로그인 때 자동으로 새 비용으로 재해싱됩니다.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+
+# /user/stats 캐시 유지 시간(초). 일기/태그 변경 시에는 즉시 무효화됩니다.
+USER_STATS_CACHE_TTL = int(os.getenv("USER_STATS_CACHE_TTL", "60"))
+
+# 분석 프롬프트에 넣을 유저 특성 키워드 수 (빈도 + 최근성 기준 상위 K개)
+TRAIT_CONTEXT_TOP_K = int(os.getenv("TRAIT_CONTEXT_TOP_K", "15"))
+TRAIT_HALF_LIFE_DAYS = float(os.getenv("TRAIT_HALF_LIFE_DAYS", "30"))  # 이 기간이 지나면 키워드 점수가 절반
+TRAIT_INDEX_MAX = 200          # 순위 계산용으로 보관하는 키워드 최대 개수
+TRAIT_INDEX_MIN_SCORE = 0.05   # 감쇠 후 이 점수 미만인 키워드는 색인에서 제거
+
 # 총괄 리포트 월간 제한 횟수
 LIFE_MAP_MONTHLY_LIMIT = 2
 
+# 일기 수정 시 재분석 기준: 정규화된 본문이 이 비율 이상 바뀌었거나 첨부 이미지가 바뀌면 재분석
+REANALYZE_MIN_CHANGE = float(os.getenv("REANALYZE_MIN_CHANGE", "0.25"))
+
+# 유사 일기 검색용 로컬 임베딩 (해시 기반 TF-IDF 벡터, 외부 모델 불필요)
+EMBEDDING_DIM = 512
+SIMILARITY_CACHE_USERS = int(os.getenv("SIMILARITY_CACHE_USERS", "256"))  # 메모리에 올려둘 유저 색인 수
+SIMILARITY_MIN_SCORE = 0.08  # 이보다 낮은 유사도는 해시 충돌 수준의 잡음으로 보고 제외
+
+# 모바일 증분 동기화: 삭제 기록 보관 기간 (이보다 오래된 커서는 전체 재동기화)
+SYNC_TOMBSTONE_RETENTION_DAYS = int(os.getenv("SYNC_TOMBSTONE_RETENTION_DAYS", "90"))
+SYNC_PAGE_SIZE = 200
+SYNC_INFLIGHT_TIMEOUT_SEC = 300  # 이보다 오래 끝나지 않은 쓰기(프로세스가 죽은 경우)는 커서 계산에서 무시
+
+# 일기 가져오기(import) & 지연 분석 큐
+IMPORT_BATCH_SIZE = 500
+IMPORT_MAX_ENTRIES = int(os.getenv("IMPORT_MAX_ENTRIES", "20000"))
+ANALYSIS_QUEUE_INTERVAL_SEC = float(os.getenv("ANALYSIS_QUEUE_INTERVAL_SEC", "5"))  # 큐 항목 사이 대기 (키 쿼터 보호)
+ANALYSIS_QUEUE_IDLE_SEC = 30           # 큐가 비었을 때 다시 확인하는 간격
+ANALYSIS_QUEUE_MAX_ATTEMPTS = 3
+# Gemini 키가 모두 소진되면 로컬 휴리스틱 분석으로 일단 저장하고 큐에서 재분석 (false 면 예전처럼 500)
+LOCAL_FALLBACK_ENABLED = os.getenv("LOCAL_FALLBACK_ENABLED", "true").lower() == "true"
+
+# 태그 작업 트랜잭션: auto = 레플리카셋(Atlas)이면 사용, 단일 mongod면 자동으로 끔 / off = 사용 안 함
+TAG_TRANSACTIONS = os.getenv("TAG_TRANSACTIONS", "auto")
+DEFAULT_TAG = "unsorted"
+
+# AI 백엔드: gemini = 실제 호출 / record = 실제 호출 + 요청 지문·응답을 파일에 기록 / replay = 기록 재생(오프라인 시뮬레이터)
+AI_BACKEND = os.getenv("AI_BACKEND", "gemini")
+AI_RECORDINGS_PATH = os.getenv("AI_RECORDINGS_PATH", "ai_recordings.jsonl")
+AI_REPLAY_SCRIPT = os.getenv("AI_REPLAY_SCRIPT", "")              # 키별 429/403 실패 시나리오 JSON 파일
+AI_REPLAY_MISS = os.getenv("AI_REPLAY_MISS", "nearest")           # 지문이 없을 때: nearest = 같은 모델의 다른 기록 / error
+AI_REPLAY_LATENCY_SCALE = float(os.getenv("AI_REPLAY_LATENCY_SCALE", "1.0"))
+
+# 응답 압축: 이 크기(바이트) 이상인 JSON/텍스트 응답만 Accept-Encoding 에 맞춰 br 또는 gzip 으로 압축
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = 5       # 6(기본)과 압축률은 비슷하고 더 빠름
+BROTLI_QUALITY = 4   # 동적 응답용 (11은 정적 파일용으로 너무 느림)
+COMPRESSION_THREAD_BYTES = 256 * 1024  # 이보다 큰 본문은 이벤트 루프를 막지 않게 스레드에서 압축
+
+# 서버 시작 워밍업: Mongo 접속 실패 시 재시도 간격 (성공할 때까지 /ready 는 503)
+STARTUP_MONGO_RETRY_SEC = float(os.getenv("STARTUP_MONGO_RETRY_SEC", "5"))
+
+# 요청 프로파일러 (운영 중 느린 요청 원인 분석용, 기본은 꺼짐)
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")        # X-Profile 헤더/관리자 API(/admin/*, /metrics) 인증. 비어 있으면 헤더 트리거와 관리자 API 비활성
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # 0~1, 무작위로 프로파일링할 요청 비율
+PROFILE_INTERVAL_SEC = float(os.getenv("PROFILE_INTERVAL_SEC", "0.005"))
+PROFILE_BUFFER_SIZE = int(os.getenv("PROFILE_BUFFER_SIZE", "50"))
+
+# 정기(격주) 리포트 배치 설정 - 한가한 시간대(UTC 기준)에만 생성
+# 기본값 17~21시(UTC) = 한국 시간 새벽 2~6시
+REPORT_BATCH_ENABLED = os.getenv("REPORT_BATCH_ENABLED", "true").lower() == "true"
+REPORT_OFFPEAK_START_HOUR = int(os.getenv("REPORT_OFFPEAK_START_HOUR", "17"))
+REPORT_OFFPEAK_END_HOUR = int(os.getenv("REPORT_OFFPEAK_END_HOUR", "21"))
+REPORT_BATCH_PAUSE_SEC = float(os.getenv("REPORT_BATCH_PAUSE_SEC", "15"))      # 유저 사이 대기 (키 쿼터 보호)
+REPORT_SCHEDULER_POLL_SEC = int(os.getenv("REPORT_SCHEDULER_POLL_SEC", "600"))
+REPORT_BATCH_RETRY_ROUNDS = int(os.getenv("REPORT_BATCH_RETRY_ROUNDS", "3"))  # 실패한 유저를 다시 시도하는 횟수 (주기당)
+REPORT_MIN_DIARIES = 3
+
+# 데이터 수명 주기 (리더 워커의 정리 작업 + TTL 인덱스). 0 이면 해당 정책을 끕니다.
+LIFECYCLE_ENABLED = os.getenv("LIFECYCLE_ENABLED", "true").lower() == "true"
+DRAFT_RETENTION_DAYS = int(os.getenv("DRAFT_RETENTION_DAYS", "0"))    # 이 기간 동안 손대지 않은 임시 저장은 삭제 (기본 꺼짐, 운영자가 켬)
+REPORT_KEEP_LATEST = int(os.getenv("REPORT_KEEP_LATEST", "0"))        # 유저별 최신 인생 지도 리포트 N개만 보관 (기본 꺼짐, 운영자가 켬)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))      # 작성 후 이 기간이 지난 일기의 무거운 필드는 콜드 컬렉션으로
+SUPERSEDED_GRACE_SEC = 3600   # 교체된 음악/이미지/리포트를 TTL 로 지우기 전 유예 (기존 URL로 재생 중인 클라이언트용)
+COMPACTOR_INTERVAL_SEC = float(os.getenv("COMPACTOR_INTERVAL_SEC", "3600"))
+COMPACTOR_BATCH = 200
+COMPACTOR_MAX_BATCHES = 20    # 한 번 돌 때 정책별 최대 배치 수 (밀린 작업은 다음 주기에)
+
+# Gemini 호출 엔드포인트 속도 제한 (토큰 버킷: 최대 버스트 횟수, 초당 충전량)
+RATE_LIMITS = {
+    "analyze": (int(os.getenv("RATE_LIMIT_ANALYZE_BURST", "5")), float(os.getenv("RATE_LIMIT_ANALYZE_PER_MIN", "6")) / 60),
+    "chat": (int(os.getenv("RATE_LIMIT_CHAT_BURST", "10")), float(os.getenv("RATE_LIMIT_CHAT_PER_MIN", "20")) / 60),
+    "ocr": (int(os.getenv("RATE_LIMIT_OCR_BURST", "3")), float(os.getenv("RATE_LIMIT_OCR_PER_MIN", "4")) / 60),
+}
+# 멀티 워커 / 멀티 인스턴스 실행 (uvicorn 과 gunicorn 모두 WEB_CONCURRENCY 를 워커 수 기본값으로 사용)
+#   WEB_CONCURRENCY=4 uvicorn main:app --host 0.0.0.0 --port $PORT
+#   WEB_CONCURRENCY=4 gunicorn main:app -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:$PORT
+# 워커 수는 CPU 코어 수 정도로. --workers 로 따로 지정할 때도 WEB_CONCURRENCY 를 같은 값으로 두세요.
+# SHARED_STATE=true 면 속도 제한, 키 쿨다운, 캐시 무효화를 Mongo로 워커 간에 공유합니다.
+# 워커가 여러 개면 자동으로 켜지고, 인스턴스를 여러 대 띄울 때는 직접 켜세요.
+# /metrics 는 요청을 받은 워커 하나의 값이므로 워커별로 구분해서 보세요 (/ready 의 worker 필드).
+WORKER_COUNT = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+SHARED_STATE = os.getenv("SHARED_STATE", "true" if WORKER_COUNT > 1 else "false").lower() == "true"
+SHARED_STATE_REFRESH_SEC = float(os.getenv("SHARED_STATE_REFRESH_SEC", "2"))  # 공유 키 쿨다운을 다시 읽는 간격
+# 셀프 핑 / 리포트 배치 / 분석 큐는 Mongo 임대(lease)를 가진 워커 하나만 실행
+LEADER_LEASE_SEC = int(os.getenv("LEADER_LEASE_SEC", "30"))
+LEADER_RENEW_SEC = LEADER_LEASE_SEC / 3
+
+# "memory": 프로세스 내 상태 / "mongo": 여러 워커가 공유하는 Mongo 상태
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "mongo" if SHARED_STATE else "memory")
+
+# Gemini 동시 호출 제한 (키 하나당 동시 호출 수 x 키 개수) 및 대기열 크기
+GEMINI_CONCURRENCY_PER_KEY = int(os.getenv("GEMINI_CONCURRENCY_PER_KEY", "4"))
+GEMINI_MAX_QUEUE = int(os.getenv("GEMINI_MAX_QUEUE", "20"))
+GEMINI_QUEUE_TIMEOUT = float(os.getenv("GEMINI_QUEUE_TIMEOUT", "30"))
+
+# 일기 분석 모델 티어 (무거운 모델 / 가벼운 모델)
+ANALYSIS_MODEL_HEAVY = "gemini-3-flash-preview"
+ANALYSIS_MODEL_LIGHT = "gemini-2.5-flash-lite"
+SHORT_DIARY_CHARS = int(os.getenv("SHORT_DIARY_CHARS", "300"))          # 이보다 짧고 이미지가 없으면 가벼운 모델
+ANALYSIS_LATENCY_BUDGET_SEC = float(os.getenv("ANALYSIS_LATENCY_BUDGET_SEC", "20"))  # 무거운 모델 평균 지연이 이걸 넘으면 강등
+KEY_COOLDOWN_SEC = int(os.getenv("KEY_COOLDOWN_SEC", "60"))             # 429/403 받은 키를 '아픈 키'로 보는 시간
+
 # --- 1. 초기 설정 ---
 MONGO_URI = MONGO_URI.strip()
 
@@ -54,35 +195,429 @@ MONGO_URI = MONGO_URI.strip()
 #    generation_config={"response_mime_type": "application/json"}
 #)
 
+# --- [Metrics] 관측 지표 (Prometheus) & 구조화 로그 ---
+# 라벨에는 라우트 '템플릿'과 키 '번호'만 사용 (유저 ID / 실제 경로 / API 키 값은 절대 넣지 않음)
+HTTP_REQUEST_SECONDS = Histogram(
+    "onion_http_request_duration_seconds", "HTTP request latency by route template",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+MONGO_COMMAND_SECONDS = Histogram(
+    "onion_mongo_command_duration_seconds", "MongoDB command latency",
+    ["command"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+MONGO_COMMAND_FAILURES = MetricCounter("onion_mongo_command_failures_total", "Failed MongoDB commands", ["command"])
+GEMINI_CALL_SECONDS = Histogram(
+    "onion_gemini_call_duration_seconds", "Gemini call latency per model and API key slot",
+    ["model", "key"],
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+)
+GEMINI_CALL_ERRORS = MetricCounter("onion_gemini_call_errors_total", "Gemini call failures", ["model", "key", "kind"])
+# 응답 파싱 결과 (복구/보충 요청이 전체 재호출을 얼마나 막았는지 확인용)
+ANALYSIS_PARSE_OUTCOMES = MetricCounter("onion_analysis_parse_total", "Gemini analysis parse outcomes", ["outcome"])
+LOCAL_FALLBACK_TOTAL = MetricCounter("onion_analysis_local_fallback_total", "Diaries saved with the local heuristic analysis")
+LIFECYCLE_ITEMS = MetricCounter("onion_lifecycle_items_total", "Documents pruned, expired or archived by the lifecycle compactor", ["policy"])
+LIFECYCLE_BYTES = MetricCounter("onion_lifecycle_bytes_total", "BSON bytes removed from hot collections by the lifecycle compactor", ["policy"])
+COLLECTION_SIZE_BYTES = Gauge("onion_collection_size_bytes", "Data + index size per collection (working set estimate)", ["collection"])
+CACHE_REQUESTS = MetricCounter("onion_cache_requests_total", "In-process cache lookups", ["cache", "result"])
+BACKGROUND_TASKS_PENDING = Gauge("onion_background_tasks_pending", "Background tasks scheduled but not finished", ["task"])
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """pymongo 명령 모니터링 -> 명령 종류별 지연 히스토그램 (+ 프로파일 중인 요청의 db 구간)"""
+    def started(self, event):
+        profile = current_profile.get()
+        if profile:
+            profile.threads.add(threading.get_ident())  # 동기 엔드포인트가 도는 워커 스레드도 샘플링 대상
+
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.labels(event.command_name).observe(event.duration_micros / 1e6)
+        add_profile_span("db", event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGO_COMMAND_SECONDS.labels(event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.labels(event.command_name).inc()
+        add_profile_span("db", event.duration_micros / 1e6)
+
+def log_event(event: str, **fields):
+    """한 줄짜리 JSON 로그 (로그 수집기에서 필드별로 검색 가능)"""
+    print(json.dumps({"ts": datetime.utcnow().isoformat(timespec="milliseconds") + "Z", "event": event, **fields}, ensure_ascii=False, default=str))
+
+def add_tracked_task(background_tasks: BackgroundTasks, func, *args, **kwargs):
+    """BackgroundTasks.add_task + 대기 중인 작업 수 게이지"""
+    gauge = BACKGROUND_TASKS_PENDING.labels(func.__name__)
+    gauge.inc()
+
+    async def run():
+        try:
+            if asyncio.iscoroutinefunction(func):
+                await func(*args, **kwargs)
+            else:
+                await run_in_threadpool(func, *args, **kwargs)
+        finally:
+            gauge.dec()
+
+    background_tasks.add_task(run)
+
+# --- [Profiler] 요청 단위 샘플링 프로파일러 ---
+# 관리자 헤더(X-Profile: <PROFILE_ADMIN_TOKEN>) 또는 PROFILE_SAMPLE_RATE 확률로 켜집니다.
+# - 구간 합계: db(Mongo 명령) / ai(Gemini 대기+호출) / serialize(JSON 렌더링) / python(나머지)
+# - 통계 프로파일: 별도 스레드가 PROFILE_INTERVAL_SEC마다 해당 요청의 스택을 찍어 collapsed 형식으로 집계
+current_profile = contextvars.ContextVar("current_profile", default=None)
+
+class RequestProfile:
+    def __init__(self, method: str, path: str, trigger: str, root_frame):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.trigger = trigger
+        self.root_frame = root_frame          # 이 요청의 미들웨어 프레임 (이벤트 루프 스택 판별용)
+        self.loop_thread = threading.get_ident()
+        self.threads = set()                  # 이 요청이 사용한 스레드 풀 워커
+        self.spans = Counter()
+        self.span_calls = Counter()
+        self.stacks = Counter()
+        self.done = False                     # 응답 전송 완료 후(BackgroundTasks 실행 중)에는 기록 중단
+        self.started_at = datetime.utcnow()
+        self.started = time.perf_counter()
+
+    def summary(self, route: str, status_code: int, duration: float) -> dict:
+        spans = {k: round(self.spans.get(k, 0.0) * 1000, 2) for k in ("db", "ai", "serialize")}
+        spans["python"] = round(max(0.0, duration * 1000 - sum(spans.values())), 2)
+        return {
+            "id": self.id, "method": self.method, "path": self.path, "route": route, "status": status_code,
+            "trigger": self.trigger, "started_at": self.started_at.isoformat() + "Z",
+            "duration_ms": round(duration * 1000, 2), "spans_ms": spans, "calls": dict(self.span_calls),
+            "samples": sum(self.stacks.values())
+        }
+
+def add_profile_span(kind: str, seconds: float):
+    profile = current_profile.get()
+    if profile and not profile.done:
+        profile.spans[kind] += seconds
+        profile.span_calls[kind] += 1
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class ProfileSampler:
+    """활성 프로파일이 있을 때만 도는 샘플링 스레드 + 최근 N개 링 버퍼"""
+    def __init__(self, interval: float, buffer_size: int):
+        self.interval = interval
+        self.finished = deque(maxlen=buffer_size)  # (summary, stacks)
+        self._active = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, profile: RequestProfile):
+        with self._lock:
+            self._active.add(profile)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+                self._thread.start()
+
+    def finish(self, profile: RequestProfile, summary: dict):
+        with self._lock:
+            self._active.discard(profile)
+            self.finished.append((summary, profile.stacks))
+
+    def _sample(self, profile: RequestProfile, frames: dict):
+        for thread_id in [profile.loop_thread, *profile.threads]:
+            frame = frames.get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame)
+                if frame is profile.root_frame:
+                    break
+                frame = frame.f_back
+            if thread_id == profile.loop_thread:
+                if not stack or stack[-1] is not profile.root_frame:
+                    continue  # 이벤트 루프가 다른 요청을 처리 중
+            else:
+                # 워커 스레드: 스레드 풀 내부 프레임은 버리고 앱 코드부터
+                while stack and os.path.basename(stack[-1].f_code.co_filename) != "main.py":
+                    stack.pop()
+                if not stack:
+                    continue
+            profile.stacks[";".join(_frame_label(f) for f in reversed(stack))] += 1
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active)
+                if not active:
+                    self._thread = None
+                    return
+            frames = sys._current_frames()
+            for profile in active:
+                if not profile.done:
+                    self._sample(profile, frames)
+
+    def collapsed(self, profile_id: Optional[str] = None) -> str:
+        """flamegraph.pl / speedscope 가 읽는 collapsed stack 형식 ("a;b;c 12")"""
+        merged = Counter()
+        for summary, stacks in list(self.finished):
+            if profile_id is None or summary["id"] == profile_id:
+                merged.update(stacks)
+        return "\n".join(f"{stack} {count}" for stack, count in merged.most_common()) + "\n"
+
+profile_sampler = ProfileSampler(PROFILE_INTERVAL_SEC, PROFILE_BUFFER_SIZE)
+
+def should_profile(scope) -> Optional[str]:
+    path = scope.get("path", "")
+    if path.startswith("/admin") or path == "/metrics":
+        return None
+    if PROFILE_ADMIN_TOKEN:
+        header = dict(scope["headers"]).get(b"x-profile", b"").decode("latin-1")
+        if header and secrets.compare_digest(header, PROFILE_ADMIN_TOKEN):
+            return "header"
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return "sample"
+    return None
+
+def _json_default(value):
+    """orjson이 직접 처리하지 못하는 타입 (datetime / numpy 는 orjson이 직접 처리)"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+class TimedJSONResponse(JSONResponse):
+    """
+    기본 응답 클래스: orjson으로 렌더링하고 걸린 시간을 프로파일의 serialize 구간으로 기록.
+    Mongo 문서를 그대로 넘기면(ObjectId / datetime 포함) FastAPI의 jsonable_encoder 를 건너뛰므로
+    큰 응답은 dict 대신 이 클래스를 직접 반환하세요.
+    """
+    def render(self, content) -> bytes:
+        started = time.perf_counter()
+        body = orjson.dumps(content, default=_json_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+        add_profile_span("serialize", time.perf_counter() - started)
+        return body
+
 # MongoDB 연결
-client = pymongo.MongoClient(MONGO_URI, tlsCAFile=certifi.where())
+# connect=False: SRV 조회 / 서버 접속을 첫 명령까지 미룸 (import 시 네트워크 대기 없음, 실제 연결은 lifespan 워밍업에서)
+client = pymongo.MongoClient(MONGO_URI, tlsCAFile=certifi.where(), connect=False, event_listeners=[MongoCommandTimer()])
 db = client["Onion_Project"]
 diary_collection = db["diaries"]
 user_collection = db["users"]
 report_collection = db["life_reports"]
 music_collection = db["musics"]
 image_collection = db["images"]
+rate_limit_collection = db["rate_limits"]
+trend_collection = db["trend_rollups"]
+job_collection = db["jobs"]  # 백그라운드 배치 작업의 진행 상황(체크포인트)
+tombstone_collection = db["diary_tombstones"]  # 삭제된 일기 기록 (동기화용)
+coordination_collection = db["coordination"]  # 워커 간 공유 상태 (리더 임대, 키 쿨다운)
+archive_collection = db["diary_archive"]  # 오래된 일기의 무거운 필드 (콜드 아카이브, _id 는 원래 일기와 같음)
+
+def ensure_indexes():
+    """인덱스 생성 (이미 있으면 아무 일도 하지 않음). 서버 시작 시 lifespan 워밍업에서 호출"""
+    trend_collection.create_index([("user_id", 1), ("granularity", 1), ("period", 1)], unique=True)
+    # 일기 전문 검색: user_id 등호 조건 + 텍스트 필드 (본문은 HTML/이미지를 걷어낸 clean_text 사용)
+    diary_collection.create_index(
+        [("user_id", 1), ("title", "text"), ("clean_text", "text"), ("event_summary", "text"), ("tags", "text")],
+        weights={"title": 5, "tags": 5, "event_summary": 3, "clean_text": 1},
+        name="diary_text_search"
+    )
+    diary_collection.create_index([("user_id", 1), ("sync_seq", 1)])
+    tombstone_collection.create_index([("user_id", 1), ("sync_seq", 1)])
+    diary_collection.create_index([("analysis_status", 1), ("queued_at", 1)])
+    diary_collection.create_index([("user_id", 1), ("tags", 1)])  # 태그 작업용 멀티키 인덱스
+    tombstone_collection.create_index("deleted_at", expireAfterSeconds=SYNC_TOMBSTONE_RETENTION_DAYS * 86400)
+    # 데이터 수명 주기: 정리 작업용 인덱스 + 교체/만료 표시된 문서는 expires_at 시각에 TTL 로 삭제
+    diary_collection.create_index([("is_temporary", 1), ("updated_at", 1)])
+    diary_collection.create_index([("is_temporary", 1), ("created_at", 1)])
+    for collection in (report_collection, music_collection, image_collection):
+        collection.create_index("expires_at", expireAfterSeconds=0)
+    if RATE_LIMIT_BACKEND == "mongo":
+        # 1시간 동안 요청이 없던 버킷은 자동 삭제 (가득 찬 버킷과 동일하므로 정보 손실 없음)
+        rate_limit_collection.create_index("updated_at", expireAfterSeconds=3600)
 
 # 비밀번호 해싱 컨텍스트
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    # min=max=현재 비용 -> 비용이 다른 해시는 needs_update로 판정되어 로그인 시 재해싱
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+# bcrypt는 CPU를 오래 쓰므로 이벤트 루프가 아닌 전용 스레드 풀에서 실행 (bcrypt는 GIL을 해제함)
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="pwd-hash")
 
 # OAuth2 스키마 (토큰 URL 설정)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
-app = FastAPI()
+# --- [Lifespan] 서버 시작 / 종료 ---
+# import 시에는 네트워크나 무거운 SDK를 건드리지 않고, 초기화는 여기서 합니다.
+# (import 단계에서 스레드 / 소켓을 만들지 않으므로 gunicorn --preload 로 fork 해도 안전하며, 연결은 워커마다 따로 생김)
+# 워밍업(Mongo 접속 + 인덱스, Gemini SDK, bcrypt 백엔드)은 백그라운드에서 병렬로 돌기 때문에
+# 워밍업이 끝나기 전에도 /health 는 바로 응답하고, 준비 완료 여부는 /ready 로 알립니다.
+@asynccontextmanager
+async def lifespan(app):
+    prepare_static_dirs()
+    background_loop_tasks.append(asyncio.create_task(warm_up_and_start()))
+    try:
+        yield
+    finally:
+        await cancel_tasks(background_loop_tasks)
+        background_loop_tasks.clear()
+
+app = FastAPI(default_response_class=TimedJSONResponse, lifespan=lifespan)
+
+# --- [Middleware] 요청 계측 + HTTP/3(QUIC) 강제 연결 방지 ---
+# 순수 ASGI 미들웨어: 응답 본문을 감싸지 않으므로 스트리밍 응답도 그대로 흘러갑니다.
+# - 라우트별 지연 히스토그램 + 요청당 한 줄 JSON 로그 (X-Request-ID)
+# - 브라우저가 불안정한 UDP(QUIC) 통신을 시도하지 않도록 Alt-Svc 헤더 삭제
+class InstrumentationMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        request_id = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")[:64] or uuid.uuid4().hex[:16]
+        status_code = 500
+        finished = None  # 응답 본문 마지막 조각을 보낸 시각 (이후 도는 BackgroundTasks 시간은 제외)
+
+        profile = None
+        trigger = should_profile(scope)
+        if trigger:
+            profile = RequestProfile(scope["method"], scope["path"], trigger, sys._getframe())
+            profile_token = current_profile.set(profile)
+            profile_sampler.start(profile)
+
+        async def send_wrapper(message):
+            nonlocal status_code, finished
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                headers = [(k, v) for k, v in message.get("headers", []) if k.lower() != b"alt-svc"]
+                headers.append((b"x-request-id", request_id.encode("latin-1")))
+                if profile:
+                    headers.append((b"x-profile-id", profile.id.encode("latin-1")))
+                message = {**message, "headers": headers}
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                finished = time.perf_counter()
+                if profile:
+                    profile.done = True
+            await send(message)
 
-# --- [Security] HTTP/3(QUIC) 강제 연결 방지 미들웨어 ---
-# 브라우저가 불안정한 UDP(QUIC) 통신을 시도하지 않도록 Alt-Svc 헤더를 삭제합니다.
-class DisableHTTP3Middleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        response = await call_next(request)
-        # Alt-Svc 헤더가 있다면 삭제하여 브라우저의 QUIC 업그레이드 시도를 차단
-        if "Alt-Svc" in response.headers:
-            del response.headers["Alt-Svc"]
-        return response
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = (finished or time.perf_counter()) - started
+            # 라우터가 scope에 채워 준 경로 템플릿 사용 (/diaries/{diary_id}), 매칭 실패는 하나로 묶음
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            HTTP_REQUEST_SECONDS.labels(scope["method"], route, str(status_code)).observe(duration)
+            log_fields = {}
+            if profile:
+                summary = profile.summary(route, status_code, duration)
+                profile_sampler.finish(profile, summary)
+                current_profile.reset(profile_token)
+                log_fields = {"profile_id": profile.id, "spans_ms": summary["spans_ms"]}
+            log_event(
+                "http_request", request_id=request_id, method=scope["method"], route=route,
+                status=status_code, duration_ms=round(duration * 1000, 1), **log_fields
+            )
 
-# 2. 미들웨어 적용
-app.add_middleware(DisableHTTP3Middleware)
+# --- [Middleware] 응답 압축 (Accept-Encoding 협상: br > gzip) ---
+# 한 번에 끝나는 JSON/텍스트 응답만 압축합니다. 스트리밍 응답(내보내기, 음악 스트리밍)과 이미 인코딩된 응답은 그대로 보냄.
+COMPRESSIBLE_TYPES = (b"application/json", b"text/", b"application/x-ndjson")
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Accept-Encoding 에서 q 값이 가장 높은 지원 인코딩 (같으면 br 우선). 없으면 None"""
+    supported = ["br", "gzip"] if brotli else ["gzip"]
+    explicit, wildcard = {}, 0.0
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        params = params.strip()
+        try:
+            q = float(params[2:]) if params.startswith("q=") else 1.0
+        except ValueError:
+            q = 0.0
+        if name == "*":
+            wildcard = q
+        else:
+            explicit[name] = q
+    weights = {e: explicit.get(e, wildcard) for e in supported}
+    best = max(supported, key=lambda e: weights[e])  # 동점이면 앞쪽(br) 우선
+    return best if weights[best] > 0 else None
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+class CompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(dict(scope["headers"]).get(b"accept-encoding", b"").decode("latin-1"))
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                headers = dict((k.lower(), v) for k, v in message.get("headers", []))
+                content_type = headers.get(b"content-type", b"")
+                if b"content-encoding" in headers or not content_type.startswith(COMPRESSIBLE_TYPES):
+                    passthrough = True
+                    await send(message)
+                else:
+                    start_message = message  # 본문을 보고 압축 여부를 정할 때까지 보류
+                return
+            if passthrough or start_message is None:
+                await send(message)
+                return
+
+            start, start_message = start_message, None
+            body = message.get("body", b"")
+            if message.get("more_body", False) or len(body) < COMPRESSION_MIN_BYTES:
+                # 스트리밍 응답이거나 작은 응답: 압축하지 않고 그대로
+                passthrough = True
+                await send(start)
+                await send(message)
+                return
+
+            started = time.perf_counter()
+            if len(body) >= COMPRESSION_THREAD_BYTES:
+                compressed = await asyncio.to_thread(compress_body, body, encoding)
+            else:
+                compressed = compress_body(body, encoding)
+            add_profile_span("serialize", time.perf_counter() - started)
+            headers = [(k, v) for k, v in start.get("headers", []) if k.lower() not in (b"content-length", b"vary")]
+            vary = [v for k, v in start.get("headers", []) if k.lower() == b"vary"]
+            headers += [
+                (b"content-encoding", encoding.encode()),
+                (b"content-length", str(len(compressed)).encode()),
+                (b"vary", b", ".join(vary + [b"Accept-Encoding"])),
+            ]
+            await send({**start, "headers": headers})
+            await send({**message, "body": compressed})
+
+        await self.app(scope, receive, send_wrapper)
+
+# 압축은 계측 미들웨어 안쪽에서 실행 (압축 시간도 요청 시간 / serialize 구간에 포함)
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(InstrumentationMiddleware)
 
 # CORS 설정
 app.add_middleware(
@@ -95,12 +630,13 @@ app.add_middleware(
 )
 
 # --- [Static] 기본 음악 파일 제공 설정 ---
-if not os.path.exists("static/music"):
+def prepare_static_dirs():
+    """업로드 / 기본 음악 폴더 생성 (lifespan 시작 시 호출)"""
     os.makedirs("static/music", exist_ok=True)
-if not os.path.exists("static/images"):
     os.makedirs("static/images", exist_ok=True)
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# 폴더는 lifespan에서 만들므로 마운트 시점에는 존재 여부를 검사하지 않음
+app.mount("/static", StaticFiles(directory="static", check_dir=False), name="static")
 
 # --- [Constants] 기본 음악 리스트 ---
 DEFAULT_MUSIC_LIST = [
@@ -124,6 +660,18 @@ def get_password_hash(password):
     # [FIX] Bcrypt는 72바이트 제한이 있으므로, 초과 시 앞부분만 잘라서 해싱합니다.
     return pwd_context.hash(password[:72])
 
+def verify_and_update_password(plain_password, hashed_password):
+    """검증 결과와 (비용 계수가 바뀐 경우) 새 해시를 함께 반환합니다. 새 해시가 필요 없으면 None."""
+    return pwd_context.verify_and_update(plain_password[:72], hashed_password)
+
+async def get_password_hash_async(password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, get_password_hash, password)
+
+async def verify_and_update_password_async(plain_password, hashed_password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, verify_and_update_password, plain_password, hashed_password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -151,59 +699,545 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         raise credentials_exception
     return user_id
 
-# --- [Helper] Gemini 호출 Fallback 함수 ---
-async def call_gemini_with_fallback(prompt_parts, response_type="application/json", model_name="gemini-3-flash-preview"):
+# --- [Helper] 유저별 속도 제한 (Token Bucket) ---
+class TokenBucketLimiter:
     """
-    API 키를 순회하며 Gemini 호출.
-    Args:
-        model_name: 기본값은 'gemini-3-flash-preview'. 
-                    챗봇 등에서 'gemini-2.0-flash-lite-preview' 등을 지정해서 사용 가능.
+    (유저, 엔드포인트 종류)마다 토큰 버킷을 두고 요청 1회당 토큰 1개를 소모합니다.
+    backend="mongo"면 버킷 상태를 rate_limits 컬렉션에 두어 멀티 워커 간에 공유합니다 (TTL 인덱스로 정리).
+    메모리 모드는 sweep_interval 마다 가득 다시 찬 버킷을 지웁니다 (없는 버킷 = 가득 찬 버킷이므로 동작은 같음).
     """
+    def __init__(self, limits: dict, backend: str = "memory", sweep_interval: float = 60.0):
+        self.limits = limits
+        self.backend = backend
+        self.sweep_interval = sweep_interval
+        self._buckets = {}  # (user_id, endpoint_class) -> (tokens, last_refill_ts)
+        self._swept_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _sweep(self, now: float):
+        # 호출자가 self._lock 을 잡고 있어야 함
+        self._swept_at = now
+        for key, (tokens, last) in list(self._buckets.items()):
+            capacity, refill_rate = self.limits[key[1]]
+            if tokens + (now - last) * refill_rate >= capacity:
+                del self._buckets[key]
+
+    def acquire(self, user_id: str, endpoint_class: str) -> float:
+        """토큰을 얻으면 0, 부족하면 다음 토큰까지 기다려야 할 초를 반환합니다."""
+        capacity, refill_rate = self.limits[endpoint_class]
+        if self.backend == "mongo":
+            return self._acquire_mongo(user_id, endpoint_class, capacity, refill_rate)
+
+        now = time.monotonic()
+        with self._lock:
+            if now - self._swept_at >= self.sweep_interval:
+                self._sweep(now)
+            tokens, last = self._buckets.get((user_id, endpoint_class), (capacity, now))
+            tokens = min(capacity, tokens + (now - last) * refill_rate)
+            if tokens >= 1:
+                self._buckets[(user_id, endpoint_class)] = (tokens - 1, now)
+                return 0.0
+            self._buckets[(user_id, endpoint_class)] = (tokens, now)
+        return (1 - tokens) / refill_rate
+
+    def _acquire_mongo(self, user_id: str, endpoint_class: str, capacity: int, refill_rate: float) -> float:
+        # 충전 + 차감을 파이프라인 업데이트 한 번으로 처리 (워커 간 경쟁 조건 없음)
+        now = datetime.utcnow()
+        elapsed_sec = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, 1000]}
+        refilled = {"$min": [capacity, {"$add": [{"$ifNull": ["$tokens", capacity]}, {"$multiply": [elapsed_sec, refill_rate]}]}]}
+        doc = rate_limit_collection.find_one_and_update(
+            {"_id": f"{endpoint_class}:{user_id}"},
+            [
+                {"$set": {"tokens": refilled, "updated_at": now}},
+                {"$set": {"granted": {"$gte": ["$tokens", 1]}}},
+                {"$set": {"tokens": {"$cond": ["$granted", {"$subtract": ["$tokens", 1]}, "$tokens"]}}},
+            ],
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        if doc.get("granted"):
+            return 0.0
+        return (1 - doc.get("tokens", 0)) / refill_rate
 
-    # 안전 필터 해제 (가장 낮은 수준으로 설정)
-    safety_settings = {
-        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-    }
+rate_limiter = TokenBucketLimiter(RATE_LIMITS, RATE_LIMIT_BACKEND)
+
+def check_rate_limit(user_id: str, endpoint_class: str):
+    """한도를 넘으면 Retry-After 헤더와 함께 429를 던집니다."""
+    retry_after = rate_limiter.acquire(user_id, endpoint_class)
+    if retry_after > 0:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests. Please try again later.",
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))}
+        )
 
-    for i, api_key in enumerate(API_KEYS):
+# --- [Helper] Gemini 전역 동시 호출 제한 ---
+class GeminiAdmission:
+    """
+    모든 Gemini 호출이 공유하는 세마포어 + 대기열.
+    동시 호출 수는 키 용량에 맞추고, 대기열이 가득 차면 바로 503(Retry-After)을 돌려줍니다.
+    """
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self._semaphore = None
+
+    def _busy(self, detail: str):
+        return HTTPException(
+            status_code=503,
+            detail=detail,
+            headers={"Retry-After": str(max(1, int(self.queue_timeout / 2)))}
+        )
+
+    async def __aenter__(self):
+        # 세마포어는 이벤트 루프 안에서 만들어야 하므로 최초 사용 시 생성
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            raise self._busy("AI server is busy. Please try again later.")
+        self.waiting += 1
         try:
-            genai.configure(api_key=api_key)
-            
-            # [수정됨] 전달받은 model_name 사용
-            current_model = genai.GenerativeModel(
-                model_name,
-                generation_config={"response_mime_type": response_type}
-            )
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise self._busy("AI server is busy. Please try again later.")
+        finally:
+            self.waiting -= 1
+        return self
 
-            print(f"INFO: Trying {model_name} with Key {i+1}...") 
-            response = current_model.generate_content(
-                prompt_parts, 
-                safety_settings=safety_settings
-            )
-            
-            # 3. 응답 확인
+    async def __aexit__(self, exc_type, exc, tb):
+        self._semaphore.release()
+        return False
+
+# 세마포어는 프로세스마다 따로 있으므로 키 용량을 워커 수로 나눠 전체 동시 호출 수를 유지
+gemini_admission = GeminiAdmission(
+    max(1, -(-GEMINI_CONCURRENCY_PER_KEY * len(API_KEYS) // WORKER_COUNT)), GEMINI_MAX_QUEUE, GEMINI_QUEUE_TIMEOUT
+)
+Gauge("onion_gemini_queue_waiting", "Requests waiting for a Gemini slot").set_function(lambda: gemini_admission.waiting)
+
+# --- [Helper] 모델 라우팅 (키 상태 + 모델별 지연 시간 기반 티어 선택) ---
+class ModelRouter:
+    """
+    Gemini 호출 결과를 관찰해 키 상태와 모델별 평균 지연 시간을 추적하고,
+    일기 길이/이미지 수와 함께 분석에 쓸 모델 티어를 고릅니다.
+    """
+    def __init__(self, key_count: int, latency_alpha: float = 0.3, shared: bool = False):
+        self.key_cooldown_until = [0.0] * key_count
+        self._next_key = 0  # 호출마다 시작 키를 돌려서 부하를 키 전체에 분산
+        self.latency_ewma = {}  # model_name -> 평균 응답 시간(초)
+        self.latency_alpha = latency_alpha
+        # shared=True: 한 워커가 받은 429/403 쿨다운을 coordination 컬렉션으로 다른 워커와 공유
+        self.shared = shared
+        self._shared_synced_at = 0.0
+
+    def record_success(self, model_name: str, key_index: int, latency: float):
+        if self.shared and self.key_cooldown_until[key_index] > 0:
+            self._publish({"$unset": {f"until.{key_index}": ""}})
+        self.key_cooldown_until[key_index] = 0.0
+        prev = self.latency_ewma.get(model_name)
+        self.latency_ewma[model_name] = latency if prev is None else prev * (1 - self.latency_alpha) + latency * self.latency_alpha
+
+    def record_quota_error(self, key_index: int):
+        self.key_cooldown_until[key_index] = time.monotonic() + KEY_COOLDOWN_SEC
+        if self.shared:
+            self._publish({"$max": {f"until.{key_index}": datetime.utcnow() + timedelta(seconds=KEY_COOLDOWN_SEC)}})
+
+    def _publish(self, update: dict):
+        # 공유 실패는 로컬 쿨다운만으로 계속 진행 (Gemini 호출 경로를 막지 않음)
+        try:
+            coordination_collection.update_one({"_id": "key_cooldowns"}, update, upsert=True)
+        except pymongo.errors.PyMongoError as e:
+            print(f"WARNING: failed to share key cooldown: {e}")
+
+    def _sync_shared_cooldowns(self):
+        """다른 워커가 기록한 쿨다운을 최대 SHARED_STATE_REFRESH_SEC 간격으로 반영"""
+        if not self.shared or time.monotonic() - self._shared_synced_at < SHARED_STATE_REFRESH_SEC:
+            return
+        self._shared_synced_at = time.monotonic()
+        try:
+            doc = coordination_collection.find_one({"_id": "key_cooldowns"}) or {}
+        except pymongo.errors.PyMongoError as e:
+            print(f"WARNING: shared key cooldowns unavailable: {e}")
+            return
+        now_utc, now = datetime.utcnow(), time.monotonic()
+        for key, until in (doc.get("until") or {}).items():
+            index = int(key)
+            if index < len(self.key_cooldown_until) and until > now_utc:
+                self.key_cooldown_until[index] = max(self.key_cooldown_until[index], now + (until - now_utc).total_seconds())
+
+    def healthy_key_ratio(self) -> float:
+        self._sync_shared_cooldowns()
+        now = time.monotonic()
+        healthy = sum(1 for until in self.key_cooldown_until if until <= now)
+        return healthy / len(self.key_cooldown_until)
+
+    def key_order(self) -> List[int]:
+        """건강한 키를 먼저(라운드 로빈 순서로) 시도하고, 쿨다운 중인 키는 마지막에 시도합니다."""
+        self._sync_shared_cooldowns()
+        now = time.monotonic()
+        key_count = len(self.key_cooldown_until)
+        start = self._next_key % key_count
+        self._next_key += 1
+        rotated = [(start + offset) % key_count for offset in range(key_count)]
+        return sorted(rotated, key=lambda i: self.key_cooldown_until[i] > now)
+
+    def choose_analysis_model(self, text_length: int, image_count: int) -> str:
+        # 1. 쿼터 압박: 절반 이상의 키가 쿨다운 중이면 가벼운 모델로
+        if self.healthy_key_ratio() < 0.5:
+            return ANALYSIS_MODEL_LIGHT
+        # 2. 짧은 텍스트 일기는 가벼운 모델로도 충분
+        if image_count == 0 and text_length < SHORT_DIARY_CHARS:
+            return ANALYSIS_MODEL_LIGHT
+        # 3. 무거운 모델이 느려진 상태면 텍스트 일기는 강등 (이미지 일기는 품질 우선)
+        heavy_latency = self.latency_ewma.get(ANALYSIS_MODEL_HEAVY)
+        if image_count == 0 and heavy_latency is not None and heavy_latency > ANALYSIS_LATENCY_BUDGET_SEC:
+            return ANALYSIS_MODEL_LIGHT
+        return ANALYSIS_MODEL_HEAVY
+
+model_router = ModelRouter(len(API_KEYS), shared=SHARED_STATE)
+
+# --- [Helper] AI 백엔드 (실제 Gemini / 녹화 / 재생 시뮬레이터) ---
+# call_gemini_with_fallback과 OCR은 키 순회·재시도·강등만 담당하고, 실제 호출은 ai_backend에 맡깁니다.
+# 재생 백엔드는 녹화된 응답을 실제와 비슷한 지연 시간으로 돌려주고, 스크립트대로 키별 429/403을 냅니다.
+# google.generativeai 는 import 에만 ~0.9초가 걸리므로 모듈 로드 시가 아니라 처음 쓸 때 불러옵니다.
+# (서버에서는 lifespan 워밍업이 미리 불러 두므로 첫 분석 요청이 이 비용을 내지 않음)
+_genai_module = None
+_genai_lock = threading.Lock()
+_safety_settings = None
+
+def load_genai():
+    global _genai_module
+    if _genai_module is None:
+        with _genai_lock:
+            if _genai_module is None:
+                import google.generativeai
+                _genai_module = google.generativeai
+    return _genai_module
+
+def gemini_safety_settings() -> dict:
+    """안전 필터 해제 (가장 낮은 수준으로 설정)"""
+    global _safety_settings
+    if _safety_settings is None:
+        from google.generativeai.types import HarmCategory, HarmBlockThreshold
+        _safety_settings = {
+            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+        }
+    return _safety_settings
+
+def ai_request_fingerprint(model_name: str, generation_config: dict, prompt_parts) -> str:
+    """모델 + 응답 형식 + 프롬프트(이미지는 해시)로 만든 요청 지문"""
+    def canonical(part):
+        if isinstance(part, str):
+            return part
+        if isinstance(part, dict):
+            data = part.get("data", b"")
+            data = data.encode() if isinstance(data, str) else data
+            return {"mime_type": part.get("mime_type"), "sha256": hashlib.sha256(data).hexdigest()}
+        return type(part).__name__
+    parts = prompt_parts if isinstance(prompt_parts, list) else [prompt_parts]
+    schema = generation_config.get("response_schema")
+    key = {
+        "model": model_name,
+        "mime": generation_config.get("response_mime_type"),
+        "schema": getattr(schema, "__name__", None),
+        "parts": [canonical(p) for p in parts],
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+def file_fingerprint(model_name: str, prompt: str, file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return hashlib.sha256(json.dumps({"model": model_name, "prompt": prompt, "file": digest}).encode()).hexdigest()
+
+class GeminiBackend:
+    """
+    실제 Gemini 호출.
+    genai.configure()는 프로세스 전역 클라이언트를 바꾸고 그때마다 연결을 새로 만들기 때문에,
+    키마다 전용 클라이언트를 한 번 만들어 재사용합니다 (동시 호출 간 키 섞임 없음, 연결 재사용).
+    SDK 내부 API(_ClientManager, GenerativeModel._client / _async_client)를 쓰므로 requirements.txt 에 버전을 고정하고,
+    시작 시 check_sdk() 로 확인합니다.
+    """
+    name = "gemini"
+
+    def __init__(self):
+        self._clients = {}  # (key_index, 종류) -> SDK 클라이언트
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def check_sdk():
+        """SDK 업데이트로 내부 API가 바뀌면 첫 호출이 아니라 시작 단계(/ready)에서 실패하도록"""
+        genai = load_genai()
+        from google.generativeai import client as genai_client
+        manager_cls = getattr(genai_client, "_ClientManager", None)
+        missing = [] if manager_cls else ["client._ClientManager"]
+        missing += [f"_ClientManager.{a}" for a in ("configure", "get_default_client") if manager_cls and not hasattr(manager_cls, a)]
+        model = genai.GenerativeModel("gemini-sdk-check")
+        missing += [f"GenerativeModel.{a}" for a in ("_client", "_async_client") if not hasattr(model, a)]
+        if missing:
+            version = getattr(genai, "__version__", "?")
+            raise RuntimeError(f"google-generativeai {version} is missing {', '.join(missing)} (pinned version expected)")
+
+    def _client(self, key_index: int, kind: str):
+        # kind: "generative" / "generative_async" / "file". 비동기 클라이언트는 이벤트 루프 안에서 처음 만들어야 함
+        with self._lock:
+            client = self._clients.get((key_index, kind))
+            if client is None:
+                load_genai()
+                from google.generativeai import client as genai_client
+                manager = genai_client._ClientManager()  # SDK가 전역으로 하나 두는 관리자를 키마다 따로 생성
+                manager.configure(api_key=API_KEYS[key_index])
+                client = manager.get_default_client(kind)
+                self._clients[(key_index, kind)] = client
+        return client
+
+    async def generate(self, key_index: int, model_name: str, prompt_parts, generation_config: dict, safety_settings):
+        model = load_genai().GenerativeModel(model_name, generation_config=generation_config)
+        model._async_client = self._client(key_index, "generative_async")
+        return await model.generate_content_async(prompt_parts, safety_settings=safety_settings)
+
+    async def generate_with_file(self, key_index: int, model_name: str, prompt: str, file_path: str, generation_config: dict):
+        # 업로드 / 생성 / 삭제 모두 동기 호출이므로 이벤트 루프를 막지 않게 스레드에서 실행
+        return await asyncio.to_thread(self._generate_with_file, key_index, model_name, prompt, file_path, generation_config)
+
+    def _generate_with_file(self, key_index: int, model_name: str, prompt: str, file_path: str, generation_config: dict):
+        genai = load_genai()
+        model = genai.GenerativeModel(model_name, generation_config=generation_config)
+        model._client = self._client(key_index, "generative")
+        file_client = self._client(key_index, "file")
+        # 파일은 해당 키의 공간에 업로드되므로 키를 바꿀 때마다 다시 업로드
+        print(f"INFO: Uploading image to Gemini with Key {key_index+1}...")
+        uploaded_file = genai.types.File(file_client.create_file(
+            path=file_path, mime_type=mimetypes.guess_type(file_path)[0], display_name=os.path.basename(file_path)
+        ))
+        try:
+            return model.generate_content([prompt, uploaded_file])
+        finally:
+            # Gemini 서버 용량 관리를 위해 업로드한 파일 삭제
             try:
-                if response.text: 
-                    return response
-            except ValueError:
-                print(f"⚠️ WARNING: Response blocked by Safety Filters (Key {i+1})")
-                continue # 다음 키로 시도하거나 넘어감
-            
+                file_client.delete_file(name=uploaded_file.name)
+                print(f"INFO: Deleted remote file for Key {key_index+1}")
+            except Exception:
+                pass
+
+class RecordedResponse:
+    """녹화된 응답. 안전 필터로 막혔던 응답은 실제처럼 .text 접근 시 ValueError"""
+    def __init__(self, text: Optional[str], blocked: bool = False):
+        self._text = text
+        self.blocked = blocked
+
+    @property
+    def text(self):
+        if self.blocked:
+            raise ValueError("Response blocked (replayed)")
+        return self._text
+
+class RecordingBackend:
+    """실제 백엔드를 감싸서 요청 지문, 지연 시간, 응답(또는 오류)을 JSONL로 남깁니다."""
+    name = "record"
+
+    def __init__(self, inner, path: str):
+        self.inner = inner
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _write(self, entry: dict):
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    async def _record(self, fingerprint: str, model_name: str, key_index: int, mime: str, call):
+        started = time.monotonic()
+        entry = {"fingerprint": fingerprint, "model": model_name, "key": key_index + 1, "mime": mime, "recorded_at": datetime.utcnow().isoformat()}
+        try:
+            response = await call()
         except Exception as e:
-            error_msg = str(e)
-            print(f"⚠️ WARNING: API Key {i+1} failed: {error_msg}")
-            
-            if "429" in error_msg or "ResourceExhausted" in error_msg or "403" in error_msg:
-                print(f"🔄 Switching to next API Key...")
+            self._write({**entry, "status": "error", "error": str(e)[:500], "latency": round(time.monotonic() - started, 4)})
+            raise
+        try:
+            entry.update(status="ok", text=response.text)
+        except ValueError:
+            entry.update(status="blocked", text=None)
+        self._write({**entry, "latency": round(time.monotonic() - started, 4)})
+        return response
+
+    async def generate(self, key_index, model_name, prompt_parts, generation_config, safety_settings):
+        fingerprint = ai_request_fingerprint(model_name, generation_config, prompt_parts)
+        return await self._record(
+            fingerprint, model_name, key_index, generation_config.get("response_mime_type"),
+            lambda: self.inner.generate(key_index, model_name, prompt_parts, generation_config, safety_settings)
+        )
+
+    async def generate_with_file(self, key_index, model_name, prompt, file_path, generation_config):
+        fingerprint = file_fingerprint(model_name, prompt, file_path)
+        return await self._record(
+            fingerprint, model_name, key_index, generation_config.get("response_mime_type"),
+            lambda: self.inner.generate_with_file(key_index, model_name, prompt, file_path, generation_config)
+        )
+
+class ReplayBackend:
+    """
+    녹화 파일을 재생하는 오프라인 시뮬레이터.
+    - 지문이 일치하면 그 응답을 녹화 당시 지연 시간(x AI_REPLAY_LATENCY_SCALE)으로 반환
+    - 일치하는 게 없으면 (nearest) 같은 모델·응답 형식의 기록을 돌려가며 쓰고, 지연은 그 모델의 실측 분포에서 추출
+    - 실패 스크립트: {"seed": 7, "error_rate": 0.0, "failures": [{"key": 1, "error": "429", "from_call": 1, "to_call": 3}]}
+      key와 호출 번호는 1부터 (키별로 셈), from/to를 생략하면 항상 실패
+    """
+    name = "replay"
+
+    def __init__(self, path: str, script_path: str = "", miss_policy: str = "nearest", latency_scale: float = 1.0):
+        self.by_fingerprint = {}
+        self.by_kind = defaultdict(list)     # (model, mime) -> [entry]
+        self.latencies = defaultdict(list)   # model -> [초]
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self.latencies[entry["model"]].append(entry.get("latency", 0.0))
+                if entry.get("status") in ("ok", "blocked"):
+                    self.by_fingerprint.setdefault(entry["fingerprint"], entry)
+                    self.by_kind[(entry["model"], entry.get("mime"))].append(entry)
+
+        script = {}
+        if script_path:
+            with open(script_path, encoding="utf-8") as f:
+                script = json.load(f)
+        self.failures = script.get("failures", [])
+        self.error_rate = script.get("error_rate", 0.0)
+        self.rng = random.Random(script.get("seed", 7))
+        self.miss_policy = miss_policy
+        self.latency_scale = latency_scale
+        self.calls_per_key = Counter()
+        self._next_by_kind = Counter()
+        print(f"INFO: AI replay backend loaded {len(self.by_fingerprint)} recordings from {path}")
+
+    def _scripted_error(self, key_index: int) -> Optional[str]:
+        call_no = self.calls_per_key[key_index + 1]
+        for rule in self.failures:
+            if rule.get("key") not in (None, key_index + 1):
                 continue
+            if rule.get("from_call", 1) <= call_no <= rule.get("to_call", float("inf")):
+                return str(rule.get("error", "429"))
+        if self.error_rate and self.rng.random() < self.error_rate:
+            return "429"
+        return None
+
+    def _lookup(self, fingerprint: str, model_name: str, mime: str) -> dict:
+        entry = self.by_fingerprint.get(fingerprint)
+        if entry:
+            return entry
+        candidates = self.by_kind.get((model_name, mime)) or []
+        if self.miss_policy != "nearest" or not candidates:
+            raise Exception(f"No recording for {model_name} request {fingerprint[:12]}")
+        entry = candidates[self._next_by_kind[(model_name, mime)] % len(candidates)]
+        self._next_by_kind[(model_name, mime)] += 1
+        latencies = self.latencies.get(model_name) or [entry.get("latency", 0.0)]
+        return {**entry, "latency": self.rng.choice(latencies)}
+
+    async def _replay(self, key_index: int, fingerprint: str, model_name: str, mime: str):
+        self.calls_per_key[key_index + 1] += 1
+        error = self._scripted_error(key_index)
+        if error:
+            # 쿼터 오류는 보통 빠르게 돌아옴
+            await asyncio.sleep(0.05 * self.latency_scale)
+            raise Exception(f"{error} Simulated failure for Key {key_index+1} (Resource has been exhausted)" if error == "429" else f"{error} Simulated permission denied for Key {key_index+1}")
+        entry = self._lookup(fingerprint, model_name, mime)
+        await asyncio.sleep(entry.get("latency", 0.0) * self.latency_scale)
+        return RecordedResponse(entry.get("text"), blocked=entry.get("status") == "blocked")
+
+    async def generate(self, key_index, model_name, prompt_parts, generation_config, safety_settings):
+        fingerprint = ai_request_fingerprint(model_name, generation_config, prompt_parts)
+        return await self._replay(key_index, fingerprint, model_name, generation_config.get("response_mime_type"))
+
+    async def generate_with_file(self, key_index, model_name, prompt, file_path, generation_config):
+        fingerprint = file_fingerprint(model_name, prompt, file_path)
+        return await self._replay(key_index, fingerprint, model_name, generation_config.get("response_mime_type"))
+
+def build_ai_backend():
+    if AI_BACKEND == "replay":
+        return ReplayBackend(AI_RECORDINGS_PATH, AI_REPLAY_SCRIPT, AI_REPLAY_MISS, AI_REPLAY_LATENCY_SCALE)
+    if AI_BACKEND == "record":
+        print(f"INFO: Recording Gemini traffic to {AI_RECORDINGS_PATH}")
+        return RecordingBackend(GeminiBackend(), AI_RECORDINGS_PATH)
+    return GeminiBackend()
+
+ai_backend = build_ai_backend()
+
+# --- [Helper] Gemini 호출 Fallback 함수 ---
+def record_gemini_failure(model_name: str, key_index: int, error: Exception) -> bool:
+    """실패한 호출을 지표에 남기고, 쿼터 에러면 그 키를 쿨다운. 쿼터 에러였으면 True"""
+    error_msg = str(error)
+    is_quota_error = "429" in error_msg or "ResourceExhausted" in error_msg or "403" in error_msg
+    GEMINI_CALL_ERRORS.labels(model_name, f"key{key_index+1}", "quota" if is_quota_error else "error").inc()
+    if is_quota_error:
+        model_router.record_quota_error(key_index)
+    return is_quota_error
+
+async def call_gemini_with_fallback(prompt_parts, response_type="application/json", model_name="gemini-3-flash-preview", response_schema=None, fallback_model=None, meta=None):
+    """
+    API 키를 순회하며 Gemini 호출.
+    Args:
+        model_name: 기본값은 'gemini-3-flash-preview'. 
+                    챗봇 등에서 'gemini-2.0-flash-lite-preview' 등을 지정해서 사용 가능.
+        response_schema: (선택) Pydantic 모델. 지정하면 Gemini가 해당 스키마에 맞춰 JSON을 생성합니다.
+        fallback_model: (선택) 모든 키가 쿼터 초과로 실패하면 이 모델로 한 번 더 시도합니다.
+        meta: (선택) dict를 넘기면 실제로 응답한 모델 이름을 meta["model"]에 기록합니다.
+    """
+
+    safety_settings = gemini_safety_settings()
+
+    # 전역 동시 호출 제한 (대기열이 가득 차면 503)
+    admission_started = time.perf_counter()
+    async with gemini_admission:
+        add_profile_span("ai", time.perf_counter() - admission_started)
+        models_to_try = [model_name] + ([fallback_model] if fallback_model and fallback_model != model_name else [])
+        for attempt_model in models_to_try:
+            quota_failures = 0
+            for i in model_router.key_order():
+                try:
+                    # [수정됨] 전달받은 model_name 사용
+                    generation_config = {"response_mime_type": response_type}
+                    if response_schema is not None:
+                        generation_config["response_schema"] = response_schema
+
+                    print(f"INFO: Trying {attempt_model} with Key {i+1}...") 
+                    # 비동기 호출: 응답을 기다리는 동안 다른 요청이 이벤트 루프를 쓸 수 있음
+                    started = time.monotonic()
+                    response = await ai_backend.generate(i, attempt_model, prompt_parts, generation_config, safety_settings)
+                    latency = time.monotonic() - started
+                    add_profile_span("ai", latency)
+                    model_router.record_success(attempt_model, i, latency)
+                    GEMINI_CALL_SECONDS.labels(attempt_model, f"key{i+1}").observe(latency)
             
-            continue
+                    # 3. 응답 확인
+                    try:
+                        if response.text: 
+                            if meta is not None:
+                                meta["model"] = attempt_model
+                            return response
+                    except ValueError:
+                        GEMINI_CALL_ERRORS.labels(attempt_model, f"key{i+1}", "blocked").inc()
+                        print(f"⚠️ WARNING: Response blocked by Safety Filters (Key {i+1})")
+                        continue # 다음 키로 시도하거나 넘어감
             
-    print("❌ CRITICAL: All API keys exhausted or Content Blocked.")
-    return None
+                except Exception as e:
+                    print(f"⚠️ WARNING: API Key {i+1} failed: {e}")
+                    if record_gemini_failure(attempt_model, i, e):
+                        quota_failures += 1
+                        print(f"🔄 Switching to next API Key...")
+                    continue
+
+            # 쿼터 문제로 전부 실패한 경우에만 가벼운 모델로 강등 (안전 필터 차단 등은 강등해도 소용없음)
+            if quota_failures < len(API_KEYS):
+                break
+            if attempt_model != models_to_try[-1]:
+                print(f"🔻 All keys hit quota on {attempt_model}. Degrading to {models_to_try[-1]}...")
+            
+        print("❌ CRITICAL: All API keys exhausted or Content Blocked.")
+        return None
 
 # --- [Helper] 이미지 OCR Fallback 함수 ---
 async def extract_text_from_image_with_fallback(image_path: str):
@@ -214,46 +1248,37 @@ async def extract_text_from_image_with_fallback(image_path: str):
     system_instruction = "You are a helpful assistant that transcribes handwritten notes into text. Output ONLY the transcribed text."
     prompt = system_instruction
 
-    for i, api_key in enumerate(API_KEYS):
-        uploaded_file = None
-        try:
-            # 1. 키 설정
-            genai.configure(api_key=api_key)
-            
-            # 2. 모델 재설정 (키 변경 반영을 위해)
-            local_model = genai.GenerativeModel(
-                'gemini-3-flash-preview',
-                generation_config={"response_mime_type": "text/plain"} # 텍스트만 받음
-            )
-
-            # 3. 파일 업로드 (해당 키의 공간에 업로드됨)
-            print(f"INFO: Uploading image to Gemini with Key {i+1}...")
-            uploaded_file = genai.upload_file(path=image_path)
+    ocr_model = "gemini-3-flash-preview"
+    # 업로드 시간이 포함되므로 지연 시간은 별도 이름으로 기록 (분석 모델 선택용 지연 평균이 흔들리지 않게)
+    ocr_label = f"{ocr_model}/ocr"
 
-            # 4. 분석 요청
-            response = local_model.generate_content([prompt, uploaded_file])
-            return response.text
-
-        except Exception as e:
-            error_msg = str(e)
-            print(f"⚠️ WARNING: OCR failed with Key {i+1}: {error_msg}")
-            
-            # 리소스 부족 에러면 다음 키로 시도, 아니면 에러
-            if "429" in error_msg or "ResourceExhausted" in error_msg or "403" in error_msg:
+    # 전역 동시 호출 제한 (대기열이 가득 차면 503)
+    async with gemini_admission:
+        # 일반 호출과 같은 키 순서 / 쿨다운 / 지표 사용
+        for i in model_router.key_order():
+            try:
+                # 키마다 업로드부터 다시 (파일은 해당 키의 공간에 업로드됨), 텍스트만 받음
+                started = time.monotonic()
+                response = await ai_backend.generate_with_file(
+                    i, ocr_model, prompt, image_path, {"response_mime_type": "text/plain"}
+                )
+                latency = time.monotonic() - started
+                add_profile_span("ai", latency)
+                model_router.record_success(ocr_label, i, latency)
+                GEMINI_CALL_SECONDS.labels(ocr_label, f"key{i+1}").observe(latency)
+            except Exception as e:
+                # 쿼터 에러면 키를 쿨다운하고 다음 키로, 파일 포맷 문제 등도 로그 찍고 다음 키 시도
+                print(f"⚠️ WARNING: OCR failed with Key {i+1}: {e}")
+                record_gemini_failure(ocr_label, i, e)
                 continue
-            else:
-                # 파일 포맷 문제 등일 수 있으므로 로그 찍고 다음 키 시도 (혹은 중단)
-                continue 
-        
-        finally:
-            # 5. Gemini 서버 용량 관리를 위해 업로드한 파일 삭제
-            if uploaded_file:
-                try: 
-                    uploaded_file.delete()
-                    print(f"INFO: Deleted remote file for Key {i+1}")
-                except: pass
 
-    return None
+            try:
+                return response.text
+            except ValueError:
+                GEMINI_CALL_ERRORS.labels(ocr_label, f"key{i+1}", "blocked").inc()
+                print(f"⚠️ WARNING: OCR response blocked by Safety Filters (Key {i+1})")
+
+        return None
 
 
 # --- [DTO] 데이터 모델 ---
@@ -308,51 +1333,305 @@ class TagDeleteRequest(BaseModel):
     #user_id: str
     tag_name: str
 
+# 5-1. 태그 이름 변경 / 병합 요청
+class TagRenameRequest(BaseModel):
+    old_name: str
+    new_name: str
+
+class TagMergeRequest(BaseModel):
+    sources: List[str]
+    target: str
+
 # --- 미니 챗봇 요청 모델 (수정됨) ---
 class DiaryChatRequest(BaseModel):
     #user_id: str
-    diary_ids: List[str] # [변경] 일기 ID를 리스트로 받음 (최대 3개)
+    diary_ids: List[str] = [] # [변경] 일기 ID를 리스트로 받음 (최대 3개)
     user_message: str
     chat_history: List[Dict[str, str]] = [] # [{"role": "user", "text": "..."}, ...]
+    auto_context: bool = False # True면 질문과 비슷한 일기로 남은 자리(최대 3개)를 자동으로 채움
+
+# --- [Schema] Gemini 일기 분석 응답 스키마 ---
+# Gemini에 response_schema로 전달되며, 응답 검증에도 그대로 사용합니다.
+# (Gemini 스키마는 기본값을 지원하지 않으므로 모든 필드는 필수로 둡니다)
+class AnalysisThemes(BaseModel):
+    theme1: str
+    theme2_title: str
+    theme2: str
+    theme3: str
+    theme4: str
+    theme5: str
+
+class RecommendMethod(BaseModel):
+    main: str
+    content: str
+    effect: str
+
+class AnalysisRecommend(BaseModel):
+    head: str
+    method1: RecommendMethod
+    method2: RecommendMethod
+    method3: RecommendMethod
+
+class Big5Openness(BaseModel):
+    imagination: int
+    artistic: int
+    emotionality: int
+    adventurousness: int
+    intellect: int
+    liberalism: int
+
+class Big5Conscientiousness(BaseModel):
+    self_efficacy: int
+    orderliness: int
+    dutifulness: int
+    achievement_striving: int
+    self_discipline: int
+    cautiousness: int
+
+class Big5Extraversion(BaseModel):
+    friendliness: int
+    gregariousness: int
+    assertiveness: int
+    activity_level: int
+    excitement_seeking: int
+    cheerfulness: int
+
+class Big5Agreeableness(BaseModel):
+    trust: int
+    morality: int
+    altruism: int
+    cooperation: int
+    modesty: int
+    sympathy: int
+
+class Big5Neuroticism(BaseModel):
+    anxiety: int
+    anger: int
+    depression: int
+    self_consciousness: int
+    immoderation: int
+    vulnerability: int
+
+class Big5Scores(BaseModel):
+    openness: Big5Openness
+    conscientiousness: Big5Conscientiousness
+    extraversion: Big5Extraversion
+    agreeableness: Big5Agreeableness
+    neuroticism: Big5Neuroticism
+
+class DiaryAnalysisResult(BaseModel):
+    event_summary: str
+    analysis: AnalysisThemes
+    recommend: AnalysisRecommend
+    one_liner: str
+    keywords: List[str]
+    big5: Big5Scores
+
+# --- [Helper] Big5 벡터 표현 ---
+# 30개 세부 특성을 고정 순서의 float 벡터로 다룹니다. (API 응답은 기존 중첩 dict 형태 유지)
+BIG5_FACETS = {
+    "openness": ["imagination", "artistic", "emotionality", "adventurousness", "intellect", "liberalism"],
+    "conscientiousness": ["self_efficacy", "orderliness", "dutifulness", "achievement_striving", "self_discipline", "cautiousness"],
+    "extraversion": ["friendliness", "gregariousness", "assertiveness", "activity_level", "excitement_seeking", "cheerfulness"],
+    "agreeableness": ["trust", "morality", "altruism", "cooperation", "modesty", "sympathy"],
+    "neuroticism": ["anxiety", "anger", "depression", "self_consciousness", "immoderation", "vulnerability"]
+}
+BIG5_VECTOR_KEYS = [(factor, facet) for factor, facets in BIG5_FACETS.items() for facet in facets]
+BIG5_DEFAULT_SCORE = 5.0
 
 # --- [Helper] Big5 초기값 ---
 def get_default_big5():
     default_score = 5
-    return {
-        "openness": { "imagination": default_score, "artistic": default_score, "emotionality": default_score, "adventurousness": default_score, "intellect": default_score, "liberalism": default_score },
-        "conscientiousness": { "self_efficacy": default_score, "orderliness": default_score, "dutifulness": default_score, "achievement_striving": default_score, "self_discipline": default_score, "cautiousness": default_score },
-        "extraversion": { "friendliness": default_score, "gregariousness": default_score, "assertiveness": default_score, "activity_level": default_score, "excitement_seeking": default_score, "cheerfulness": default_score },
-        "agreeableness": { "trust": default_score, "morality": default_score, "altruism": default_score, "cooperation": default_score, "modesty": default_score, "sympathy": default_score },
-        "neuroticism": { "anxiety": default_score, "anger": default_score, "depression": default_score, "self_consciousness": default_score, "immoderation": default_score, "vulnerability": default_score }
-    }
+    return {factor: {facet: default_score for facet in facets} for factor, facets in BIG5_FACETS.items()}
+
+def big5_to_vector(scores) -> np.ndarray:
+    """중첩 dict -> 길이 30 벡터. 없거나 숫자가 아닌 값은 NaN."""
+    scores = scores or {}
+    vec = np.full(len(BIG5_VECTOR_KEYS), np.nan)
+    for i, (factor, facet) in enumerate(BIG5_VECTOR_KEYS):
+        try: vec[i] = float((scores.get(factor) or {})[facet])
+        except (KeyError, TypeError, ValueError): pass
+    return vec
+
+def vector_to_big5(vec) -> dict:
+    """길이 30 벡터 -> 중첩 dict (소수점 2자리)."""
+    result = {factor: {} for factor in BIG5_FACETS}
+    for (factor, facet), value in zip(BIG5_VECTOR_KEYS, vec):
+        result[factor][facet] = round(float(value), 2)
+    return result
 
 # --- [Helper] Big5 업데이트 ---
 def update_big5_scores(old_scores, new_scores, alpha=0.2):
-    old_scores = old_scores or {}
-    new_scores = new_scores or {}
-    factors = ["openness", "conscientiousness", "extraversion", "agreeableness", "neuroticism"]
-    facets_list = {
-        "openness": ["imagination", "artistic", "emotionality", "adventurousness", "intellect", "liberalism"],
-        "conscientiousness": ["self_efficacy", "orderliness", "dutifulness", "achievement_striving", "self_discipline", "cautiousness"],
-        "extraversion": ["friendliness", "gregariousness", "assertiveness", "activity_level", "excitement_seeking", "cheerfulness"],
-        "agreeableness": ["trust", "morality", "altruism", "cooperation", "modesty", "sympathy"],
-        "neuroticism": ["anxiety", "anger", "depression", "self_consciousness", "immoderation", "vulnerability"]
-    }
-    updated = {}
-    for factor in factors:
-        updated[factor] = {}
-        factor_old = old_scores.get(factor) or {}
-        factor_new = new_scores.get(factor) or {}
-        for facet in facets_list[factor]:
-            try: old_val = float(factor_old.get(facet, 5.0))
-            except: old_val = 5.0
-            try: new_val = float(factor_new.get(facet, old_val))
-            except: new_val = old_val
-            updated[factor][facet] = round((old_val * (1 - alpha)) + (new_val * alpha), 2)
-    return updated
+    old_vec = big5_to_vector(old_scores)
+    old_vec = np.where(np.isnan(old_vec), BIG5_DEFAULT_SCORE, old_vec)
+    new_vec = big5_to_vector(new_scores)
+    # 새 점수가 없는 세부 특성은 그대로 유지
+    new_vec = np.where(np.isnan(new_vec), old_vec, new_vec)
+    return vector_to_big5(old_vec * (1 - alpha) + new_vec * alpha)
+
+def ewma_big5_from_snapshots(snapshot_matrix: np.ndarray, alpha=0.2) -> np.ndarray:
+    """
+    (일기 수 x 30) 스냅샷 행렬을 순서대로 EWMA 한 결과를 한 번에 계산합니다.
+    NaN(해당 일기에 점수 없음)은 그 단계를 건너뛴 것과 동일하게 처리됩니다.
+    결과 = 기본값 * (1-a)^m + sum(a * (1-a)^(이후 유효 개수) * x)
+    """
+    if snapshot_matrix.size == 0:
+        return np.full(len(BIG5_VECTOR_KEYS), BIG5_DEFAULT_SCORE)
+    valid = ~np.isnan(snapshot_matrix)
+    values = np.where(valid, snapshot_matrix, 0.0)
+    valid_count = valid.sum(axis=0)
+    # 각 행 이후에 유효한 점수가 몇 개 더 나오는지 (역방향 누적합)
+    later_valid = np.flip(np.cumsum(np.flip(valid, axis=0), axis=0), axis=0) - valid
+    weights = np.where(valid, alpha * (1 - alpha) ** later_valid, 0.0)
+    return BIG5_DEFAULT_SCORE * (1 - alpha) ** valid_count + (weights * values).sum(axis=0)
+
+def recompute_big5_profile(user_id: str) -> dict:
+    """
+    유저의 모든 big5_snapshot으로 프로필 Big5를 처음부터 다시 계산해 저장합니다.
+    (일기 삭제/수정 후 누적 EWMA에 남은 흔적을 제거하기 위함)
+    """
+    cursor = diary_collection.find(
+        {"user_id": user_id, "is_temporary": False, "big5_snapshot": {"$exists": True}},
+        {"big5_snapshot": 1, "_id": 0}
+    ).sort([("created_at", 1), ("_id", 1)])
+    snapshots = [big5_to_vector(doc.get("big5_snapshot")) for doc in cursor]
+    matrix = np.vstack(snapshots) if snapshots else np.empty((0, len(BIG5_VECTOR_KEYS)))
+
+    big5_scores = vector_to_big5(ewma_big5_from_snapshots(matrix))
+    user_collection.update_one(
+        {"user_id": user_id},
+        {"$set": {"big5_scores": big5_scores, "big5_recomputed_at": datetime.utcnow()}}
+    )
+    return big5_scores
+
+def recompute_big5_profile_bg(user_id: str):
+    try:
+        recompute_big5_profile(user_id)
+        user_stats_cache.invalidate(user_id)
+        print(f"INFO: [Background] Big5 profile recomputed for {user_id}")
+    except Exception as e:
+        print(f"ERROR: [Background] Failed to recompute Big5: {e}")
+
+# --- [Helper] 분석 응답 JSON 복구 & 검증 ---
+# 필수 필드와 검증용 스키마 매핑 (keywords는 문자열 리스트만 확인)
+REQUIRED_ANALYSIS_FIELDS = {
+    "analysis": AnalysisThemes,
+    "recommend": AnalysisRecommend,
+    "keywords": None,
+    "big5": Big5Scores,
+}
+
+def _close_json_fragment(fragment: str) -> str:
+    """잘린 JSON 조각의 열린 문자열/괄호를 순서대로 닫아줍니다."""
+    stack = []
+    in_string = False
+    escaped = False
+    for ch in fragment:
+        if in_string:
+            if escaped: escaped = False
+            elif ch == "\\": escaped = True
+            elif ch == '"': in_string = False
+            continue
+        if ch == '"': in_string = True
+        elif ch == "{": stack.append("}")
+        elif ch == "[": stack.append("]")
+        elif ch in "}]" and stack: stack.pop()
+    return fragment + ('"' if in_string else "") + "".join(reversed(stack))
+
+def repair_json_text(raw_text: str, max_cuts: int = 64):
+    """
+    코드펜스로 감싸졌거나 중간에 잘린 JSON 응답을 최대한 살려서 dict로 반환합니다.
+    복구가 불가능하면 None.
+    """
+    if not raw_text:
+        return None
+
+    text = re.sub(r"```(?:json)?", "", raw_text).strip()
+    start = text.find("{")
+    if start == -1:
+        return None
+    text = text[start:]
+
+    # 1. 그대로 파싱 (정상 응답)
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+
+    # 2. 뒤쪽 쓰레기 문자 / 끝의 쉼표 정리
+    end = text.rfind("}")
+    if end != -1:
+        try:
+            return json.loads(re.sub(r",\s*([}\]])", r"\1", text[:end + 1]))
+        except ValueError:
+            pass
+
+    # 3. 잘린 응답: 마지막 완결된 값까지 잘라가며 괄호를 닫아봅니다.
+    candidate = text
+    for _ in range(max_cuts):
+        trimmed = candidate.rstrip().rstrip(",:").rstrip()
+        try:
+            data = json.loads(re.sub(r",\s*([}\]])", r"\1", _close_json_fragment(trimmed)))
+            if isinstance(data, dict):
+                return data
+        except ValueError:
+            pass
+        cut = max(candidate.rfind(","), candidate.rfind("{", 0, len(candidate) - 1), candidate.rfind("[", 0, len(candidate) - 1))
+        if cut <= 0:
+            break
+        candidate = candidate[:cut] if candidate[cut] == "," else candidate[:cut + 1]
+    return None
+
+def _try_plain_json(raw_text: str):
+    """기존 방식(코드펜스 제거 후 json.loads) 그대로 파싱. 실패 시 None."""
+    try:
+        return json.loads(re.sub(r"```json|```", "", raw_text).strip())
+    except ValueError:
+        return None
+
+def find_missing_analysis_fields(data: dict) -> List[str]:
+    """필수 필드 중 없거나 스키마에 맞지 않는 필드 이름 목록을 반환합니다."""
+    missing = []
+    for field, schema in REQUIRED_ANALYSIS_FIELDS.items():
+        value = data.get(field)
+        if value is None:
+            missing.append(field)
+            continue
+        if schema is None:
+            if not isinstance(value, list) or not value or not all(isinstance(v, str) for v in value):
+                missing.append(field)
+            continue
+        try:
+            schema(**value)
+        except Exception:
+            missing.append(field)
+    return missing
+
+async def request_missing_analysis_fields(cleaned_text: str, missing_fields: List[str], partial: dict):
+    """
+    누락된 필드만 다시 요청합니다. (이미지 없이 텍스트만 보내므로 전체 재호출보다 훨씬 가볍습니다)
+    """
+    known_context = {k: partial[k] for k in ("event_summary", "one_liner") if partial.get(k)}
+    followup_prompt = (
+        "You previously analyzed the diary entry below, but some fields of your JSON answer were missing or malformed.\n"
+        f"Return ONLY a JSON object containing exactly these keys: {', '.join(missing_fields)}.\n"
+        "Follow the same structure as before: 'analysis' has theme1, theme2_title, theme2, theme3, theme4, theme5; "
+        "'recommend' has head and method1~3 (each with main, content, effect); 'keywords' is a list of 3 strings; "
+        "'big5' has the 5 OCEAN factors with their 6 facets scored 0-10 as integers.\n"
+        "All text values must be in English.\n\n"
+        f"Diary Entry: {cleaned_text}\n"
+        f"Already known: {json.dumps(known_context, ensure_ascii=False)}"
+    )
+
+    # 텍스트만 보내는 짧은 보충 요청이므로 가벼운 모델 사용
+    response = await call_gemini_with_fallback([followup_prompt], response_type="application/json", model_name=ANALYSIS_MODEL_LIGHT)
+    if not response:
+        return None
+    return repair_json_text(response.text)
 
 # --- [Gemini] 분석 함수 ---
 async def get_gemini_analysis(diary_text: str, user_traits: List[str], retries=2):
+    # 반환: (분석 결과, 실제 분석한 모델). 실패하면 (None, None). 모델 이름은 응답 본문에 섞지 않고 analysis_model 로만 저장
     # 1. [NEW] 이미지 데이터(Base64) 추출 로직
     # 일기 본문에서 <img src="data:image/..."> 패턴을 찾아냅니다.
     image_parts = []
@@ -372,6 +1651,10 @@ async def get_gemini_analysis(diary_text: str, user_traits: List[str], retries=2
         print(f"INFO: {len(image_parts)} image(s) detected in diary for Multimodal Analysis.")
     
     cleaned_text = re.sub(r'<[^>]+>', '', diary_text).strip()
+
+    # 일기 길이 / 이미지 수 / 키 상태 / 모델 지연 시간으로 모델 티어 선택
+    chosen_model = model_router.choose_analysis_model(len(cleaned_text), len(image_parts))
+    call_meta = {}
     
     # !!! 중요: 여기에 system_instruction 내용이 반드시 있어야 합니다 !!!
     system_instruction = """
@@ -473,20 +1756,154 @@ async def get_gemini_analysis(diary_text: str, user_traits: List[str], retries=2
 
     # [FIX] 단순 model.generate_content 대신 Fallback 함수 사용
     for attempt in range(retries + 1):
+        if attempt > 0:
+            ANALYSIS_PARSE_OUTCOMES.labels(outcome="full_retry").inc()
         try:
             # Fallback 함수 호출 (알아서 키 바꿔가며 시도함)
-            response = await call_gemini_with_fallback(prompt_parts, response_type="application/json")
-            
+            # response_schema를 넘겨 Gemini가 구조화된 JSON을 생성하도록 강제
+            response = await call_gemini_with_fallback(
+                prompt_parts,
+                response_type="application/json",
+                model_name=chosen_model,
+                response_schema=DiaryAnalysisResult,
+                fallback_model=ANALYSIS_MODEL_LIGHT,
+                meta=call_meta
+            )
+
             if response:
-                clean_json = re.sub(r"```json|```", "", response.text).strip()
-                data = json.loads(clean_json)
-                if all(k in data for k in ["analysis", "recommend", "keywords", "big5"]):
-                    return data
+                data = repair_json_text(response.text)
+                if not isinstance(data, dict):
+                    print(f"WARNING: Attempt {attempt} returned unparseable JSON.")
+                    ANALYSIS_PARSE_OUTCOMES.labels(outcome="unparseable").inc()
+                else:
+                    missing = find_missing_analysis_fields(data)
+                    if not missing:
+                        ANALYSIS_PARSE_OUTCOMES.labels(outcome="repaired" if data != _try_plain_json(response.text) else "clean").inc()
+                        return data, call_meta.get("model", chosen_model)
+
+                    # 빠진 필드만 골라서 보충 요청 (이미지 재전송 없음)
+                    print(f"INFO: Analysis missing fields {missing}. Requesting only those.")
+                    patch = await request_missing_analysis_fields(cleaned_text, missing, data)
+                    if isinstance(patch, dict):
+                        data.update({k: patch[k] for k in missing if k in patch})
+                        if not find_missing_analysis_fields(data):
+                            ANALYSIS_PARSE_OUTCOMES.labels(outcome="followup_recovered").inc()
+                            return data, call_meta.get("model", chosen_model)
+                    ANALYSIS_PARSE_OUTCOMES.labels(outcome="followup_failed").inc()
+        except HTTPException:
+            # Gemini 대기열 포화(503 + Retry-After): 재시도하지 않고 호출자에게 그대로 전달
+            raise
         except Exception as e:
             print(f"Attempt {attempt} failed: {e}")
-            if attempt < retries: time.sleep(1)
-            
-    return None
+        if attempt < retries: await asyncio.sleep(1)
+
+    ANALYSIS_PARSE_OUTCOMES.labels(outcome="failed").inc()
+    return None, None
+
+# --- [Helper] 로컬 휴리스틱 분석 (모든 Gemini 키가 소진됐을 때의 임시 분석) ---
+# 감성 사전 + 유저 기존 특성 매칭만으로 수 ms 안에 분석 형태의 결과를 만듭니다.
+# 일기는 analysis_source="local" 로 저장되고 지연 분석 큐에 올라가서, 쿼터가 회복되면 Gemini 분석으로 교체됩니다.
+LOCAL_POSITIVE_WORDS = {
+    "happy", "glad", "joy", "fun", "love", "loved", "great", "good", "nice", "calm", "relaxed", "proud", "grateful",
+    "thankful", "excited", "peaceful", "hope", "hopeful", "enjoyed", "laughed", "smile", "smiled", "better", "rested",
+    "satisfied", "accomplished", "comfortable", "warm", "kind", "beautiful", "success", "finished",
+    "행복", "기쁨", "좋았다", "즐거웠다", "감사", "뿌듯", "편안", "설렘", "웃었다", "다행",
+}
+LOCAL_NEGATIVE_WORDS = {
+    "sad", "tired", "angry", "upset", "anxious", "worried", "worry", "stress", "stressed", "lonely", "afraid", "scared",
+    "depressed", "bad", "hate", "cried", "cry", "hurt", "exhausted", "frustrated", "annoyed", "fail", "failed", "sick",
+    "pain", "regret", "nervous", "overwhelmed", "miserable", "awful", "terrible", "guilty", "ashamed",
+    "슬픔", "슬펐다", "우울", "불안", "피곤", "화가", "짜증", "외로", "걱정", "스트레스", "힘들었다", "후회",
+}
+LOCAL_ANALYSIS_MODEL = "local-heuristic"  # 임시 분석으로 저장된 일기의 analysis_model
+LOCAL_NEGATIONS = {"not", "no", "never", "don't", "didn't", "isn't", "wasn't", "can't", "couldn't", "안", "못"}
+LOCAL_DEFAULT_KEYWORDS = {
+    "positive": ["#Gratitude", "#SelfEfficacy", "#Contentment"],
+    "negative": ["#Stress", "#SelfCompassion", "#Resilience"],
+    "neutral": ["#Reflection", "#DailyRoutine", "#Awareness"],
+}
+LOCAL_RECOMMENDATIONS = {
+    "positive": ("Hold on to what made today good.", [
+        ("Savor it", "Write down the one moment you want to remember from today", "Strengthens positive memories"),
+        ("Repeat it", "Plan a small way to do the same thing again this week", "Turns a good day into a habit"),
+        ("Share it", "Tell someone close to you about it", "Deepens the feeling through connection"),
+    ]),
+    "negative": ("It's okay that today felt heavy.", [
+        ("Name it", "Write the feeling in one word and where you feel it in your body", "Creates distance from the emotion"),
+        ("Slow down", "Take five slow breaths or a ten-minute walk", "Calms the stress response"),
+        ("Be kind", "Write what you would say to a friend in the same situation", "Softens self-criticism"),
+    ]),
+    "neutral": ("Quiet days are worth noticing too.", [
+        ("Notice", "Pick one small detail from today and describe it", "Builds everyday awareness"),
+        ("Check in", "Rate your energy from 1 to 10 before bed", "Helps you see patterns over time"),
+        ("Plan", "Choose one small thing to look forward to tomorrow", "Adds gentle motivation"),
+    ]),
+}
+
+def local_sentiment(words: List[str]) -> float:
+    """사전 기반 감성 점수 (-1 ~ 1). 바로 앞 두 단어 안에 부정어가 있으면 반대로 셉니다."""
+    score, hits = 0, 0
+    for i, word in enumerate(words):
+        polarity = 1 if word in LOCAL_POSITIVE_WORDS else -1 if word in LOCAL_NEGATIVE_WORDS else 0
+        if not polarity:
+            # 한국어는 어미가 붙으므로 어간(앞부분) 일치로 확인
+            polarity = 1 if any(word.startswith(w) for w in LOCAL_POSITIVE_WORDS if not w.isascii()) else \
+                -1 if any(word.startswith(w) for w in LOCAL_NEGATIVE_WORDS if not w.isascii()) else 0
+        if not polarity:
+            continue
+        if any(w in LOCAL_NEGATIONS for w in words[max(0, i - 2):i]):
+            polarity = -polarity
+        score += polarity
+        hits += 1
+    return score / hits if hits else 0.0
+
+def local_trait_keywords(words: List[str], user_traits: List[str], sentiment_label: str) -> List[str]:
+    """본문에 등장하는 유저 기존 특성(#CamelCase -> 단어)을 우선 사용하고, 부족하면 감성별 기본 키워드로 채움"""
+    word_set = set(words)
+    matches = []
+    for trait in user_traits or []:
+        parts = [p.lower() for p in re.findall(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|[^\W\d_]+", trait.lstrip("#"))]
+        hits = sum(1 for p in parts if len(p) >= 3 and (p in word_set or any(w.startswith(p[:5]) for w in word_set if len(p) >= 5)))
+        if hits:
+            matches.append((hits, trait))
+    keywords = [trait for _, trait in sorted(matches, key=lambda m: -m[0])][:3]
+    for fallback in LOCAL_DEFAULT_KEYWORDS[sentiment_label]:
+        if len(keywords) >= 3:
+            break
+        if fallback not in keywords:
+            keywords.append(fallback)
+    return keywords
+
+def local_heuristic_analysis(diary_text: str, user_traits: List[str]) -> dict:
+    """get_gemini_analysis 와 같은 형태의 임시 분석. Big5 는 비워 두어 프로필 점수를 움직이지 않음"""
+    cleaned_text = clean_diary_text(re.sub(IMAGE_DATA_PATTERN, " ", diary_text or ""))
+    words = normalize_diary_text(diary_text)
+    sentiment = local_sentiment(words)
+    label = "positive" if sentiment > 0.2 else "negative" if sentiment < -0.2 else "neutral"
+    keywords = local_trait_keywords(words, user_traits, label)
+
+    first_sentence = re.split(r"(?<=[.!?。])\s+", cleaned_text, maxsplit=1)[0] if cleaned_text else ""
+    event_summary = first_sentence[:157] + "..." if len(first_sentence) > 160 else first_sentence
+    head, methods = LOCAL_RECOMMENDATIONS[label]
+    flow = {"positive": "a mostly positive", "negative": "a mostly difficult", "neutral": "a fairly even"}[label]
+    return {
+        "event_summary": event_summary,
+        "analysis": {
+            "theme1": f"This entry reads as {flow} day.",
+            "theme2_title": "Provisional analysis",
+            "theme2": "A detailed reading of your beliefs and values will appear once the full analysis is ready.",
+            "theme3": f"Words that stood out: {', '.join(k.lstrip('#') for k in keywords)}.",
+            "theme4": "Patterns across your entries will be compared in the full analysis.",
+            "theme5": "This is a quick summary made while the AI analysis is busy. It will be replaced automatically.",
+        },
+        "recommend": {
+            "head": head,
+            **{f"method{i}": {"main": main, "content": content, "effect": effect} for i, (main, content, effect) in enumerate(methods, start=1)},
+        },
+        "one_liner": head,
+        "keywords": keywords,
+        "big5": {},
+    }
 
 # --- [Helper] 장기 분석 함수 (Event & Growth Focused) ---
 async def get_long_term_analysis_rag(context_data: str, data_count: int):
@@ -531,51 +1948,684 @@ async def get_long_term_analysis_rag(context_data: str, data_count: int):
         response = await call_gemini_with_fallback([system_instruction, context_data])
         
         if response:
-            clean_json = re.sub(r"```json|```", "", response.text).strip()
-            return json.loads(clean_json)
+            data = repair_json_text(response.text)
+            if isinstance(data, dict):
+                return data
+            print("WARNING: Long-term analysis returned unparseable JSON.")
+    except HTTPException:
+        # Gemini 대기열 포화(503 + Retry-After): 호출자에게 그대로 전달
+        raise
     except Exception as e:
         print(f"Analysis Error: {e}")
-        return None
+    return None
+
+# --- [Helper] 특성 키워드 Top-K 색인 (빈도 + 최근성 감쇠) ---
+def _decayed_trait_score(entry: dict, now: datetime) -> float:
+    elapsed_days = max(0.0, (now - entry["last_seen"]).total_seconds() / 86400)
+    return entry["score"] * (0.5 ** (elapsed_days / TRAIT_HALF_LIFE_DAYS))
+
+def update_trait_index(trait_index: List[dict], new_keywords: List[str], now: datetime, removed_keywords: List[str] = ()):
+    """
+    trait_index: [{"keyword", "score", "last_seen"}] 형태의 색인에 새 키워드를 반영하고,
+    (갱신된 색인, 상위 K개 키워드 리스트)를 반환합니다.
+    점수는 마지막 등장 시점 기준으로 감쇠시킨 뒤 +1 하므로 전체 기록을 다시 볼 필요가 없습니다.
+    removed_keywords: 재분석으로 빠진 키워드. 등장 한 번만큼(-1) 되돌립니다 (0 아래로는 내려가지 않음).
+    """
+    entries = {}
+    for entry in trait_index or []:
+        entries[entry["keyword"]] = {"keyword": entry["keyword"], "score": _decayed_trait_score(entry, now), "last_seen": now}
+    for keyword in new_keywords:
+        entry = entries.setdefault(keyword, {"keyword": keyword, "score": 0.0, "last_seen": now})
+        entry["score"] += 1.0
+    for keyword in removed_keywords:
+        if keyword in entries:
+            entries[keyword]["score"] = max(0.0, entries[keyword]["score"] - 1.0)
+
+    ranked = sorted(
+        (e for e in entries.values() if e["score"] >= TRAIT_INDEX_MIN_SCORE),
+        key=lambda e: e["score"],
+        reverse=True
+    )[:TRAIT_INDEX_MAX]
+    for entry in ranked:
+        entry["score"] = round(entry["score"], 4)
+    return ranked, [e["keyword"] for e in ranked[:TRAIT_CONTEXT_TOP_K]]
+
+def positive_trait_counts(trait_counts: Optional[dict]) -> dict:
+    """trait_counts / user_tag_counts 는 $inc 한 번으로만 증감하므로 0 이하가 된 키가 남아 있음 -> 읽을 때 걸러냄"""
+    return {k: v for k, v in (trait_counts or {}).items() if v and v > 0}
+
+def seed_trait_index(trait_counts: dict, now: datetime) -> List[dict]:
+    """trait_index가 없는 기존 유저: 누적 빈도를 초기 점수로 사용합니다."""
+    return [{"keyword": k, "score": float(v), "last_seen": now} for k, v in positive_trait_counts(trait_counts).items()]
 
 # --- 백그라운드 작업 함수 (뒤에서 몰래 계산할 녀석) ---
-def update_user_stats_bg(user_id: str, new_keywords: List[str], new_tags: List[str], new_big5: dict):
+def trait_delta_update(user_id: str, added: List[str], removed: List[str]) -> dict:
+    """
+    키워드 증감(added - removed)을 반영하는 유저 문서 업데이트 (재분석 / 가져오기 / 백필 공통, 바뀐 게 없으면 빈 dict).
+    trait_counts 는 $inc 로, 프롬프트용 trait_index / top_traits 는 같은 차이로 다시 계산해 $set 합니다.
+    """
+    delta = Counter(added)
+    delta.subtract(removed)
+    delta = {k: v for k, v in delta.items() if v}
+    if not delta:
+        return {}
+    now = datetime.utcnow()
+    profile = user_collection.find_one({"user_id": user_id}, {"trait_index": 1, "trait_counts": 1}) or {}
+    trait_index = profile.get("trait_index")
+    if trait_index is None:
+        trait_index = seed_trait_index(profile.get("trait_counts"), now)
+    gained = [k for k, v in delta.items() for _ in range(max(v, 0))]
+    lost = [k for k, v in delta.items() for _ in range(max(-v, 0))]
+    ranked, top_traits = update_trait_index(trait_index, gained, now, lost)
+    return {
+        # 0 이 된 키워드는 남겨두고 읽을 때 positive_trait_counts 로 거름
+        "$inc": {f"trait_counts.{k}": v for k, v in delta.items()},
+        "$set": {"trait_index": ranked, "top_traits": top_traits},
+    }
+
+def update_user_stats_bg(user_id: str, new_keywords: List[str], new_big5: dict):
     try:
         # 1. 유저 프로필 다시 로드 (최신 상태)
         user_profile = user_collection.find_one({"user_id": user_id})
         if not user_profile: return
 
         # 2. 통계 계산 (무거운 작업)
-        # (1) AI 키워드 누적
-        existing_ai_counts = user_profile.get("trait_counts") or {}
-        ai_counter = Counter(existing_ai_counts)
-        ai_counter.update(new_keywords)
+        # (1) AI 키워드 누적: 다른 경로(재분석/가져오기/백필)도 $inc 로 증감하므로 읽은 값을 덮어쓰지 않고 $inc 로만 더함
+        existing_ai_counts = positive_trait_counts(user_profile.get("trait_counts"))
+        keyword_inc = {f"trait_counts.{k}": v for k, v in Counter(new_keywords).items()}
 
-        # (2) 유저 태그 누적
-        existing_user_tags = user_profile.get("user_tag_counts") or {}
-        user_tag_counter = Counter(existing_user_tags)
-        user_tag_counter.update(new_tags)
+        # (2) 유저 태그 카운트는 태그 엔진(apply_tag_delta)이 원자적으로 관리
 
         # (3) Big5 점수 재계산
         existing_big5 = user_profile.get("big5_scores") or get_default_big5()
         updated_big5 = update_big5_scores(existing_big5, new_big5)
 
+        update_fields = {
+            "big5_scores": updated_big5,
+            "last_updated": datetime.utcnow()
+        }
+
+        # (4) 프롬프트용 Top-K 특성 색인 (새 키워드가 있거나 색인이 아직 없을 때만)
+        if new_keywords or "trait_index" not in user_profile:
+            now = datetime.utcnow()
+            trait_index = user_profile.get("trait_index")
+            if trait_index is None:
+                trait_index = seed_trait_index(existing_ai_counts, now)
+            update_fields["trait_index"], update_fields["top_traits"] = update_trait_index(trait_index, new_keywords, now)
+
         # 3. DB 업데이트 (느린 작업)
-        user_collection.update_one(
-            {"user_id": user_id},
-            {
-                "$set": {
-                    "trait_counts": dict(ai_counter),
-                    "user_tag_counts": dict(user_tag_counter),
-                    "big5_scores": updated_big5,
-                    "last_updated": datetime.utcnow()
-                }
-            }
-        )
+        update = {"$set": update_fields}
+        if keyword_inc:
+            update["$inc"] = keyword_inc
+        user_collection.update_one({"user_id": user_id}, update)
+        user_stats_cache.invalidate(user_id)
         print(f"INFO: [Background] User stats updated for {user_id}")
         
     except Exception as e:
         print(f"ERROR: [Background] Failed to update stats: {e}")
 
+# --- [Helper] Big5 / 기분 추이 롤업 (일별 & 주별) ---
+# trend_rollups 문서: {user_id, granularity: "day"|"week", period: "YYYY-MM-DD"(주별은 월요일),
+#                      count, mood_counts: {기분: n}, big5_sum: {요인: {세부: 합}}, big5_n: {요인: {세부: 개수}}}
+# 일기 저장/삭제 때 $inc로 증감만 하므로 추이 조회 시 전체 일기를 볼 필요가 없습니다.
+TREND_GRANULARITIES = ("day", "week")
+
+def trend_periods(entry_date: str):
+    """'YYYY-MM-DD' -> {"day": 해당일, "week": 그 주 월요일}. 형식이 잘못되면 None."""
+    try:
+        day = datetime.strptime(entry_date, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return None
+    return {"day": day.isoformat(), "week": (day - timedelta(days=day.weekday())).isoformat()}
+
+def _trend_increments(diary: dict, sign: int) -> dict:
+    inc = {"count": sign}
+    if diary.get("mood"):
+        inc[f"mood_counts.{diary['mood']}"] = sign
+    vec = big5_to_vector(diary.get("big5_snapshot"))
+    for (factor, facet), value in zip(BIG5_VECTOR_KEYS, vec):
+        if not np.isnan(value):
+            inc[f"big5_sum.{factor}.{facet}"] = sign * float(value)
+            inc[f"big5_n.{factor}.{facet}"] = sign
+    return inc
+
+def trend_rollup_ops(diary: dict, sign: int) -> List[UpdateOne]:
+    """최종 제출된 일기 하나의 기여분을 더하거나(sign=1) 빼는(sign=-1) 업데이트 목록."""
+    if not diary or diary.get("is_temporary", False):
+        return []
+    periods = trend_periods(diary.get("entry_date"))
+    if not periods:
+        return []
+    inc = _trend_increments(diary, sign)
+    return [
+        UpdateOne(
+            {"user_id": diary["user_id"], "granularity": granularity, "period": periods[granularity]},
+            {"$inc": inc},
+            upsert=True
+        )
+        for granularity in TREND_GRANULARITIES
+    ]
+
+def shift_trend_rollups(old_diary: Optional[dict], new_diary: Optional[dict]):
+    """이전 상태의 기여분을 빼고 새 상태의 기여분을 더합니다. (생성: old=None / 삭제: new=None)"""
+    try:
+        ops = trend_rollup_ops(old_diary, -1) + trend_rollup_ops(new_diary, 1)
+        if ops:
+            trend_collection.bulk_write(ops, ordered=False)
+    except Exception as e:
+        print(f"ERROR: Failed to update trend rollups: {e}")
+
+def rebuild_trend_rollups(user_id: str) -> int:
+    """유저의 과거 일기 전체로 롤업을 처음부터 다시 만듭니다. 생성된 롤업 문서 수를 반환."""
+    buckets = defaultdict(lambda: {"count": 0, "mood_counts": Counter(), "big5_sum": np.zeros(len(BIG5_VECTOR_KEYS)), "big5_n": np.zeros(len(BIG5_VECTOR_KEYS))})
+    cursor = diary_collection.find(
+        {"user_id": user_id, "is_temporary": False},
+        {"entry_date": 1, "mood": 1, "big5_snapshot": 1, "_id": 0}
+    )
+    for diary in cursor:
+        periods = trend_periods(diary.get("entry_date"))
+        if not periods:
+            continue
+        vec = big5_to_vector(diary.get("big5_snapshot"))
+        valid = ~np.isnan(vec)
+        for granularity in TREND_GRANULARITIES:
+            bucket = buckets[(granularity, periods[granularity])]
+            bucket["count"] += 1
+            if diary.get("mood"):
+                bucket["mood_counts"][diary["mood"]] += 1
+            bucket["big5_sum"] += np.where(valid, vec, 0.0)
+            bucket["big5_n"] += valid
+
+    docs = []
+    for (granularity, period), bucket in buckets.items():
+        big5_sum, big5_n = {f: {} for f in BIG5_FACETS}, {f: {} for f in BIG5_FACETS}
+        for i, (factor, facet) in enumerate(BIG5_VECTOR_KEYS):
+            if bucket["big5_n"][i]:
+                big5_sum[factor][facet] = float(bucket["big5_sum"][i])
+                big5_n[factor][facet] = int(bucket["big5_n"][i])
+        docs.append({
+            "user_id": user_id, "granularity": granularity, "period": period,
+            "count": bucket["count"], "mood_counts": dict(bucket["mood_counts"]),
+            "big5_sum": big5_sum, "big5_n": big5_n
+        })
+
+    trend_collection.delete_many({"user_id": user_id})
+    if docs:
+        trend_collection.insert_many(docs)
+    return len(docs)
+
+def rebuild_trend_rollups_bg(user_id: str):
+    try:
+        count = rebuild_trend_rollups(user_id)
+        print(f"INFO: [Background] Rebuilt {count} trend rollups for {user_id}")
+    except Exception as e:
+        print(f"ERROR: [Background] Failed to rebuild trend rollups: {e}")
+
+# --- [Helper] 일기 수정 변화량 판단 (재분석 여부) ---
+IMAGE_DATA_PATTERN = r'data:(image\/[^;]+);base64,([^"]+)'
+
+def normalize_diary_text(content: str) -> List[str]:
+    """이미지/HTML 태그를 걷어내고 소문자 단어 목록으로 정규화합니다."""
+    text = re.sub(IMAGE_DATA_PATTERN, " ", content or "")
+    text = re.sub(r'<[^>]+>', ' ', text)
+    return re.findall(r"\w+", text.lower())
+
+def diary_image_fingerprints(content: str) -> set:
+    return {hashlib.sha1(data.encode()).hexdigest() for _, data in re.findall(IMAGE_DATA_PATTERN, content or "")}
+
+def content_change_score(old_content: str, new_content: str):
+    """(본문 변화량 0~1, 이미지 변경 여부). 단어 단위로 비교하므로 오타 수정은 낮은 점수가 나옵니다."""
+    old_words, new_words = normalize_diary_text(old_content), normalize_diary_text(new_content)
+    if not old_words and not new_words:
+        text_change = 0.0
+    else:
+        text_change = 1.0 - difflib.SequenceMatcher(None, old_words, new_words, autojunk=False).ratio()
+    images_changed = diary_image_fingerprints(old_content) != diary_image_fingerprints(new_content)
+    return round(text_change, 4), images_changed
+
+def apply_analysis_result(user_id: str, diary_id: str, expected_content: str, analysis_result: dict, analysis_model: Optional[str], recompute_big5: bool = True) -> bool:
+    """
+    새 분석 결과를 일기에 반영하고, 이전 스냅샷을 빼고 새 스냅샷을 더하는 방식으로 통계를 갱신합니다.
+    그 사이 본문이 바뀌었다면 (더 최신 작업이 있으므로) 아무것도 하지 않고 False를 반환합니다.
+    """
+    new_big5 = analysis_result.get("big5") or {}
+    new_keywords = analysis_result.get("keywords") or []
+    new_fields = {
+        "event_summary": analysis_result.get("event_summary") or analysis_result.get("one_liner", ""),
+        "analysis": analysis_result.get("analysis"),
+        "recommend": analysis_result.get("recommend"),
+        "one_liner": analysis_result.get("one_liner"),
+        "big5_snapshot": new_big5,
+        "keywords_snapshot": new_keywords,
+        "analysis_model": analysis_model,
+        "analysis_source": "gemini",
+        "analysis_status": "fresh",
+        "analyzed_at": datetime.utcnow()
+    }
+    diary_meta = diary_collection.find_one({"_id": ObjectId(diary_id)}, {"title": 1}) or {}
+    embedding = embed_text(diary_embedding_text({**diary_meta, **new_fields, "content": expected_content}))
+    new_fields["embedding"] = embedding_to_binary(embedding)
+    # 본문이 그대로일 때만 교체하고, 교체 전 스냅샷을 돌려받아 차이만 반영
+    with sync_seq_slot(user_id) as seq:
+        new_fields["sync_seq"] = seq
+        previous = diary_collection.find_one_and_update(
+            {"_id": ObjectId(diary_id), "user_id": user_id, "content": expected_content},
+            {"$set": new_fields},
+            projection={"user_id": 1, "is_temporary": 1, "entry_date": 1, "mood": 1, "big5_snapshot": 1, "keywords_snapshot": 1}
+        )
+    if not previous:
+        print(f"INFO: [Background] Diary {diary_id} changed again; dropping stale analysis")
+        return False
+
+    # 키워드 증감은 유저 문서 쓰기 한 번으로 (trait_counts $inc + 프롬프트용 trait_index / top_traits)
+    trait_update = trait_delta_update(user_id, new_keywords, previous.get("keywords_snapshot") or [])
+    if trait_update:
+        user_collection.update_one({"user_id": user_id}, trait_update)
+
+    shift_trend_rollups(previous, {**previous, "big5_snapshot": new_big5})
+    similarity_index.upsert(user_id, diary_id, embedding)
+    if recompute_big5:
+        recompute_big5_profile(user_id)
+    user_stats_cache.invalidate(user_id)
+    return True
+
+async def reanalyze_diary_bg(user_id: str, diary_id: str, expected_content: str):
+    """
+    수정된 일기를 바로 다시 분석해서 반영합니다.
+    일기는 이미 analysis_status="queued" 로 저장돼 있으므로, 여기서 실패하거나 서버가 죽어도 지연 분석 큐가 다시 처리합니다.
+    """
+    try:
+        # 큐 워커와 같은 방식으로 선점 (이미 큐가 가져갔거나 다시 수정됐으면 건너뜀)
+        claimed = diary_collection.find_one_and_update(
+            {"_id": ObjectId(diary_id), "content": expected_content, "analysis_status": "queued"},
+            {"$set": {"analysis_status": "running", "analysis_started_at": datetime.utcnow()}, "$inc": {"analysis_attempts": 1}},
+            projection={"_id": 1}
+        )
+        if not claimed:
+            return
+
+        profile = user_collection.find_one({"user_id": user_id}, {"top_traits": 1}) or {}
+        try:
+            analysis_result, analysis_model = await get_gemini_analysis(expected_content, profile.get("top_traits", []))
+        except HTTPException:
+            analysis_result = None  # Gemini 대기열 포화 -> 큐에서 다시 시도
+        if not analysis_result:
+            diary_collection.update_one(
+                {"_id": ObjectId(diary_id), "content": expected_content, "analysis_status": "running"},
+                {"$set": {"analysis_status": "queued"}}
+            )
+            print(f"WARNING: [Background] Re-analysis failed for diary {diary_id}; left in the analysis queue")
+            return
+
+        if apply_analysis_result(user_id, diary_id, expected_content, analysis_result, analysis_model):
+            print(f"INFO: [Background] Diary {diary_id} re-analyzed")
+    except Exception as e:
+        print(f"ERROR: [Background] Re-analysis error for diary {diary_id}: {e}")
+
+# --- [Helper] 유사 일기 색인 (해시 TF-IDF + 코사인 유사도) ---
+EMBEDDING_STOPWORDS = {
+    "the", "a", "an", "and", "or", "but", "to", "of", "in", "on", "at", "for", "with", "is", "was", "were", "be",
+    "been", "it", "this", "that", "i", "me", "my", "we", "you", "he", "she", "they", "so", "just", "very", "today"
+}
+
+def diary_embedding_text(diary: dict) -> str:
+    keywords = " ".join(diary.get("keywords_snapshot") or [])
+    return " ".join(filter(None, [diary.get("title"), diary.get("event_summary"), keywords, diary.get("content")]))
+
+def embed_text(text: str) -> np.ndarray:
+    """
+    단어/바이그램을 crc32로 EMBEDDING_DIM 차원에 해싱(부호 포함)하고 로그 TF 가중 후 L2 정규화합니다.
+    IDF는 검색 시 유저별 색인에서 계산합니다.
+    """
+    # 아주 단순한 어간 처리: 복수형 s 제거 (mountains -> mountain)
+    words = [w[:-1] if len(w) > 3 and w.endswith("s") and not w.endswith("ss") else w
+             for w in normalize_diary_text(text) if w not in EMBEDDING_STOPWORDS]
+    tokens = words + [f"{a}_{b}" for a, b in zip(words, words[1:])]
+    vec = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    for token, tf in Counter(tokens).items():
+        h = zlib.crc32(token.encode())
+        vec[h % EMBEDDING_DIM] += (1.0 + np.log(tf)) * (1.0 if (h >> 16) & 1 else -1.0)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
+
+def embedding_to_binary(vec: np.ndarray) -> Binary:
+    return Binary(vec.astype(np.float16).tobytes())  # 일기당 1KB
+
+def binary_to_embedding(data) -> np.ndarray:
+    return np.frombuffer(bytes(data), dtype=np.float16).astype(np.float32)
+
+class SimilarityIndex:
+    """
+    유저별 (일기 ID 목록, N x EMBEDDING_DIM 행렬)을 LRU로 메모리에 보관합니다.
+    저장/수정/삭제 시 해당 행만 갱신하므로 전체를 다시 읽지 않습니다.
+    shared=True(멀티 워커)면 조회 때 유저의 sync_seq를 확인해 다른 워커가 바꾼 일기만 증분으로 반영합니다.
+    """
+    def __init__(self, max_users: int, shared: bool = False):
+        self.max_users = max_users
+        self.shared = shared
+        self._users = OrderedDict()  # user_id -> {"ids": [str], "matrix": np.ndarray, "seq": 반영된 최대 sync_seq}
+        self._lock = threading.Lock()
+
+    def _load(self, user_id: str) -> dict:
+        ids, rows, missing, seq = [], [], [], 0
+        cursor = diary_collection.find(
+            {"user_id": user_id, "is_temporary": False},
+            {"embedding": 1, "title": 1, "event_summary": 1, "keywords_snapshot": 1, "content": 1, "sync_seq": 1}
+        )
+        for doc in cursor:
+            seq = max(seq, doc.get("sync_seq") or 0)
+            if doc.get("embedding") is not None:
+                vec = binary_to_embedding(doc["embedding"])
+            else:
+                # 색인 도입 전 일기: 한 번만 계산해서 저장
+                vec = embed_text(diary_embedding_text(doc))
+                missing.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"embedding": embedding_to_binary(vec)}}))
+            ids.append(str(doc["_id"]))
+            rows.append(vec)
+        if missing:
+            diary_collection.bulk_write(missing, ordered=False)
+        matrix = np.vstack(rows) if rows else np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        return {"ids": ids, "matrix": matrix, "seq": seq}
+
+    def _refresh(self, user_id: str, entry: dict):
+        """다른 워커에서 저장/수정/삭제된 일기를 sync_seq 기준으로 반영"""
+        user = user_collection.find_one({"user_id": user_id}, {"sync_seq": 1}) or {}
+        if (user.get("sync_seq") or 0) <= entry["seq"]:
+            return
+        since = {"user_id": user_id, "sync_seq": {"$gt": entry["seq"]}}
+        # 최대 seq는 실제로 읽은 문서 기준으로만 올림 (번호만 받고 아직 쓰이지 않은 일기는 다음 조회 때 반영)
+        seq = entry["seq"]
+        for doc in diary_collection.find(since, {"embedding": 1, "is_temporary": 1, "sync_seq": 1}):
+            seq = max(seq, doc["sync_seq"])
+            if doc.get("is_temporary") or doc.get("embedding") is None:
+                self.remove(user_id, str(doc["_id"]))
+            else:
+                self.upsert(user_id, str(doc["_id"]), binary_to_embedding(doc["embedding"]))
+        for tombstone in tombstone_collection.find(since, {"diary_id": 1, "sync_seq": 1}):
+            seq = max(seq, tombstone["sync_seq"])
+            self.remove(user_id, tombstone["diary_id"])
+        entry["seq"] = seq
+
+    def _get(self, user_id: str) -> dict:
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None:
+                self._users.move_to_end(user_id)
+        if entry is not None:
+            CACHE_REQUESTS.labels("similarity_index", "hit").inc()
+            if self.shared:
+                self._refresh(user_id, entry)
+            return entry
+        CACHE_REQUESTS.labels("similarity_index", "miss").inc()
+        entry = self._load(user_id)
+        with self._lock:
+            self._users[user_id] = entry
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return entry
+
+    def upsert(self, user_id: str, diary_id: str, vec: np.ndarray):
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return  # 아직 메모리에 없으면 다음 조회 때 DB에서 읽음
+            if diary_id in entry["ids"]:
+                entry["matrix"][entry["ids"].index(diary_id)] = vec
+            else:
+                entry["ids"].append(diary_id)
+                entry["matrix"] = np.vstack([entry["matrix"], vec[None, :]])
+
+    def drop(self, user_id: str):
+        """대량 변경(가져오기 등) 후 유저 색인을 통째로 버리고 다음 조회 때 다시 읽습니다."""
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def remove(self, user_id: str, diary_id: str):
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None or diary_id not in entry["ids"]:
+                return
+            row = entry["ids"].index(diary_id)
+            entry["ids"].pop(row)
+            entry["matrix"] = np.delete(entry["matrix"], row, axis=0)
+
+    def search(self, user_id: str, query_vec: np.ndarray, k: int = 5, exclude_ids=(), min_score: float = SIMILARITY_MIN_SCORE) -> List[tuple]:
+        """[(diary_id, 유사도)] 를 유사도 내림차순으로 반환합니다."""
+        entry = self._get(user_id)
+        matrix = entry["matrix"]
+        if matrix.shape[0] == 0:
+            return []
+        # 유저 색인 안에서의 IDF (여러 일기에 공통으로 나오는 차원은 가중치를 낮춤)
+        df = np.count_nonzero(matrix, axis=0)
+        idf = np.log((1 + matrix.shape[0]) / (1 + df)) + 1.0
+        weighted = matrix * idf
+        query = query_vec * idf
+        norms = np.linalg.norm(weighted, axis=1) * (np.linalg.norm(query) or 1.0)
+        scores = (weighted @ query) / np.where(norms > 0, norms, 1.0)
+
+        excluded = set(exclude_ids)
+        order = np.argsort(-scores)
+        results = []
+        for row in order:
+            if entry["ids"][row] in excluded:
+                continue
+            if scores[row] < min_score or scores[row] <= 0:
+                break
+            results.append((entry["ids"][row], round(float(scores[row]), 4)))
+            if len(results) >= k:
+                break
+        return results
+
+similarity_index = SimilarityIndex(SIMILARITY_CACHE_USERS, shared=SHARED_STATE)
+
+# --- [Helper] 검색용 본문 정리 ---
+def clean_diary_text(content: str) -> str:
+    """HTML 태그(이미지 base64 포함)를 제거하고 공백을 정리한 본문. 전문 검색 색인에 사용합니다."""
+    return re.sub(r"\s+", " ", re.sub(r'<[^>]+>', ' ', content or "")).strip()
+
+def encode_search_cursor(score: float, diary_id) -> str:
+    raw = json.dumps({"s": score, "id": str(diary_id)}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_search_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        return float(data["s"]), ObjectId(data["id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+# --- [Helper] 증분 동기화 시퀀스 ---
+# 유저마다 단조 증가하는 sync_seq 카운터를 두고, 일기를 쓰거나 고치거나 지울 때마다 새 번호를 찍습니다.
+# 클라이언트는 마지막으로 받은 번호 이후의 변경만 받아가면 됩니다.
+# 번호는 쓰기 전에 발급되므로 5번 쓰기가 끝나기 전에 6번이 먼저 저장될 수 있습니다. 그 사이 커서 6을 내주면
+# 5번은 영영 못 받으므로, 진행 중인 쓰기 수(sync_inflight)를 함께 세고 0이 된 순간의 번호(sync_safe_seq)까지만 커서로 내줍니다.
+def next_sync_seq(user_id: str) -> int:
+    """새 번호 발급 + 진행 중 쓰기 수 증가. 쓰기가 끝나면 release_sync_seq 를 꼭 호출 (보통 sync_seq_slot 사용)"""
+    user = user_collection.find_one_and_update(
+        {"user_id": user_id},
+        {"$inc": {"sync_seq": 1, "sync_inflight": 1}, "$set": {"sync_inflight_at": datetime.utcnow()}},
+        projection={"sync_seq": 1},
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    return (user or {}).get("sync_seq", 0)
+
+def release_sync_seq(user_id: str):
+    user = user_collection.find_one_and_update(
+        {"user_id": user_id, "sync_inflight": {"$gt": 0}},
+        {"$inc": {"sync_inflight": -1}},
+        projection={"sync_seq": 1, "sync_inflight": 1},
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    if user and user.get("sync_inflight", 0) <= 0:
+        # 진행 중인 쓰기가 없는 순간: 이 번호까지는 모두 저장됨 (그 사이 새 번호가 나갔으면 조건에 걸리지 않음)
+        user_collection.update_one(
+            {"user_id": user_id, "sync_seq": user.get("sync_seq", 0), "sync_inflight": 0},
+            {"$max": {"sync_safe_seq": user.get("sync_seq", 0)}}
+        )
+
+@contextmanager
+def sync_seq_slot(user_id: str):
+    """with sync_seq_slot(user) as seq: 쓰기  (블록이 끝나면 실패해도 진행 중 표시를 해제)"""
+    seq = next_sync_seq(user_id)
+    try:
+        yield seq
+    finally:
+        release_sync_seq(user_id)
+
+def committed_sync_seq(user: dict) -> int:
+    """커서로 내줄 수 있는 가장 큰 번호. user 는 sync_seq / sync_inflight / sync_inflight_at / sync_safe_seq 를 포함"""
+    seq = user.get("sync_seq", 0)
+    if user.get("sync_inflight", 0) <= 0:
+        return seq
+    started = user.get("sync_inflight_at")
+    if started and (datetime.utcnow() - started).total_seconds() > SYNC_INFLIGHT_TIMEOUT_SEC:
+        # 끝나지 않은 쓰기는 죽은 프로세스의 것: 카운터를 비워 커서가 계속 멈춰 있지 않게 함
+        user_collection.update_one(
+            {"user_id": user["user_id"], "sync_inflight_at": started},
+            {"$set": {"sync_inflight": 0}, "$max": {"sync_safe_seq": seq}}
+        )
+        return seq
+    return min(seq, user.get("sync_safe_seq", 0))
+
+SYNC_CURSOR_FIELDS = {"user_id": 1, "sync_seq": 1, "sync_inflight": 1, "sync_inflight_at": 1, "sync_safe_seq": 1}
+
+def encode_sync_cursor(seq: int) -> str:
+    return f"{seq}.{int(time.time())}"
+
+def decode_sync_cursor(cursor: str):
+    """(seq, 발급 시각 epoch). 형식이 잘못되면 400."""
+    try:
+        seq, issued = cursor.split(".")
+        return int(seq), int(issued)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid sync cursor")
+
+# --- [Helper] 태그 엔진 (카운트 증감 / 병합 / 재집계) ---
+# user_tag_counts[태그] = 그 태그가 붙은 일기 수 (임시 저장 포함). 모든 변경은 $inc 또는 재집계로만 반영합니다.
+tag_transactions_supported = TAG_TRANSACTIONS == "auto"
+
+def validate_tag_name(tag: str) -> str:
+    tag = (tag or "").strip()
+    # '.'과 '$'는 user_tag_counts의 필드 경로로 쓸 수 없음
+    if not tag or "." in tag or tag.startswith("$"):
+        raise HTTPException(status_code=400, detail=f"Invalid tag name: '{tag}'")
+    return tag
+
+def apply_tag_delta(user_id: str, old_tags: Optional[List[str]], new_tags: Optional[List[str]], session=None):
+    """일기 하나의 태그가 old -> new로 바뀐 만큼만 카운트 증감 (생성: old=None / 삭제: new=None)"""
+    delta = Counter(set(new_tags or []))
+    delta.subtract(set(old_tags or []))
+    inc = {f"user_tag_counts.{k}": v for k, v in delta.items() if v}
+    if inc:
+        # $inc 한 번으로만 (0 이 된 태그는 남겨두고 읽을 때 positive_trait_counts 로 거름, 재집계/병합 때 정리됨)
+        user_collection.update_one({"user_id": user_id}, {"$inc": inc}, session=session)
+
+def count_user_tags(user_id: str, session=None) -> dict:
+    """일기 컬렉션 집계로 태그별 일기 수를 한 번에 계산 (한 일기 안의 중복 태그는 1회)"""
+    pipeline = [
+        {"$match": {"user_id": user_id, "tags.0": {"$exists": True}}},
+        {"$project": {"tags": {"$setUnion": ["$tags", []]}}},
+        {"$unwind": "$tags"},
+        {"$group": {"_id": "$tags", "count": {"$sum": 1}}}
+    ]
+    return {row["_id"]: row["count"] for row in diary_collection.aggregate(pipeline, session=session)}
+
+def recount_user_tags(user_id: str, session=None) -> dict:
+    tag_counts = count_user_tags(user_id, session=session)
+    user_collection.update_one({"user_id": user_id}, {"$set": {"user_tag_counts": tag_counts}}, session=session)
+    return tag_counts
+
+def merge_tags(user_id: str, sources: List[str], target: str, sync_seq: int, session=None) -> int:
+    """
+    sources 태그들을 target 하나로 합칩니다. (이름 변경 = 원본 1개, 삭제 = target이 'unsorted')
+    일기 쪽은 bulk_write 한 번, 유저 카운트는 update 한 번. 바뀐 일기 수를 반환.
+    sync_seq 는 트랜잭션 밖에서 미리 발급받아 넘깁니다 (트랜잭션 안에서 세션 없이 유저 문서를 $inc 하면
+    같은 문서를 세션으로 고치는 아래 update 와 WriteConflict 가 나서 with_transaction 이 계속 재시도함).
+    """
+    sources = [t for t in dict.fromkeys(sources) if t != target]
+    if not sources:
+        return 0
+    # 병합 후 target 카운트 = target 또는 sources 중 하나라도 가진 일기 수
+    target_count = diary_collection.count_documents({"user_id": user_id, "tags": {"$in": sources + [target]}}, session=session)
+    touched = {"user_id": user_id, "tags": {"$in": sources}}
+    modified = diary_collection.count_documents(touched, session=session)
+    if modified:
+        diary_collection.bulk_write([
+            UpdateMany(touched, {"$addToSet": {"tags": target}, "$set": {"sync_seq": sync_seq}}),
+            UpdateMany(touched, {"$pull": {"tags": {"$in": sources}}})
+        ], ordered=True, session=session)
+
+    user_update = {"$unset": {f"user_tag_counts.{t}": "" for t in sources}}
+    if target_count:
+        user_update["$set"] = {f"user_tag_counts.{target}": target_count}
+    user_collection.update_one({"user_id": user_id}, user_update, session=session)
+    return modified
+
+def run_tag_merge(user_id: str, sources: List[str], target: str) -> int:
+    """merge_tags 를 트랜잭션으로 실행 (동기화 번호는 세션 시작 전에 발급)"""
+    with sync_seq_slot(user_id) as sync_seq:
+        return run_tag_operation(lambda session: merge_tags(user_id, sources, target, sync_seq, session))
+
+def run_tag_operation(operation):
+    """
+    태그 작업을 트랜잭션 하나로 실행합니다. 트랜잭션을 지원하지 않는 단일 mongod에서는
+    세션 없이 실행합니다. (이 경우 드물게 어긋난 카운트는 /user/tags/recount로 복구)
+    """
+    global tag_transactions_supported
+    if tag_transactions_supported:
+        try:
+            with client.start_session() as session:
+                return session.with_transaction(operation)
+        except pymongo.errors.OperationFailure as e:
+            if e.code != 20:  # IllegalOperation: 레플리카셋이 아님
+                raise
+            tag_transactions_supported = False
+            print("WARNING: MongoDB transactions unavailable; tag operations run without a session")
+    return operation(None)
+
+# --- [Helper] /user/stats 캐시 ---
+class UserStatsCache:
+    """
+    유저별 통계 응답과 ETag를 짧게 보관합니다.
+    일기 작성/수정/삭제, 태그 삭제, 백그라운드 통계 갱신 시 invalidate()로 즉시 비웁니다.
+    shared=True(멀티 워커)면 무효화를 유저 문서의 stats_epoch 증가로 알리고, 적중 시 epoch가 같은지 확인합니다.
+    """
+    def __init__(self, ttl_seconds: int, shared: bool = False):
+        self.ttl_seconds = ttl_seconds
+        self.shared = shared
+        self._entries = {}  # user_id -> (payload, etag, expires_at, stats_epoch)
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[2] <= time.monotonic():
+                del self._entries[user_id]
+                entry = None
+        if entry and self.shared:
+            user = user_collection.find_one({"user_id": user_id}, {"stats_epoch": 1}) or {}
+            if user.get("stats_epoch", 0) != entry[3]:
+                entry = None  # 다른 워커에서 무효화됨
+        CACHE_REQUESTS.labels("user_stats", "hit" if entry else "miss").inc()
+        return entry
+
+    def set(self, user_id: str, payload: dict, epoch: int = 0) -> str:
+        """epoch: 통계를 계산하기 전에 읽은 유저 문서의 stats_epoch"""
+        etag = '"' + hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest() + '"'
+        with self._lock:
+            self._entries[user_id] = (payload, etag, time.monotonic() + self.ttl_seconds, epoch)
+        return etag
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._entries.pop(user_id, None)
+        if self.shared:
+            user_collection.update_one({"user_id": user_id}, {"$inc": {"stats_epoch": 1}})
+
+user_stats_cache = UserStatsCache(USER_STATS_CACHE_TTL, shared=SHARED_STATE)
+
 # --- 기분 통계 계산 헬퍼 함수 ---
 def calculate_mood_statistics(user_id: str):
     # 1. 임시저장이 아닌(is_temporary=False) 일기의 날짜와 기분만 가져옴
@@ -624,6 +2674,64 @@ def calculate_mood_statistics(user_id: str):
     # Counter 객체를 dict로 변환해서 리턴
     return {k: dict(v) for k, v in stats.items()}
 
+# --- [Helper] 콜드 아카이브 read-through ---
+# 오래된 일기는 content / analysis / recommend 를 diary_archive 로 옮기고 archived=True 표시만 남깁니다.
+# 본문이 필요한 조회는 아래 함수로 한 번의 $in 조회로 다시 채우고, 수정 전에는 unarchive_diary 로 되돌립니다.
+ARCHIVE_FIELDS = ("content", "analysis", "recommend")
+
+def merge_archived_fields(docs) -> List[dict]:
+    """archived 일기에 콜드 필드를 채워 넣은 목록 (문서에 이미 있는 값이 우선)"""
+    docs = list(docs)
+    archived_ids = [d["_id"] for d in docs if d.get("archived") and "_id" in d]
+    if not archived_ids:
+        return docs
+    cold = {c["_id"]: c for c in archive_collection.find({"_id": {"$in": archived_ids}})}
+    for doc in docs:
+        extra = cold.get(doc.get("_id")) if doc.get("archived") else None
+        if extra:
+            for field in ARCHIVE_FIELDS:
+                if field in extra and field not in doc:
+                    doc[field] = extra[field]
+    return docs
+
+def iter_merge_archived_fields(cursor, chunk: int = 200):
+    """커서를 chunk 단위로 읽으며 콜드 필드를 채움 (내보내기 등 스트리밍 응답용)"""
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= chunk:
+            yield from merge_archived_fields(batch)
+            batch = []
+    yield from merge_archived_fields(batch)
+
+def unarchive_diary(user_id: str, diary_id: ObjectId) -> bool:
+    """콜드 필드를 원래 일기로 되돌림 (수정 / 재분석 전에 호출). 아카이브돼 있지 않으면 False"""
+    # 1) 보관 표시부터 내림: compactor 는 표시가 자기 토큰 그대로일 때만 필드를 빼므로, 이후로는 원래 문서를 비우지 못함
+    hot = diary_collection.find_one_and_update(
+        {"_id": diary_id, "user_id": user_id, "archived": True},
+        {"$unset": {"archived": "", "archived_at": "", "archive_token": ""}},
+        projection={f: 1 for f in ARCHIVE_FIELDS}
+    )
+    if not hot:
+        return False
+    # 2) 콜드 문서는 가져오면서 지움. compactor 가 아직 복사 전이면 없고, 그때는 필드가 원래 문서에 남아 있음
+    cold = archive_collection.find_one_and_delete({"_id": diary_id}) or {}
+    restore = {f: cold[f] for f in ARCHIVE_FIELDS if f in cold and f not in hot}
+    if restore:
+        diary_collection.update_one({"_id": diary_id}, {"$set": restore})
+    return True
+
+def retire_superseded_files(collection, user_id: str, keep_id=None) -> int:
+    """
+    교체된 음악/이미지를 바로 지우지 않고 expires_at 만 표시 (TTL 인덱스가 유예 후 삭제).
+    큰 바이너리 삭제가 업로드 요청 경로에서 빠지고, 기존 URL로 재생 중인 클라이언트도 끊기지 않음
+    """
+    query = {"user_id": user_id, "expires_at": {"$exists": False}}
+    if keep_id is not None:
+        query["_id"] = {"$ne": keep_id}
+    expires_at = datetime.utcnow() + timedelta(seconds=SUPERSEDED_GRACE_SEC)
+    return collection.update_many(query, {"$set": {"expires_at": expires_at}}).modified_count
+
 # =========================================================
 # API 엔드포인트
 # =========================================================
@@ -633,6 +2741,58 @@ def calculate_mood_statistics(user_id: str):
 def health_check():
     return {"status": "alive", "timestamp": datetime.utcnow()}
 
+# --- [API: Readiness] 워밍업 완료 여부 (배포 플랫폼 / 로드밸런서용) ---
+# /health 는 프로세스가 살아 있으면 항상 200, /ready 는 Mongo 연결과 AI SDK 로드가 끝나야 200
+@app.get("/ready")
+async def readiness_check(response: Response):
+    if not startup_state["ready"]:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {
+        "status": "ready" if startup_state["ready"] else "starting",
+        "components": startup_state["components"],
+        "worker": WORKER_ID,
+        "leader": leader_lease.held,
+    }
+
+# --- [Helper] 관리자 토큰 검사 (/metrics, /admin/*) ---
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    # 토큰이 설정되지 않은 서버에서는 관리자 API 자체가 없는 것처럼 동작
+    if not PROFILE_ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, PROFILE_ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+# --- [API: Metrics] Prometheus 스크레이프 ---
+# 큐 깊이 / 키 상태 / 워커 정보가 노출되므로 관리자 토큰 필요 (스크레이프 설정의 http_headers 에 X-Admin-Token 지정)
+ANALYSIS_QUEUE_DEPTH = Gauge("onion_analysis_queue_depth", "Diaries waiting in the deferred analysis queue")
+
+@app.get("/metrics", dependencies=[Depends(require_admin)])
+def prometheus_metrics():
+    try:
+        ANALYSIS_QUEUE_DEPTH.set(diary_collection.count_documents({"analysis_status": "queued"}))
+    except Exception as e:
+        print(f"WARNING: Failed to read analysis queue depth: {e}")
+    return Response(content=generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+# --- [API: Admin] 요청 프로파일 조회 ---
+@app.get("/admin/profiles", dependencies=[Depends(require_admin)])
+def list_profiles():
+    return {"profiles": [summary for summary, _ in reversed(profile_sampler.finished)]}
+
+@app.get("/admin/profiles/collapsed", dependencies=[Depends(require_admin)])
+def all_profiles_collapsed():
+    """버퍼에 있는 모든 프로파일을 합친 collapsed stack (flamegraph.pl, speedscope에 바로 사용)"""
+    return Response(content=profile_sampler.collapsed(), media_type="text/plain")
+
+@app.get("/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+def get_profile(profile_id: str, format: str = Query("json", pattern="^(json|collapsed)$")):
+    for summary, stacks in profile_sampler.finished:
+        if summary["id"] == profile_id:
+            if format == "collapsed":
+                return Response(content=profile_sampler.collapsed(profile_id), media_type="text/plain")
+            return {**summary, "top_stacks": [{"stack": k, "samples": v} for k, v in stacks.most_common(20)]}
+    raise HTTPException(status_code=404, detail="Profile not found")
+
 # --- [API 0] 회원가입 & 로그인 (NEW!) ---
 
 @app.post("/signup", response_model=Token)
@@ -646,7 +2806,7 @@ async def signup(user: UserCreate):
         raise HTTPException(status_code=400, detail="User ID already exists")
     
     # 2. 비밀번호 해싱 (암호화)
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash_async(user.password)
     
     # 3. 유저 정보 저장 (초기값 포함)
     new_user = {
@@ -655,6 +2815,8 @@ async def signup(user: UserCreate):
         "joined_at": datetime.utcnow(),
         "big5_scores": get_default_big5(),
         "trait_counts": {},
+        "trait_index": [],
+        "top_traits": [],
         "user_tag_counts": {},
         "saved_musics": [],
         "profile_image": "",
@@ -674,14 +2836,22 @@ async def signup(user: UserCreate):
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     # OAuth2PasswordRequestForm은 username, password 필드를 가집니다.
     # 여기서는 username을 user_id로 사용합니다.
-    user = user_collection.find_one({"user_id": form_data.username})
+    user = user_collection.find_one({"user_id": form_data.username}, {"user_id": 1, "hashed_password": 1})
     
-    if not user or not verify_password(form_data.password, user["hashed_password"]):
+    is_valid, new_hash = False, None
+    if user:
+        is_valid, new_hash = await verify_and_update_password_async(form_data.password, user["hashed_password"])
+
+    if not is_valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect user ID or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+
+    # 비용 계수가 바뀐 해시는 로그인 성공 시 조용히 새 해시로 교체
+    if new_hash:
+        user_collection.update_one({"user_id": user["user_id"]}, {"$set": {"hashed_password": new_hash}})
     
     # 토큰 발급
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -710,44 +2880,69 @@ async def analyze_and_save(request: DiaryRequest, background_tasks: BackgroundTa
                 "mood": request.mood,
                 "weather": request.weather,
                 "tags": request.tags,
+                "clean_text": clean_diary_text(request.content),
                 "is_temporary": True,
                 "updated_at": datetime.utcnow()
             }
             
-            if request.diary_id and ObjectId.is_valid(request.diary_id):
-                result = diary_collection.update_one(
-                    {"_id": ObjectId(request.diary_id), "user_id": current_user},
-                    {"$set": draft_data}
-                )
-                if result.matched_count == 0:
-                    raise HTTPException(status_code=404, detail="Draft not found")
-                saved_id = request.diary_id
-            else:
-                draft_data["created_at"] = datetime.utcnow()
-                result = diary_collection.insert_one(draft_data)
-                saved_id = str(result.inserted_id)
-
-            background_tasks.add_task(update_user_stats_bg, current_user, [], request.tags, {})
+            with sync_seq_slot(current_user) as seq:
+                draft_data["sync_seq"] = seq
+                if request.diary_id and ObjectId.is_valid(request.diary_id):
+                    previous = diary_collection.find_one_and_update(
+                        {"_id": ObjectId(request.diary_id), "user_id": current_user},
+                        {"$set": draft_data},
+                        projection={"tags": 1}
+                    )
+                    if not previous:
+                        raise HTTPException(status_code=404, detail="Draft not found")
+                    saved_id = request.diary_id
+                    old_tags = previous.get("tags")
+                else:
+                    draft_data["created_at"] = datetime.utcnow()
+                    result = diary_collection.insert_one(draft_data)
+                    saved_id = str(result.inserted_id)
+                    old_tags = None
+
+            apply_tag_delta(current_user, old_tags, request.tags)
+            user_stats_cache.invalidate(current_user)
             return {"status": "draft_saved", "message": "임시 저장되었습니다.", "diary_id": saved_id, "is_temporary": True}
 
         # -------------------------------------------------------------
         # [CASE 2] 최종 제출 (여기가 핵심!)
         # -------------------------------------------------------------
         
+        # 0. 유저별 분석 요청 속도 제한 (임시 저장은 AI를 안 쓰므로 제외)
+        check_rate_limit(current_user, "analyze")
+
         # 1. 유저 컨텍스트 로드 (최소한의 정보만 가져오기)
         # 통계 업데이트용 데이터는 여기서 계산 안 함! AI한테 줄 정보만 가져옴
-        user_profile = user_collection.find_one({"user_id": current_user}, {"trait_counts": 1})
+        # 전체 키워드 대신 빈도+최근성 기준 상위 K개만 사용 (기록이 늘어도 프롬프트 크기 일정)
+        user_profile = user_collection.find_one({"user_id": current_user}, {"top_traits": 1})
         
-        existing_traits_list = list(user_profile.get("trait_counts", {}).keys()) if user_profile else []
+        if user_profile and "top_traits" in user_profile:
+            existing_traits_list = user_profile["top_traits"]
+        else:
+            # 색인이 아직 없는 기존 유저: 누적 빈도 상위 K개로 대체 (다음 통계 갱신 때 색인 생성)
+            legacy_profile = user_collection.find_one({"user_id": current_user}, {"trait_counts": 1}) if user_profile else None
+            legacy_counts = Counter(positive_trait_counts((legacy_profile or {}).get("trait_counts")))
+            existing_traits_list = [k for k, _ in legacy_counts.most_common(TRAIT_CONTEXT_TOP_K)]
         
         # 2. Gemini 분석 (가장 오래 걸림 - 어쩔 수 없음)
-        analysis_result = await get_gemini_analysis(request.content, existing_traits_list)
-        if not analysis_result:
-             raise HTTPException(status_code=500, detail="AI Analysis Failed")
+        analysis_result, analysis_model = await get_gemini_analysis(request.content, existing_traits_list)
+        is_local = not analysis_result
+        if is_local:
+            if not LOCAL_FALLBACK_ENABLED:
+                raise HTTPException(status_code=500, detail="AI Analysis Failed")
+            # 키가 모두 소진됨: 재시도 폭주를 막기 위해 임시 분석으로 저장하고 재분석은 큐에 맡김
+            analysis_result = local_heuristic_analysis(request.content, existing_traits_list)
+            analysis_model = LOCAL_ANALYSIS_MODEL
+            LOCAL_FALLBACK_TOTAL.inc()
+            print(f"WARNING: Gemini unavailable; saving diary for {current_user} with local analysis")
 
         # 3. 결과 파싱
         new_big5 = analysis_result.get("big5") or {}
-        new_ai_keywords = analysis_result.get("keywords") or []
+        # 임시 분석의 키워드는 화면에만 보여주고 특성 통계에는 넣지 않음 (가져온 일기의 대기 항목과 동일)
+        new_ai_keywords = [] if is_local else analysis_result.get("keywords") or []
 
         # 사건 요약 추출 (없으면 one_liner라도 가져와서 채움)
         extracted_event = analysis_result.get("event_summary", "")
@@ -764,6 +2959,7 @@ async def analyze_and_save(request: DiaryRequest, background_tasks: BackgroundTa
             "mood": request.mood,
             "weather": request.weather,
             "tags": request.tags,
+            "clean_text": clean_diary_text(request.content),
             "is_temporary": False,
             "event_summary": extracted_event,
             "analysis": analysis_result.get("analysis"),
@@ -771,30 +2967,58 @@ async def analyze_and_save(request: DiaryRequest, background_tasks: BackgroundTa
             "one_liner": analysis_result.get("one_liner"),
             "big5_snapshot": new_big5,
             "keywords_snapshot": new_ai_keywords,
+            "analysis_model": analysis_model, # 품질 감사용: 실제 분석한 모델
+            "analysis_source": "local" if is_local else "gemini",
+            "analysis_status": "queued" if is_local else "fresh",
             "updated_at": datetime.utcnow()
         }
+        if is_local:
+            final_data["queued_at"] = datetime.utcnow()
+            final_data["analysis_attempts"] = 0
+        # 유사 일기 검색용 임베딩 (로컬 계산, 수 ms)
+        embedding = embed_text(diary_embedding_text(final_data))
+        final_data["embedding"] = embedding_to_binary(embedding)
 
         saved_id = None
         
         if request.diary_id and ObjectId.is_valid(request.diary_id):
-            diary_collection.update_one(
-                {"_id": ObjectId(request.diary_id), "user_id": current_user},
-                {"$set": final_data}
-            )
+            unarchive_diary(current_user, ObjectId(request.diary_id))  # 콜드 필드가 새 분석과 섞이지 않도록
+            # 이전 상태를 함께 받아 추이 롤업에서 기존 기여분을 빼기 위함
+            with sync_seq_slot(current_user) as seq:
+                final_data["sync_seq"] = seq
+                previous = diary_collection.find_one_and_update(
+                    {"_id": ObjectId(request.diary_id), "user_id": current_user},
+                    {"$set": final_data},
+                    projection={"user_id": 1, "is_temporary": 1, "entry_date": 1, "mood": 1, "big5_snapshot": 1, "tags": 1}
+                )
             saved_id = request.diary_id
+            if previous:
+                shift_trend_rollups(previous, final_data)
+                apply_tag_delta(current_user, previous.get("tags"), request.tags)
         else:
             final_data["created_at"] = datetime.utcnow()
-            result = diary_collection.insert_one(final_data)
+            with sync_seq_slot(current_user) as seq:
+                final_data["sync_seq"] = seq
+                result = diary_collection.insert_one(final_data)
             saved_id = str(result.inserted_id)
+            shift_trend_rollups(None, final_data)
+            apply_tag_delta(current_user, None, request.tags)
+        similarity_index.upsert(current_user, saved_id, embedding)
 
         # ---------------------------------------------------------
         # [핵심] 무거운 통계 업데이트는 "나중에 해!" 하고 넘겨버림
         # ---------------------------------------------------------
-        background_tasks.add_task(update_user_stats_bg, current_user, new_ai_keywords, request.tags, new_big5)
+        user_stats_cache.invalidate(current_user)
+        add_tracked_task(background_tasks, update_user_stats_bg, current_user, new_ai_keywords, new_big5)
 
         # 5. 사용자에게 바로 응답 (통계 업데이트 기다리지 않음!)
-        return {"status": "success", "message": "저장 완료", "diary_id": saved_id, "analysis": analysis_result}
+        return TimedJSONResponse({
+            "status": "success", "message": "저장 완료", "diary_id": saved_id, "analysis": analysis_result,
+            "analysis_source": final_data["analysis_source"], "reanalysis_queued": is_local
+        })
 
+    except HTTPException as http_ex:
+        raise http_ex
     except Exception as e:
         print(f"Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -802,48 +3026,73 @@ async def analyze_and_save(request: DiaryRequest, background_tasks: BackgroundTa
 
 # --- [API 2] 일기 수정 ---
 @app.patch("/diaries/{diary_id}")
-async def update_diary_content(diary_id: str, request: DiaryUpdateRequest, current_user: str = Depends(get_current_user)):
+async def update_diary_content(diary_id: str, request: DiaryUpdateRequest, background_tasks: BackgroundTasks, current_user: str = Depends(get_current_user)):
     try:
         if not ObjectId.is_valid(diary_id):
             raise HTTPException(status_code=400, detail="Invalid ID")
 
+        unarchive_diary(current_user, ObjectId(diary_id))  # 오래된 일기를 고치면 다시 핫 데이터로
         old_diary = diary_collection.find_one({"_id": ObjectId(diary_id), "user_id": current_user})
         if not old_diary:   raise HTTPException(status_code=404, detail="Diary not found")
 
         update_fields = {"updated_at": datetime.utcnow()}
         if request.title is not None: update_fields["title"] = request.title # [NEW] 제목 수정
-        if request.content is not None: update_fields["content"] = request.content
+        if request.content is not None:
+            update_fields["content"] = request.content
+            update_fields["clean_text"] = clean_diary_text(request.content)
         if request.entry_date is not None: update_fields["entry_date"] = request.entry_date
         if request.entry_time is not None: update_fields["entry_time"] = request.entry_time
         if request.mood is not None: update_fields["mood"] = request.mood
         if request.weather is not None: update_fields["weather"] = request.weather
+
+        # 본문이 의미 있게 바뀐 최종 일기만 재분석 (오타 수정 등은 기존 분석 유지)
+        reanalysis_queued = False
+        if request.content is not None and not old_diary.get("is_temporary", False) and old_diary.get("analysis"):
+            text_change, images_changed = content_change_score(old_diary.get("content", ""), request.content)
+            if text_change >= REANALYZE_MIN_CHANGE or images_changed:
+                # 지연 분석 큐에 올려 두고, 속도 제한 안쪽이면 바로 한 번 시도 (실패/재시작/속도 제한은 큐가 다시 처리)
+                update_fields.update({"analysis_status": "queued", "queued_at": datetime.utcnow(), "analysis_attempts": 0})
+                if rate_limiter.acquire(current_user, "analyze") == 0:
+                    add_tracked_task(background_tasks, reanalyze_diary_bg, current_user, diary_id, request.content)
+                reanalysis_queued = True
         
         if request.tags is not None:
-            old_tags = old_diary.get("tags", [])
-            new_tags = request.tags
-            
-            if set(old_tags) != set(new_tags):
-                user_profile = user_collection.find_one({"user_id": current_user})
-                if user_profile:
-                    tag_counts = Counter(user_profile.get("user_tag_counts", {}))
-                    tag_counts.subtract(old_tags)
-                    tag_counts.update(new_tags)
-                    tag_counts = {k: v for k, v in tag_counts.items() if v > 0}
-                    
-                    user_collection.update_one(
-                        {"user_id": current_user},
-                        {"$set": {"user_tag_counts": tag_counts}}
-                    )
-            update_fields["tags"] = new_tags
-
-        diary_collection.update_one({"_id": ObjectId(diary_id)}, {"$set": update_fields})
-        return {"status": "success", "message": "Updated successfully"}
+            update_fields["tags"] = request.tags
+
+        embedding = None
+        if not old_diary.get("is_temporary", False) and ("content" in update_fields or "title" in update_fields):
+            embedding = embed_text(diary_embedding_text({**old_diary, **update_fields}))
+            update_fields["embedding"] = embedding_to_binary(embedding)
+
+        with sync_seq_slot(current_user) as seq:
+            update_fields["sync_seq"] = seq
+            diary_collection.update_one({"_id": ObjectId(diary_id)}, {"$set": update_fields})
+        if "tags" in update_fields:
+            apply_tag_delta(current_user, old_diary.get("tags"), update_fields["tags"])
+        if embedding is not None:
+            similarity_index.upsert(current_user, diary_id, embedding)
+        if "entry_date" in update_fields or "mood" in update_fields:
+            shift_trend_rollups(old_diary, {**old_diary, **update_fields})
+        user_stats_cache.invalidate(current_user)
+        return {"status": "success", "message": "Updated successfully", "reanalysis_queued": reanalysis_queued}
     except Exception as e: raise HTTPException(status_code=500, detail=str(e))
 
 # --- [API 3] 유저 정보 조회 ---
 @app.get("/user/stats")
-async def get_user_stats(current_user: str = Depends(get_current_user)):
-    user_profile = user_collection.find_one({"user_id": current_user})
+async def get_user_stats(request: Request, current_user: str = Depends(get_current_user)):
+    # 캐시 적중 시 DB 조회 없이 응답 (ETag가 같으면 304)
+    cached = user_stats_cache.get(current_user)
+    if cached:
+        payload, etag = cached[0], cached[1]
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        return TimedJSONResponse(content=payload, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+    # 응답에 필요한 필드만 조회 (비밀번호 해시, 음악 목록 등 제외)
+    user_profile = user_collection.find_one(
+        {"user_id": current_user},
+        {"user_id": 1, "joined_at": 1, "big5_scores": 1, "trait_counts": 1, "user_tag_counts": 1, "life_map_usage": 1, "stats_epoch": 1}
+    )
     if not user_profile:
         return {"user_id": current_user, "message": "New User", "mood_stats": {"week": {}, "month": {}, "all": {}}}
 
@@ -855,7 +3104,6 @@ async def get_user_stats(current_user: str = Depends(get_current_user)):
 
     # 기분 통계 계산 함수 호출
     mood_stats = calculate_mood_statistics(current_user)
-    user_profile["_id"] = str(user_profile["_id"])
 
     # 총괄 리포트 사용량 로직
     current_month = datetime.utcnow().strftime("%Y-%m")
@@ -863,19 +3111,168 @@ async def get_user_stats(current_user: str = Depends(get_current_user)):
     if usage_data["month"] != current_month:
         usage_data = {"month": current_month, "count": 0}
 
-    print(f"DEBUG: user_profile found for {current_user}") 
-    print(f"DEBUG: service_days = {service_days}")
-
-    return {
+    payload = {
         "user_id": user_profile["user_id"],
         "big5_scores": user_profile.get("big5_scores", get_default_big5()),
-        "ai_trait_counts": user_profile.get("trait_counts", {}),
-        "user_tag_counts": user_profile.get("user_tag_counts", {}),
+        "ai_trait_counts": positive_trait_counts(user_profile.get("trait_counts")),
+        "user_tag_counts": positive_trait_counts(user_profile.get("user_tag_counts")),
         "service_days": service_days,
         "mood_stats": mood_stats,
         "life_map_usage": usage_data,           # 현재 사용량 전달
         "life_map_limit": LIFE_MAP_MONTHLY_LIMIT # 전체 한도 전달
     }
+    etag = user_stats_cache.set(current_user, payload, user_profile.get("stats_epoch", 0))
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return TimedJSONResponse(content=payload, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+# --- [API 3.1] Big5 프로필 재계산 (전체 스냅샷 기반) ---
+@app.post("/user/big5/recompute")
+async def recompute_user_big5(current_user: str = Depends(get_current_user)):
+    try:
+        big5_scores = recompute_big5_profile(current_user)
+        user_stats_cache.invalidate(current_user)
+        return {"status": "success", "big5_scores": big5_scores}
+    except Exception as e:
+        print(f"Error in recompute_user_big5: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# --- [API 3.2] Big5 / 기분 추이 (롤업 조회) ---
+@app.get("/user/trends")
+async def get_user_trends(
+    granularity: str = "week",
+    from_date: Optional[str] = Query(None, alias="from"),
+    to_date: Optional[str] = Query(None, alias="to"),
+    current_user: str = Depends(get_current_user)
+):
+    if granularity not in TREND_GRANULARITIES:
+        raise HTTPException(status_code=400, detail="granularity must be 'day' or 'week'")
+
+    query = {"user_id": current_user, "granularity": granularity}
+    period_range = {}
+    if from_date:
+        periods = trend_periods(from_date)
+        if not periods: raise HTTPException(status_code=400, detail="Invalid 'from' date (YYYY-MM-DD)")
+        period_range["$gte"] = periods[granularity]
+    if to_date:
+        periods = trend_periods(to_date)
+        if not periods: raise HTTPException(status_code=400, detail="Invalid 'to' date (YYYY-MM-DD)")
+        period_range["$lte"] = periods[granularity]
+    if period_range:
+        query["period"] = period_range
+
+    points = []
+    for doc in trend_collection.find(query, {"_id": 0, "user_id": 0}).sort("period", 1):
+        if doc.get("count", 0) <= 0:
+            continue
+        big5_sum, big5_n = doc.get("big5_sum") or {}, doc.get("big5_n") or {}
+        big5_avg = {}
+        for factor, facets in BIG5_FACETS.items():
+            factor_avg = {}
+            for facet in facets:
+                n = (big5_n.get(factor) or {}).get(facet, 0)
+                if n > 0:
+                    factor_avg[facet] = round(big5_sum[factor][facet] / n, 2)
+            if factor_avg:
+                big5_avg[factor] = factor_avg
+        points.append({
+            "period": doc["period"],
+            "diary_count": doc["count"],
+            "mood_counts": {k: v for k, v in (doc.get("mood_counts") or {}).items() if v > 0},
+            "big5_avg": big5_avg
+        })
+
+    return {"granularity": granularity, "points": points}
+
+# --- [API 3.3] 추이 롤업 재생성 (과거 데이터) ---
+@app.post("/user/trends/rebuild")
+async def rebuild_user_trends(background_tasks: BackgroundTasks, current_user: str = Depends(get_current_user)):
+    add_tracked_task(background_tasks, rebuild_trend_rollups_bg, current_user)
+    return {"status": "accepted", "message": "Trend rollups are being rebuilt."}
+
+# --- [Helper] 인생 지도 컨텍스트 구성 (수동 요청 & 정기 배치 공용) ---
+def load_life_map_diaries(user_id: str) -> List[dict]:
+    # 필요한 필드(특히 analysis)만 가져와서 최적화
+    cursor = diary_collection.find(
+        {"user_id": user_id},
+        {
+            "entry_date": 1, 
+            "content": 1, 
+            "mood": 1, 
+            "event_summary": 1,
+            "keywords_snapshot": 1, 
+            "one_liner": 1,
+            "analysis": 1, # [핵심] 심리 분석 데이터 포함
+            "archived": 1
+        }
+    ).sort("entry_date", 1)
+    return merge_archived_fields(cursor)
+
+def build_life_map_context(diaries: List[dict]) -> str:
+    full_context = "--- User's Life Timeline ---\n"
+    for d in diaries:
+        date_str = d.get("entry_date", "Unknown")
+        mood = d.get("mood", "Neutral")
+        
+        # (1) 사건 정보 추출
+        event_text = d.get("event_summary")
+        if not event_text:
+            event_text = d.get("one_liner")
+        if not event_text:
+            event_text = d.get("content", "")[:50] + "..." 
+
+        # (2) 심리 정보 추출 [수정됨: Theme 4 포함!]
+        analysis_data = d.get("analysis", {})
+        if analysis_data:
+            # 감정 흐름 / 핵심 신념 / 행동 패턴까지 모두 포함
+            psych_text = (
+                f"Emotion: {analysis_data.get('theme1', '')} / "
+                f"Belief: {analysis_data.get('theme2', '')} / "
+                f"Pattern: {analysis_data.get('theme4', '')}"
+            )
+        else:
+            psych_text = f"Summary: {d.get('one_liner', 'No deep analysis')}"
+
+        # (3) AI에게 줄 최종 라인 조립
+        line = f"Date: {date_str} | Mood: {mood} | [EVENT]: {event_text} | [PSYCHOLOGY]: {psych_text}"
+        
+        full_context += line + "\n"
+    return full_context
+
+def save_life_report(user_id: str, report_result: dict, diary_count: int, source: str):
+    """리포트 저장. source: "manual"(유저 요청) / "scheduled"(정기 배치)"""
+    now = datetime.utcnow()
+    report_collection.insert_one({
+        "user_id": user_id,
+        "created_at": now,
+        "period_type": "ALL_TIME_EVENT_CENTERED", 
+        "diary_count": diary_count,
+        "source": source,
+        "result": report_result
+    })
+    user_collection.update_one({"user_id": user_id}, {"$set": {"last_report_at": now}})
+
+# --- [Helper] 인생 지도 월간 사용량 (워커 간 공유 카운터) ---
+def reserve_life_map_usage(user_id: str, month: str) -> Optional[int]:
+    """이번 달 사용 횟수를 한도 안에서 원자적으로 1 늘리고 새 횟수를 반환. 한도를 다 썼으면 None"""
+    # 달이 바뀌었으면 먼저 초기화 (이미 이번 달이면 조건에 걸리지 않으므로 동시에 실행돼도 한 번만 적용)
+    user_collection.update_one(
+        {"user_id": user_id, "life_map_usage.month": {"$ne": month}},
+        {"$set": {"life_map_usage": {"month": month, "count": 0}}}
+    )
+    user = user_collection.find_one_and_update(
+        {"user_id": user_id, "life_map_usage.month": month, "life_map_usage.count": {"$lt": LIFE_MAP_MONTHLY_LIMIT}},
+        {"$inc": {"life_map_usage.count": 1}},
+        projection={"life_map_usage": 1},
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    return user["life_map_usage"]["count"] if user else None
+
+def release_life_map_usage(user_id: str, month: str):
+    user_collection.update_one(
+        {"user_id": user_id, "life_map_usage.month": month, "life_map_usage.count": {"$gt": 0}},
+        {"$inc": {"life_map_usage.count": -1}}
+    )
 
 # --- [API 4] 인생 지도 분석 (Timeline-Flow: 과거 vs 현재 균형 분석) ---
 @app.post("/analyze-life-map")
@@ -884,96 +3281,46 @@ async def analyze_life_map(request: LifeMapRequest, current_user: str = Depends(
         print(f"INFO: Starting Life Map analysis for {current_user}")
 
         # ▼▼▼ [NEW] 0. 유저 및 사용량 확인 & 제한 체크 ▼▼▼
-        user = user_collection.find_one({"user_id": current_user})
+        user = user_collection.find_one({"user_id": current_user}, {"_id": 1})
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
+        # 사용 횟수를 먼저 원자적으로 1 올려 자리를 확보 (여러 워커에서 동시에 요청해도 한도를 넘지 않음)
         current_month = datetime.utcnow().strftime("%Y-%m")
-        usage_data = user.get("life_map_usage", {"month": current_month, "count": 0})
-
-        # 월이 바뀌었으면 초기화
-        if usage_data["month"] != current_month:
-            usage_data = {"month": current_month, "count": 0}
+        new_count = reserve_life_map_usage(current_user, current_month)
 
         # 횟수 제한 체크 (이미 다 썼으면 429 에러)
-        if usage_data["count"] >= LIFE_MAP_MONTHLY_LIMIT:
+        if new_count is None:
              raise HTTPException(
                 status_code=429, # Too Many Requests
                 detail=f"이번 달 총괄 리포트 생성 한도({LIFE_MAP_MONTHLY_LIMIT}회)를 초과했습니다."
             )
 
-        # 1. 모든 일기 가져오기 (오래된 순)
-        # 필요한 필드(특히 analysis)만 가져와서 최적화
-        cursor = diary_collection.find(
-            {"user_id": current_user},
-            {
-                "entry_date": 1, 
-                "content": 1, 
-                "mood": 1, 
-                "event_summary": 1,
-                "keywords_snapshot": 1, 
-                "one_liner": 1,
-                "analysis": 1, # [핵심] 심리 분석 데이터 포함
-                "_id": 0
-            }
-        ).sort("entry_date", 1)
-        diaries = list(cursor)
-
-        if not diaries: return {"status": "error", "message": "분석할 일기가 없습니다."}
-        if len(diaries) < 3: return {"status": "fail", "message": "데이터가 너무 적습니다. 최소 3개 이상의 일기가 필요합니다."}
-
-        # 2. [Context Building] 사건(Fact)과 심리(Feeling)의 분리 구성
-        full_context = "--- User's Life Timeline ---\n"
-        for d in diaries:
-            date_str = d.get("entry_date", "Unknown")
-            mood = d.get("mood", "Neutral")
-            
-            # (1) 사건 정보 추출
-            event_text = d.get("event_summary")
-            if not event_text:
-                event_text = d.get("one_liner")
-            if not event_text:
-                event_text = d.get("content", "")[:50] + "..." 
-
-            # (2) 심리 정보 추출 [수정됨: Theme 4 포함!]
-            analysis_data = d.get("analysis", {})
-            if analysis_data:
-                # 감정 흐름 / 핵심 신념 / 행동 패턴까지 모두 포함
-                psych_text = (
-                    f"Emotion: {analysis_data.get('theme1', '')} / "
-                    f"Belief: {analysis_data.get('theme2', '')} / "
-                    f"Pattern: {analysis_data.get('theme4', '')}"
-                )
-            else:
-                psych_text = f"Summary: {d.get('one_liner', 'No deep analysis')}"
+        # 리포트를 저장하지 못하면 확보한 사용 횟수를 돌려줌 (성공 시에만 차감)
+        reserved = True
+        try:
+            # 1. 모든 일기 가져오기 (오래된 순)
+            diaries = load_life_map_diaries(current_user)
 
-            # (3) AI에게 줄 최종 라인 조립
-            line = f"Date: {date_str} | Mood: {mood} | [EVENT]: {event_text} | [PSYCHOLOGY]: {psych_text}"
-            
-            full_context += line + "\n"
+            if not diaries: return {"status": "error", "message": "분석할 일기가 없습니다."}
+            if len(diaries) < 3: return {"status": "fail", "message": "데이터가 너무 적습니다. 최소 3개 이상의 일기가 필요합니다."}
 
-        # 3. Gemini 분석 요청
-        report_result = await get_long_term_analysis_rag(full_context, len(diaries))
+            # 2. [Context Building] 사건(Fact)과 심리(Feeling)의 분리 구성
+            full_context = build_life_map_context(diaries)
 
-        if not report_result:
-             raise HTTPException(status_code=500, detail="Gemini generated an empty report.")
+            # 3. Gemini 분석 요청
+            report_result = await get_long_term_analysis_rag(full_context, len(diaries))
 
-        # 4. 저장
-        report_data = {
-            "user_id": current_user,
-            "created_at": datetime.utcnow(),
-            "period_type": "ALL_TIME_EVENT_CENTERED", 
-            "diary_count": len(diaries),
-            "result": report_result
-        }
-        db["life_reports"].insert_one(report_data)
+            if not report_result:
+                 raise HTTPException(status_code=500, detail="Gemini generated an empty report.")
 
-        # ▼▼▼ 사용 횟수 1 증가 (성공 시에만 DB 업데이트) ▼▼▼
-        new_count = usage_data["count"] + 1
-        user_collection.update_one(
-            {"user_id": current_user},
-            {"$set": {"life_map_usage": {"month": current_month, "count": new_count}}}
-        )
+            # 4. 저장
+            save_life_report(current_user, report_result, len(diaries), source="manual")
+            reserved = False
+        finally:
+            if reserved:
+                release_life_map_usage(current_user, current_month)
+        user_stats_cache.invalidate(current_user)
 
         return {
             "status": "success",
@@ -982,6 +3329,8 @@ async def analyze_life_map(request: LifeMapRequest, current_user: str = Depends(
             "usage": {"current": new_count, "limit": LIFE_MAP_MONTHLY_LIMIT}
         }
 
+    except HTTPException as http_ex:
+        raise http_ex
     except Exception as e:
         print(f"CRITICAL ERROR: {e}")
         if "429" in str(e) or "한도" in str(e):
@@ -990,10 +3339,10 @@ async def analyze_life_map(request: LifeMapRequest, current_user: str = Depends(
 
 @app.get("/life-map")
 async def get_life_map(current_user: str = Depends(get_current_user)):
-    report = db["life_reports"].find_one({"user_id": current_user}, sort=[("created_at", -1)])
+    # 정기 배치가 미리 만들어 둔 리포트도 여기서 바로 반환됩니다.
+    report = report_collection.find_one({"user_id": current_user}, sort=[("created_at", -1)])
     if not report: return {"status": "empty"}
-    report["_id"] = str(report["_id"])
-    return report
+    return TimedJSONResponse(report)
 
 # --- [API 5] 음악 파일 업로드 (덮어쓰기 모드) ---
 @app.post("/user/music/upload")
@@ -1010,11 +3359,7 @@ async def upload_music(
         if len(file_content) > 15 * 1024 * 1024:
             raise HTTPException(status_code=413, detail="File too large. Limit is 15MB.")
 
-        # [NEW] 1. 기존 음악 삭제 (덮어쓰기 효과)
-        # 이 유저가 올린 음악이 있다면 싹 지웁니다.
-        music_collection.delete_many({"user_id": current_user})
-
-        # 2. 새 음악 저장
+        # 1. 새 음악 저장
         music_doc = {
             "user_id": current_user,
             "title": title,
@@ -1027,6 +3372,8 @@ async def upload_music(
         
         result = music_collection.insert_one(music_doc)
         new_music_id = str(result.inserted_id)
+        # 2. 기존 음악은 만료 표시만 (덮어쓰기 효과, 실제 삭제는 TTL 인덱스가 유예 후 처리)
+        retire_superseded_files(music_collection, current_user, keep_id=result.inserted_id)
         
         return {
             "status": "success", 
@@ -1052,7 +3399,7 @@ async def stream_music(music_id: str):
 async def get_user_music_list(current_user: str = Depends(get_current_user)):
     try:
         # file_data 제외하고 가져오기 (속도 향상)
-        cursor = music_collection.find({"user_id": current_user}, {"file_data": 0})
+        cursor = music_collection.find({"user_id": current_user, "expires_at": {"$exists": False}}, {"file_data": 0})
         user_musics = []
         for doc in cursor:
             # 재생 URL 생성
@@ -1073,14 +3420,291 @@ async def get_user_music_list(current_user: str = Depends(get_current_user)):
     except Exception as e: raise HTTPException(status_code=500, detail=str(e))
 
 # --- [API 8] 일기 목록 ---
+# 서버 전용 필드(유사도 임베딩, 검색 색인용 clean_text)는 클라이언트에 내려주지 않음
+DIARY_RESPONSE_EXCLUDED_FIELDS = {"embedding": 0, "clean_text": 0}
+
 @app.get("/diaries")
 async def get_user_diaries(current_user: str = Depends(get_current_user)):
-    cursor = diary_collection.find({"user_id": current_user}).sort("entry_date", -1)
-    diaries = []
-    for doc in cursor:
+    # Mongo 문서를 그대로 orjson으로 렌더링 (ObjectId / datetime 변환 루프와 jsonable_encoder 생략)
+    cursor = diary_collection.find({"user_id": current_user}, DIARY_RESPONSE_EXCLUDED_FIELDS).sort("entry_date", -1)
+    return TimedJSONResponse({"diaries": merge_archived_fields(cursor)})
+
+# --- [Helper] 일기 내보내기 / 가져오기 (NDJSON) ---
+EXPORT_EXCLUDED_FIELDS = {"embedding": 0, "clean_text": 0, "sync_seq": 0, "user_id": 0}
+IMPORT_ANALYSIS_FIELDS = ["event_summary", "analysis", "recommend", "one_liner", "big5_snapshot", "keywords_snapshot"]
+
+def _export_default(value):
+    if isinstance(value, ObjectId): return str(value)
+    if isinstance(value, datetime): return value.isoformat()
+    raise TypeError(f"Unserializable: {type(value)}")
+
+def iter_diary_export(user_id: str):
+    """Mongo 커서에서 한 줄씩 바로 NDJSON으로 변환 (전체를 메모리에 올리지 않음)"""
+    cursor = diary_collection.find({"user_id": user_id}, EXPORT_EXCLUDED_FIELDS, batch_size=200).sort("entry_date", 1)
+    for doc in iter_merge_archived_fields(cursor):
+        yield json.dumps(doc, ensure_ascii=False, default=_export_default) + "\n"
+
+def _imported_names(entry: dict, field: str) -> List[str]:
+    """tags / keywords_snapshot 은 user_tag_counts / trait_counts 의 필드 경로가 되므로 줄마다 미리 검사"""
+    names = entry.get(field) or []
+    if not isinstance(names, list) or not all(isinstance(n, str) for n in names):
+        raise ValueError(f"'{field}' must be a list of strings")
+    try:
+        return [validate_tag_name(n) for n in names]
+    except HTTPException as e:
+        raise ValueError(f"'{field}': {e.detail}")
+
+def _imported_diary(user_id: str, entry: dict, now: datetime) -> dict:
+    content = entry.get("content")
+    if not isinstance(content, str) or not content.strip():
+        raise ValueError("'content' is required")
+    tags = _imported_names(entry, "tags")
+
+    doc = {
+        "user_id": user_id,
+        "title": entry.get("title"),
+        "content": content,
+        "entry_date": entry.get("entry_date"),
+        "entry_time": entry.get("entry_time"),
+        "mood": entry.get("mood"),
+        "weather": entry.get("weather"),
+        "tags": tags,
+        "clean_text": clean_diary_text(content),
+        "is_temporary": False,
+        "source": "import",
+        "created_at": now,
+        "updated_at": now,
+    }
+    if entry.get("analysis") and entry.get("big5_snapshot"):
+        # 우리 서비스에서 내보낸 백업: 기존 분석을 그대로 복원
+        doc.update({k: entry.get(k) for k in IMPORT_ANALYSIS_FIELDS})
+        doc["keywords_snapshot"] = _imported_names(entry, "keywords_snapshot")
+        doc["analysis_status"] = "fresh"
+    else:
+        # 다른 앱에서 옮겨온 일기: 분석은 큐에서 천천히
+        doc.update({"keywords_snapshot": [], "analysis_status": "queued", "queued_at": now})
+    doc["embedding"] = embedding_to_binary(embed_text(diary_embedding_text(doc)))
+    return doc
+
+def import_diaries_ndjson(user_id: str, stream) -> dict:
+    """NDJSON 스트림을 IMPORT_BATCH_SIZE 단위 insert_many로 저장합니다. (스레드 풀에서 실행)"""
+    now = datetime.utcnow()
+    batch, errors = [], []
+    summary = {"imported": 0, "queued_for_analysis": 0, "restored_with_analysis": 0, "skipped": 0}
+    tag_counter, keyword_counter = Counter(), Counter()
+
+    def flush():
+        if not batch:
+            return
+        with sync_seq_slot(user_id) as sync_seq:
+            for doc in batch:
+                doc["sync_seq"] = sync_seq
+            diary_collection.insert_many(batch, ordered=False)
+        ops = [op for doc in batch for op in trend_rollup_ops(doc, 1)]
+        if ops:
+            trend_collection.bulk_write(ops, ordered=False)
+        batch.clear()
+
+    for line_no, raw_line in enumerate(stream, start=1):
+        line = raw_line.decode("utf-8").strip() if isinstance(raw_line, bytes) else raw_line.strip()
+        if not line:
+            continue
+        if summary["imported"] >= IMPORT_MAX_ENTRIES:
+            errors.append({"line": line_no, "error": f"Import limit ({IMPORT_MAX_ENTRIES}) reached"})
+            break
+        try:
+            doc = _imported_diary(user_id, json.loads(line), now)
+        except (ValueError, AttributeError) as e:
+            summary["skipped"] += 1
+            if len(errors) < 20:
+                errors.append({"line": line_no, "error": str(e)})
+            continue
+
+        batch.append(doc)
+        summary["imported"] += 1
+        tag_counter.update(set(doc["tags"]))
+        if doc["analysis_status"] == "queued":
+            summary["queued_for_analysis"] += 1
+        else:
+            summary["restored_with_analysis"] += 1
+            keyword_counter.update(doc.get("keywords_snapshot") or [])
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            flush()
+    flush()
+
+    # 통계는 마지막에 한 번에 반영 (복원된 분석의 키워드는 프롬프트용 trait_index 에도)
+    update = trait_delta_update(user_id, list(keyword_counter.elements()), [])
+    tag_inc = {f"user_tag_counts.{k}": v for k, v in tag_counter.items()}
+    if tag_inc:
+        update.setdefault("$inc", {}).update(tag_inc)
+    if update:
+        user_collection.update_one({"user_id": user_id}, update)
+    if summary["restored_with_analysis"]:
+        recompute_big5_profile(user_id)
+    similarity_index.drop(user_id)
+    user_stats_cache.invalidate(user_id)
+    summary["errors"] = errors
+    return summary
+
+# --- [API 8.3] 일기 전체 내보내기 (NDJSON 스트리밍) ---
+@app.get("/export")
+def export_diaries(current_user: str = Depends(get_current_user)):
+    filename = f"onion_diaries_{datetime.utcnow():%Y%m%d}.ndjson"
+    return StreamingResponse(
+        iter_diary_export(current_user),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+# --- [API 8.4] 일기 대량 가져오기 (NDJSON, 분석은 백그라운드 큐) ---
+@app.post("/import")
+async def import_diaries(file: UploadFile = File(...), current_user: str = Depends(get_current_user)):
+    try:
+        # 업로드 파일은 디스크에 임시 저장되어 있으므로 줄 단위로 읽어도 메모리를 많이 쓰지 않음
+        summary = await run_in_threadpool(import_diaries_ndjson, current_user, file.file)
+        return {"status": "success", **summary}
+    except Exception as e:
+        print(f"Error in import_diaries: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# --- [API 8.2] 증분 동기화 (오프라인 우선 모바일 클라이언트용) ---
+@app.get("/sync")
+async def sync_diaries(since: Optional[str] = None, current_user: str = Depends(get_current_user)):
+    """
+    since 없음(또는 너무 오래된 커서): 전체 일기 + 새 커서 (full_resync=True)
+    since 있음: 그 이후 생성/수정된 일기와 삭제된 일기 ID만 sync_seq 순서로 반환
+    """
+    full_resync = since is None
+    since_seq = 0
+    if since is not None:
+        since_seq, issued_at = decode_sync_cursor(since)
+        # 삭제 기록이 만료됐을 수 있는 오래된 커서는 전체 재동기화
+        if time.time() - issued_at > SYNC_TOMBSTONE_RETENTION_DAYS * 86400:
+            full_resync = True
+
+    # 조회 전에 커서 상한을 읽어두면, 조회 중 일어난 변경은 다음 동기화에서 받게 됨
+    # 상한 = 아직 저장 중인 쓰기가 없는 마지막 번호 (그보다 큰 번호는 이번에 내주지 않음)
+    user = user_collection.find_one({"user_id": current_user}, SYNC_CURSOR_FIELDS) or {"user_id": current_user}
+    safe_seq = committed_sync_seq(user)
+
+    if full_resync:
+        current_seq = safe_seq
+        changes = merge_archived_fields(diary_collection.find({"user_id": current_user}, DIARY_RESPONSE_EXCLUDED_FIELDS))
+        return TimedJSONResponse({"full_resync": True, "changes": changes, "deleted": [], "next_cursor": encode_sync_cursor(current_seq), "has_more": False})
+
+    # 변경분과 삭제 기록을 각각 번호 순으로 한 페이지씩 읽고 합쳐서 앞쪽 한 페이지만 반환
+    seq_range = {"$gt": since_seq, "$lte": safe_seq}
+    changed_docs = list(diary_collection.find(
+        {"user_id": current_user, "sync_seq": seq_range}, DIARY_RESPONSE_EXCLUDED_FIELDS
+    ).sort("sync_seq", 1).limit(SYNC_PAGE_SIZE + 1))
+    tombstones = list(tombstone_collection.find(
+        {"user_id": current_user, "sync_seq": seq_range}, {"_id": 0, "diary_id": 1, "sync_seq": 1}
+    ).sort("sync_seq", 1).limit(SYNC_PAGE_SIZE + 1))
+
+    events = sorted(
+        [("change", d["sync_seq"], d) for d in changed_docs] + [("delete", t["sync_seq"], t) for t in tombstones],
+        key=lambda e: e[1]
+    )
+    has_more = len(events) > SYNC_PAGE_SIZE
+    if has_more:
+        # 같은 번호(태그 일괄 변경 등)가 페이지 경계에서 잘리지 않도록 마지막 번호는 통째로 다음 페이지로
+        boundary_seq = events[SYNC_PAGE_SIZE][1]
+        events = [e for e in events[:SYNC_PAGE_SIZE] if e[1] < boundary_seq]
+        if not events:
+            # 한 번호에 페이지보다 많은 변경이 몰린 경우: 그 번호는 한 번에 전부 내려줌
+            events = [("change", boundary_seq, d) for d in diary_collection.find(
+                {"user_id": current_user, "sync_seq": boundary_seq}, DIARY_RESPONSE_EXCLUDED_FIELDS
+            )] + [("delete", boundary_seq, t) for t in tombstone_collection.find(
+                {"user_id": current_user, "sync_seq": boundary_seq}, {"_id": 0, "diary_id": 1, "sync_seq": 1}
+            )]
+
+    changes, deleted = [], []
+    for kind, _, payload in events:
+        if kind == "change":
+            changes.append(payload)
+        else:
+            deleted.append(payload["diary_id"])
+    changes = merge_archived_fields(changes)
+    # 삭제 후 같은 ID가 다시 생길 수는 없으므로 두 목록은 겹치지 않음
+    last_seq = events[-1][1] if events else since_seq
+    return TimedJSONResponse({"full_resync": False, "changes": changes, "deleted": deleted, "next_cursor": encode_sync_cursor(last_seq), "has_more": has_more})
+
+# --- [API 8.0] 일기 검색 (전문 검색 + 관련도 순 + 커서 페이지네이션) ---
+@app.get("/diaries/search")
+async def search_diaries(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=50),
+    cursor: Optional[str] = None,
+    from_date: Optional[str] = Query(None, alias="from"),
+    to_date: Optional[str] = Query(None, alias="to"),
+    mood: Optional[str] = None,
+    tag: Optional[str] = None,
+    current_user: str = Depends(get_current_user)
+):
+    match = {"user_id": current_user, "$text": {"$search": q}}
+    date_range = {}
+    if from_date: date_range["$gte"] = from_date
+    if to_date: date_range["$lte"] = to_date
+    if date_range: match["entry_date"] = date_range
+    if mood: match["mood"] = mood
+    if tag: match["tags"] = tag
+
+    pipeline = [
+        {"$match": match},
+        {"$addFields": {"score": {"$meta": "textScore"}}},
+    ]
+    # 키셋 페이지네이션: (점수, _id)가 이전 페이지 마지막 항목보다 "뒤"인 것만
+    if cursor:
+        last_score, last_id = decode_search_cursor(cursor)
+        pipeline.append({"$match": {"$or": [
+            {"score": {"$lt": last_score}},
+            {"score": last_score, "_id": {"$lt": last_id}}
+        ]}})
+    pipeline += [
+        {"$sort": {"score": -1, "_id": -1}},
+        {"$limit": limit + 1},
+        # 목록 화면에 필요한 요약 필드만
+        {"$project": {"title": 1, "entry_date": 1, "mood": 1, "tags": 1, "event_summary": 1, "one_liner": 1, "is_temporary": 1, "score": 1}}
+    ]
+
+    docs = list(diary_collection.aggregate(pipeline))
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    next_cursor = encode_search_cursor(docs[-1]["score"], docs[-1]["_id"]) if has_more else None
+    for doc in docs:
         doc["_id"] = str(doc["_id"])
-        diaries.append(doc)
-    return {"diaries": diaries}
+        doc["score"] = round(doc["score"], 4)
+    return {"results": docs, "next_cursor": next_cursor}
+
+# --- [API 8.1] 비슷한 날 찾기 (유사 일기) ---
+@app.get("/diaries/{diary_id}/similar")
+async def get_similar_diaries(diary_id: str, k: int = Query(5, ge=1, le=20), current_user: str = Depends(get_current_user)):
+    if not ObjectId.is_valid(diary_id):
+        raise HTTPException(status_code=400, detail="Invalid ID")
+    target = diary_collection.find_one({"_id": ObjectId(diary_id), "user_id": current_user})
+    if not target:
+        raise HTTPException(status_code=404, detail="Diary not found")
+
+    if target.get("embedding") is not None:
+        query_vec = binary_to_embedding(target["embedding"])
+    else:
+        query_vec = embed_text(diary_embedding_text(target))
+    matches = similarity_index.search(current_user, query_vec, k=k, exclude_ids=[diary_id])
+    if not matches:
+        return {"diary_id": diary_id, "similar": []}
+
+    scores = dict(matches)
+    docs = diary_collection.find(
+        {"_id": {"$in": [ObjectId(i) for i in scores]}, "user_id": current_user},
+        {"title": 1, "entry_date": 1, "mood": 1, "event_summary": 1, "one_liner": 1, "tags": 1}
+    )
+    similar = []
+    for doc in docs:
+        doc["_id"] = str(doc["_id"])
+        doc["score"] = scores[doc["_id"]]
+        similar.append(doc)
+    similar.sort(key=lambda d: d["score"], reverse=True)
+    return {"diary_id": diary_id, "similar": similar}
 
 # --- [API 5.5] 이미지 파일 업로드 ---
 @app.post("/user/image/upload")
@@ -1094,8 +3718,6 @@ async def upload_image(
         if len(file_content) > 5 * 1024 * 1024:
             raise HTTPException(status_code=413, detail="File too large. Limit is 5MB.")
 
-        image_collection.delete_many({"user_id": current_user})
-
         # 새 이미지 저장
         image_doc = {
             "user_id": current_user,
@@ -1107,6 +3729,8 @@ async def upload_image(
         
         # 'images'라는 별도 컬렉션에 저장
         result = image_collection.insert_one(image_doc)
+        # 이전 이미지는 만료 표시만 (실제 삭제는 TTL 인덱스가 유예 후 처리)
+        retire_superseded_files(image_collection, current_user, keep_id=result.inserted_id)
         
         return {
             "status": "success", 
@@ -1180,8 +3804,8 @@ async def reset_profile_image(current_user: str = Depends(get_current_user)): #
             {"$set": {"profile_image": ""}}
         )
         
-        # 기존에 업로드했던 이미지 파일도 삭제 (용량 절약)
-        image_collection.delete_many({"user_id": current_user})
+        # 기존에 업로드했던 이미지 파일도 만료 표시 (용량 절약, 실제 삭제는 TTL 인덱스)
+        retire_superseded_files(image_collection, current_user)
         
         return {
             "status": "success", 
@@ -1196,56 +3820,70 @@ async def reset_profile_image(current_user: str = Depends(get_current_user)): #
 async def delete_and_replace_tag(request: TagDeleteRequest, current_user: str = Depends(get_current_user)):
     try:
         # "unsorted" 태그 자체를 삭제하려는 경우 차단
-        if request.tag_name == "unsorted":
+        if request.tag_name == DEFAULT_TAG:
             raise HTTPException(status_code=400, detail="Cannot delete the default 'unsorted' tag.")
 
         print(f"INFO: Deleting tag '{request.tag_name}' for user {current_user}")
-
-        # 1. 유저 프로필(통계) 업데이트
-        # 삭제할 태그의 카운트를 가져와서 'unsorted'에 더해줍니다.
-        user = user_collection.find_one({"user_id": current_user})
-        if user:
-            tag_counts = user.get("user_tag_counts", {})
-            count_to_move = tag_counts.get(request.tag_name, 0)
-
-            if count_to_move > 0:
-                # (1) 기존 태그 삭제 ($unset) 및 (2) unsorted 카운트 증가 ($inc)
-                user_collection.update_one(
-                    {"user_id": current_user},
-                    {
-                        "$unset": {f"user_tag_counts.{request.tag_name}": ""},
-                        "$inc": {"user_tag_counts.unsorted": count_to_move}
-                    }
-                )
-
-        # 2. 일기 데이터 업데이트 (Bulk Update)
-        # 해당 태그를 가진 모든 일기를 찾아서 처리합니다.
-        
-        # 단계 2-1: 해당 태그가 있는 일기에 'unsorted' 태그 추가 ($addToSet은 중복 방지됨)
-        diary_collection.update_many(
-            {"user_id": current_user, "tags": request.tag_name},
-            {"$addToSet": {"tags": "unsorted"}}
-        )
-
-        # 단계 2-2: 해당 태그 삭제 ($pull)
-        result = diary_collection.update_many(
-            {"user_id": current_user, "tags": request.tag_name},
-            {"$pull": {"tags": request.tag_name}}
-        )
+        # 삭제 = 'unsorted'로 병합 (일기 bulk_write + 카운트 이동을 한 트랜잭션으로)
+        modified = run_tag_merge(current_user, [request.tag_name], DEFAULT_TAG)
+        user_stats_cache.invalidate(current_user)
 
         return {
             "status": "success", 
             "message": f"Tag '{request.tag_name}' replaced with 'unsorted'.",
-            "modified_diaries": result.modified_count
+            "modified_diaries": modified
         }
 
+    except HTTPException as http_ex:
+        raise http_ex
     except Exception as e:
         print(f"Error in delete_tag: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+
+# --- [API 10.1] 태그 이름 변경 (새 이름이 이미 있으면 자동 병합) ---
+@app.patch("/user/tags/rename")
+async def rename_tag(request: TagRenameRequest, current_user: str = Depends(get_current_user)):
+    try:
+        new_name = validate_tag_name(request.new_name)
+        if request.old_name == DEFAULT_TAG:
+            raise HTTPException(status_code=400, detail="Cannot rename the default 'unsorted' tag.")
+        modified = run_tag_merge(current_user, [request.old_name], new_name)
+        user_stats_cache.invalidate(current_user)
+        return {"status": "success", "message": f"Tag '{request.old_name}' renamed to '{new_name}'.", "modified_diaries": modified}
+    except HTTPException as http_ex:
+        raise http_ex
+    except Exception as e:
+        print(f"Error in rename_tag: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# --- [API 10.2] 여러 태그를 하나로 병합 ---
+@app.post("/user/tags/merge")
+async def merge_user_tags(request: TagMergeRequest, current_user: str = Depends(get_current_user)):
+    try:
+        target = validate_tag_name(request.target)
+        if not request.sources:
+            raise HTTPException(status_code=400, detail="No source tags given")
+        if DEFAULT_TAG in request.sources and target != DEFAULT_TAG:
+            raise HTTPException(status_code=400, detail="Cannot merge away the default 'unsorted' tag.")
+        modified = run_tag_merge(current_user, request.sources, target)
+        user_stats_cache.invalidate(current_user)
+        return {"status": "success", "message": f"Merged {len(request.sources)} tags into '{target}'.", "modified_diaries": modified}
+    except HTTPException as http_ex:
+        raise http_ex
+    except Exception as e:
+        print(f"Error in merge_tags: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# --- [API 10.3] 태그 카운트 재집계 (어긋난 user_tag_counts 복구) ---
+@app.post("/user/tags/recount")
+async def recount_tags(current_user: str = Depends(get_current_user)):
+    tag_counts = recount_user_tags(current_user)
+    user_stats_cache.invalidate(current_user)
+    return {"status": "success", "user_tag_counts": tag_counts}
     
-# --- [API 11] 일기 삭제 (Big5 유지, 태그 카운트 감소) ---
+# --- [API 11] 일기 삭제 (태그 카운트 감소, Big5 재계산) ---
 @app.delete("/diaries/{diary_id}")
-async def delete_diary(diary_id: str, current_user: str = Depends(get_current_user)):
+async def delete_diary(diary_id: str, background_tasks: BackgroundTasks, current_user: str = Depends(get_current_user)):
     try:
         # 1. ID 유효성 검사
         if not ObjectId.is_valid(diary_id):
@@ -1261,22 +3899,27 @@ async def delete_diary(diary_id: str, current_user: str = Depends(get_current_us
 
         # 3. 유저 태그 통계 업데이트
         tags_to_remove = target_diary.get("tags", [])
-        if tags_to_remove:
-            inc_update = {f"user_tag_counts.{tag}": -1 for tag in tags_to_remove}
-            user_collection.update_one(
-                {"user_id": current_user},
-                {"$inc": inc_update}
-            )
-            
-            # (선택 사항) 카운트가 0 이하가 된 태그 찌꺼기 청소
-            # 굳이 안 해도 되지만, DB를 깔끔하게 유지하고 싶다면 아래 주석 해제
-            # user_collection.update_one(
-            #     {"user_id": user_id},
-            #     {"$pull": {"user_tag_counts": {"$lte": 0}}} # 주의: 구조에 따라 쿼리 복잡해질 수 있음, 일단 생략 권장
-            # )
+        apply_tag_delta(current_user, tags_to_remove, None)
 
         # 4. 일기 데이터 삭제
         delete_result = diary_collection.delete_one({"_id": ObjectId(diary_id)})
+        if target_diary.get("archived"):
+            archive_collection.delete_one({"_id": ObjectId(diary_id)})
+        # 오프라인 클라이언트가 삭제를 알 수 있도록 삭제 기록을 남김
+        with sync_seq_slot(current_user) as seq:
+            tombstone_collection.insert_one({
+                "user_id": current_user,
+                "diary_id": diary_id,
+                "sync_seq": seq,
+                "deleted_at": datetime.utcnow()
+            })
+        shift_trend_rollups(target_diary, None)
+        similarity_index.remove(current_user, diary_id)
+        user_stats_cache.invalidate(current_user)
+
+        # 5. 삭제된 일기의 Big5 기여분을 없애기 위해 남은 스냅샷으로 프로필 재계산
+        if target_diary.get("big5_snapshot"):
+            add_tracked_task(background_tasks, recompute_big5_profile_bg, current_user)
 
         return {
             "status": "success", 
@@ -1301,6 +3944,7 @@ async def scan_diary_text(
     temp_filename = f"temp_ocr_{current_user}_{timestamp}.jpg"
     
     try:
+        check_rate_limit(current_user, "ocr")
         print(f"INFO: Receiving image for OCR from user {current_user}")
         
         # 1. 서버에 잠시 저장 (Gemini 업로드를 위해)
@@ -1321,6 +3965,8 @@ async def scan_diary_text(
             "extracted_text": extracted_text.strip()
         }
 
+    except HTTPException as http_ex:
+        raise http_ex
     except Exception as e:
         print(f"Error in scan_diary: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1335,16 +3981,25 @@ async def scan_diary_text(
 @app.post("/chat/diary")
 async def chat_about_diary(request: DiaryChatRequest, current_user: str = Depends(get_current_user)):
     try:
+        check_rate_limit(current_user, "chat")
+
         # 1. 일기 개수 제한 체크 (최대 3개)
         if len(request.diary_ids) > 3:
             raise HTTPException(status_code=400, detail="You can select up to 3 diaries.")
 
+        # 1-1. [자동 문맥] 질문과 비슷한 과거 일기로 빈 자리 채우기
+        diary_ids = list(request.diary_ids)
+        if request.auto_context and len(diary_ids) < 3:
+            # 질문은 짧아서 유사도가 낮게 나오므로 하한 없이 가장 가까운 일기를 사용
+            matches = similarity_index.search(current_user, embed_text(request.user_message), k=3 - len(diary_ids), exclude_ids=diary_ids, min_score=0.0)
+            diary_ids.extend(diary_id for diary_id, _ in matches)
+
         # 2. 일기 데이터 일괄 조회 (MongoDB $in 연산자 사용)
-        obj_ids = [ObjectId(id) for id in request.diary_ids if ObjectId.is_valid(id)]
+        obj_ids = [ObjectId(id) for id in diary_ids if ObjectId.is_valid(id)]
         cursor = diary_collection.find(
             {"_id": {"$in": obj_ids}, "user_id": current_user}
         )
-        diaries = list(cursor)
+        diaries = merge_archived_fields(cursor)
 
         if not diaries:
             raise HTTPException(status_code=404, detail="No diaries found.")
@@ -1444,28 +4099,513 @@ async def chat_about_diary(request: DiaryChatRequest, current_user: str = Depend
             "messages": messages
         }
 
+    except HTTPException as http_ex:
+        raise http_ex
     except Exception as e:
         print(f"Chat Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
     
+# =========================================================
+# [Queue] 지연 분석 큐 (가져온 일기 등 analysis_status="queued")
+# =========================================================
+# 일기 문서 자체가 큐 항목입니다. 한 번에 하나씩 간격을 두고 처리하므로 키 쿼터를 잠식하지 않습니다.
+async def process_next_queued_analysis() -> bool:
+    """큐에서 한 건 처리. 처리할 항목이 있었으면 True."""
+    if model_router.healthy_key_ratio() < 0.5:
+        return False
+
+    now = datetime.utcnow()
+    diary = diary_collection.find_one_and_update(
+        {"$or": [
+            {"analysis_status": "queued"},
+            # 처리 중 서버가 죽어서 멈춘 항목은 10분 뒤 다시 가져감
+            {"analysis_status": "running", "analysis_started_at": {"$lt": now - timedelta(minutes=10)}}
+        ]},
+        {"$set": {"analysis_status": "running", "analysis_started_at": now}, "$inc": {"analysis_attempts": 1}},
+        sort=[("queued_at", 1)],
+        projection={"user_id": 1, "content": 1, "analysis_attempts": 1},
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    if not diary:
+        return False
+
+    user_id, diary_id = diary["user_id"], str(diary["_id"])
+    profile = user_collection.find_one({"user_id": user_id}, {"top_traits": 1}) or {}
+    try:
+        analysis_result, analysis_model = await get_gemini_analysis(diary.get("content", ""), profile.get("top_traits", []))
+    except HTTPException:
+        analysis_result = None  # Gemini 대기열 포화 -> 다음 차례에 다시 시도
+
+    if not analysis_result:
+        give_up = diary.get("analysis_attempts", 1) >= ANALYSIS_QUEUE_MAX_ATTEMPTS
+        diary_collection.update_one(
+            {"_id": diary["_id"]},
+            {"$set": {"analysis_status": "failed" if give_up else "queued"}}
+        )
+        return True
+
+    apply_analysis_result(user_id, diary_id, diary.get("content", ""), analysis_result, analysis_model, recompute_big5=False)
+    # 이 유저의 대기 항목이 모두 끝났을 때 Big5를 한 번만 재계산
+    if not diary_collection.find_one({"user_id": user_id, "analysis_status": {"$in": ["queued", "running"]}}, {"_id": 1}):
+        recompute_big5_profile(user_id)
+        user_stats_cache.invalidate(user_id)
+    return True
+
+async def analysis_queue_loop():
+    while True:
+        processed = False
+        try:
+            processed = await process_next_queued_analysis()
+        except Exception as e:
+            print(f"ERROR: [AnalysisQueue] {e}")
+        await asyncio.sleep(ANALYSIS_QUEUE_INTERVAL_SEC if processed else ANALYSIS_QUEUE_IDLE_SEC)
+
+# =========================================================
+# [Lifecycle] 데이터 수명 주기 정리 (오래된 임시 저장 / 지난 리포트 / 콜드 아카이브)
+# =========================================================
+# 리더 워커에서만 주기적으로 돕니다. 실제 삭제는 가능한 한 TTL 인덱스(expires_at)에 맡기고,
+# 태그 카운트 / 동기화 삭제 기록이 함께 바뀌어야 하는 임시 저장만 직접 지웁니다.
+WORKING_SET_COLLECTIONS = ("diaries", "diary_archive", "life_reports", "musics", "images")
+
+def prune_stale_drafts(now: datetime, users: set) -> dict:
+    """DRAFT_RETENTION_DAYS 동안 손대지 않은 임시 저장 삭제 (일기 삭제 API와 같은 후처리)"""
+    cutoff = now - timedelta(days=DRAFT_RETENTION_DAYS)
+    query = {"is_temporary": True, "updated_at": {"$lt": cutoff}}
+    pruned, freed = 0, 0
+    for _ in range(COMPACTOR_MAX_BATCHES):
+        drafts = list(diary_collection.find(query, {"embedding": 0}).limit(COMPACTOR_BATCH))
+        for draft in drafts:
+            # 조회 후 유저가 다시 수정했다면 조건에 걸리지 않아 건너뜀
+            if not diary_collection.delete_one({"_id": draft["_id"], **query}).deleted_count:
+                continue
+            apply_tag_delta(draft["user_id"], draft.get("tags"), None)
+            with sync_seq_slot(draft["user_id"]) as seq:
+                tombstone_collection.insert_one({
+                    "user_id": draft["user_id"],
+                    "diary_id": str(draft["_id"]),
+                    "sync_seq": seq,
+                    "deleted_at": now
+                })
+            users.add(draft["user_id"])
+            pruned += 1
+            freed += len(bson.encode(draft))
+        if len(drafts) < COMPACTOR_BATCH:
+            break
+    return {"items": pruned, "bytes": freed}
+
+def expire_old_reports(now: datetime) -> dict:
+    """유저별 최신 REPORT_KEEP_LATEST 개를 넘는 리포트에 expires_at 표시 (TTL 인덱스가 유예 후 삭제)"""
+    pipeline = [
+        {"$match": {"expires_at": {"$exists": False}}},
+        {"$sort": {"user_id": 1, "created_at": -1}},
+        {"$group": {"_id": "$user_id", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": REPORT_KEEP_LATEST}}},
+    ]
+    old_ids = [i for row in report_collection.aggregate(pipeline) for i in row["ids"][REPORT_KEEP_LATEST:]]
+    if not old_ids:
+        return {"items": 0, "bytes": 0}
+    freed = sum(len(bson.encode(doc)) for doc in report_collection.find({"_id": {"$in": old_ids}}))
+    expires_at = now + timedelta(seconds=SUPERSEDED_GRACE_SEC)
+    marked = report_collection.update_many({"_id": {"$in": old_ids}}, {"$set": {"expires_at": expires_at}}).modified_count
+    return {"items": marked, "bytes": freed}
+
+def archive_old_diaries(now: datetime) -> dict:
+    """
+    ARCHIVE_AFTER_DAYS 가 지난 일기의 무거운 필드를 diary_archive 로 옮김.
+    분석 대기 중이거나 임베딩이 없는 일기(아직 본문이 필요한 작업이 남음)는 건너뜁니다.
+    """
+    cutoff = now - timedelta(days=ARCHIVE_AFTER_DAYS)
+    query = {
+        "is_temporary": False, "created_at": {"$lt": cutoff}, "archived": {"$ne": True},
+        "content": {"$exists": True}, "embedding": {"$exists": True},
+        "analysis_status": {"$nin": ["queued", "running"]},
+        # 최근에 수정된 일기는 다시 핫 데이터로 둠 (수정 시 unarchive_diary 로 되돌린 직후 재보관 방지)
+        "$or": [{"updated_at": {"$lt": cutoff}}, {"updated_at": {"$exists": False}}],
+    }
+    projection = {"user_id": 1, **{f: 1 for f in ARCHIVE_FIELDS}}
+    archived, freed = 0, 0
+    for _ in range(COMPACTOR_MAX_BATCHES):
+        docs = list(diary_collection.find(query, projection).limit(COMPACTOR_BATCH))
+        for doc in docs:
+            cold = {f: doc[f] for f in ARCHIVE_FIELDS if f in doc}
+            token = ObjectId()
+            # 1) 본문이 그대로일 때만 보관 표시 + 토큰 (필드는 아직 그대로라 이 사이에 읽어도 온전한 일기가 보임)
+            flagged = diary_collection.update_one(
+                {"_id": doc["_id"], "content": doc.get("content"), "archived": {"$ne": True}},
+                {"$set": {"archived": True, "archived_at": now, "archive_token": token}}
+            )
+            if not flagged.modified_count:
+                continue
+            # 2) 콜드 복사
+            archive_collection.replace_one(
+                {"_id": doc["_id"]}, {"user_id": doc["user_id"], **cold, "archived_at": now, "archive_token": token}, upsert=True
+            )
+            # 3) 표시가 아직 이번 토큰일 때만 원래 문서에서 필드를 뺌.
+            #    그 사이 unarchive_diary 가 표시를 내렸거나 일기가 지워졌으면 필드는 원래 문서에 두고 복사본만 버림
+            result = diary_collection.update_one(
+                {"_id": doc["_id"], "archive_token": token}, {"$unset": {**{f: "" for f in ARCHIVE_FIELDS}, "archive_token": ""}}
+            )
+            if not result.modified_count:
+                archive_collection.delete_one({"_id": doc["_id"], "archive_token": token})
+                continue
+            archived += 1
+            freed += len(bson.encode(cold))
+        if len(docs) < COMPACTOR_BATCH:
+            break
+    return {"items": archived, "bytes": freed}
+
+def collection_sizes() -> dict:
+    """컬렉션별 데이터 + 인덱스 크기 (collStats 를 지원하지 않는 환경에서는 빈 dict)"""
+    sizes = {}
+    for name in WORKING_SET_COLLECTIONS:
+        try:
+            stats = db.command("collStats", name)
+        except Exception:
+            continue
+        sizes[name] = int(stats.get("size", 0)) + int(stats.get("totalIndexSize", 0))
+        COLLECTION_SIZE_BYTES.labels(collection=name).set(sizes[name])
+    return sizes
+
+def run_lifecycle_compaction() -> dict:
+    """정책 하나가 실패해도 나머지는 계속 (스레드 풀에서 실행)"""
+    now = datetime.utcnow()
+    users = set()
+    before = collection_sizes()
+    policies = [
+        ("drafts", DRAFT_RETENTION_DAYS, lambda: prune_stale_drafts(now, users)),
+        ("reports", REPORT_KEEP_LATEST, lambda: expire_old_reports(now)),
+        ("archive", ARCHIVE_AFTER_DAYS, lambda: archive_old_diaries(now)),
+    ]
+    summary = {}
+    for policy, setting, func in policies:
+        if setting <= 0:
+            continue
+        try:
+            summary[policy] = func()
+        except Exception as e:
+            print(f"ERROR: [Lifecycle] {policy} failed: {e}")
+            continue
+        LIFECYCLE_ITEMS.labels(policy=policy).inc(summary[policy]["items"])
+        LIFECYCLE_BYTES.labels(policy=policy).inc(summary[policy]["bytes"])
+    after = collection_sizes()
+    return {"policies": summary, "users": users, "diaries_bytes_before": before.get("diaries"), "diaries_bytes_after": after.get("diaries")}
+
+async def lifecycle_compactor_loop():
+    while True:
+        try:
+            started = time.perf_counter()
+            result = await asyncio.to_thread(run_lifecycle_compaction)
+            # 캐시는 이벤트 루프 쪽에서 무효화 (임시 저장 삭제로 태그 카운트가 바뀐 유저)
+            for user_id in result.pop("users"):
+                user_stats_cache.invalidate(user_id)
+            log_event("lifecycle", seconds=round(time.perf_counter() - started, 3), **result)
+        except Exception as e:
+            print(f"ERROR: [Lifecycle] {e}")
+        await asyncio.sleep(COMPACTOR_INTERVAL_SEC)
+
+# =========================================================
+# [Scheduler] 격주 리포트 정기 배치 생성
+# =========================================================
+# 한 달을 전반(1~15일)/후반(16일~)으로 나눠 주기마다 한 번씩 리포트를 미리 만들어 둡니다.
+# 진행 상황은 jobs 컬렉션에 유저 단위로 체크포인트하므로, 시간대가 끝나거나 서버가 재시작돼도 이어서 진행합니다.
+def in_offpeak_window(now: datetime) -> bool:
+    start, end = REPORT_OFFPEAK_START_HOUR, REPORT_OFFPEAK_END_HOUR
+    if start <= end:
+        return start <= now.hour < end
+    return now.hour >= start or now.hour < end  # 자정을 넘기는 시간대
+
+def report_cycle(now: datetime):
+    """(주기 ID, 주기 시작 시각) 반환. 예: ("2024-01-B", 2024-01-16 00:00)"""
+    if now.day <= 15:
+        return f"{now:%Y-%m}-A", datetime(now.year, now.month, 1)
+    return f"{now:%Y-%m}-B", datetime(now.year, now.month, 16)
+
+async def generate_scheduled_report(user: dict) -> str:
+    """유저 한 명의 정기 리포트 생성. 결과: "generated" / "skipped" / "failed" """
+    user_id = user["user_id"]
+    last_report_at = user.get("last_report_at")
+
+    # 지난 리포트 이후 새로 쓰거나 고친 일기가 없으면 생략
+    if last_report_at and not diary_collection.find_one(
+        {"user_id": user_id, "is_temporary": False, "updated_at": {"$gt": last_report_at}}, {"_id": 1}
+    ):
+        return "skipped"
+
+    diaries = load_life_map_diaries(user_id)
+    if len(diaries) < REPORT_MIN_DIARIES:
+        return "skipped"
+
+    try:
+        report_result = await get_long_term_analysis_rag(build_life_map_context(diaries), len(diaries))
+    except HTTPException as e:
+        print(f"WARNING: [ReportBatch] Gemini busy for {user_id}: {e.detail}")
+        return "failed"
+    if not report_result:
+        return "failed"
+
+    save_life_report(user_id, report_result, len(diaries), source="scheduled")
+    return "generated"
+
+async def run_report_batch(page_size: int = 100, max_consecutive_failures: int = 3):
+    cycle_id, cycle_start = report_cycle(datetime.utcnow())
+    job_id = f"report_batch:{cycle_id}"
+    job = job_collection.find_one_and_update(
+        {"_id": job_id},
+        {"$setOnInsert": {
+            "type": "report_batch", "status": "running", "last_user_id": "",
+            "generated": 0, "skipped": 0, "failed": 0, "started_at": datetime.utcnow()
+        }},
+        upsert=True,
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    if job["status"] == "done":
+        return
+
+    last_user_id = job["last_user_id"]
+    consecutive_failures = 0
+    print(f"INFO: [ReportBatch] {cycle_id} running (resume after '{last_user_id}')")
+    while True:
+        # 커서를 오래 붙잡지 않도록 페이지 단위로 조회
+        users = list(user_collection.find(
+            {
+                "user_id": {"$gt": last_user_id},
+                "$or": [{"last_report_at": {"$exists": False}}, {"last_report_at": {"$lt": cycle_start}}]
+            },
+            {"user_id": 1, "last_report_at": 1, "_id": 0}
+        ).sort("user_id", 1).limit(page_size))
+        if not users:
+            break
+
+        for user in users:
+            # 한가한 시간대가 끝났거나 키 절반 이상이 쿼터 초과면 멈추고 다음 기회에 이어서
+            if not in_offpeak_window(datetime.utcnow()) or model_router.healthy_key_ratio() < 0.5:
+                print(f"INFO: [ReportBatch] {cycle_id} paused at '{last_user_id}'")
+                return
+
+            outcome = await generate_scheduled_report(user)
+            last_user_id = user["user_id"]
+            update = {"$set": {"last_user_id": last_user_id, "updated_at": datetime.utcnow()}, "$inc": {outcome: 1}}
+            if outcome == "failed":
+                # 커서는 넘어가도 실패한 유저는 기록해 두고 완료 전에 다시 시도
+                update["$addToSet"] = {"failed_user_ids": last_user_id}
+            job_collection.update_one({"_id": job_id}, update)
+
+            consecutive_failures = consecutive_failures + 1 if outcome == "failed" else 0
+            if consecutive_failures >= max_consecutive_failures:
+                print(f"WARNING: [ReportBatch] {cycle_id} paused after {consecutive_failures} consecutive failures")
+                return
+            if outcome == "generated":
+                await asyncio.sleep(REPORT_BATCH_PAUSE_SEC)
+
+    if not await retry_failed_reports(job_id, cycle_id, cycle_start, max_consecutive_failures):
+        return
+    job_collection.update_one({"_id": job_id}, {"$set": {"status": "done", "finished_at": datetime.utcnow()}})
+    print(f"INFO: [ReportBatch] {cycle_id} finished")
+
+async def retry_failed_reports(job_id: str, cycle_id: str, cycle_start: datetime, max_consecutive_failures: int) -> bool:
+    """
+    본 순회에서 실패한 유저(failed_user_ids)를 다시 시도. 배치를 완료 처리해도 되면 True.
+    한 번 호출이 재시도 한 바퀴이고, REPORT_BATCH_RETRY_ROUNDS 바퀴 뒤에도 남은 유저는 job 문서에 기록만 남깁니다.
+    """
+    job = job_collection.find_one({"_id": job_id}, {"failed_user_ids": 1, "retry_rounds": 1}) or {}
+    failed_ids = job.get("failed_user_ids") or []
+    if not failed_ids:
+        return True
+    if job.get("retry_rounds", 0) >= REPORT_BATCH_RETRY_ROUNDS:
+        print(f"WARNING: [ReportBatch] {cycle_id} giving up on {len(failed_ids)} users after {REPORT_BATCH_RETRY_ROUNDS} retry rounds")
+        return True
+
+    job_collection.update_one({"_id": job_id}, {"$inc": {"retry_rounds": 1}})
+    print(f"INFO: [ReportBatch] {cycle_id} retrying {len(failed_ids)} failed users")
+    users = list(user_collection.find(
+        {"user_id": {"$in": failed_ids}, "$or": [{"last_report_at": {"$exists": False}}, {"last_report_at": {"$lt": cycle_start}}]},
+        {"user_id": 1, "last_report_at": 1, "_id": 0}
+    ).sort("user_id", 1))
+    # 그 사이 탈퇴했거나 직접 리포트를 만든 유저는 다시 시도할 필요 없음
+    settled = set(failed_ids) - {u["user_id"] for u in users}
+    if settled:
+        job_collection.update_one({"_id": job_id}, {"$pullAll": {"failed_user_ids": list(settled)}})
+
+    consecutive_failures = 0
+    for user in users:
+        if not in_offpeak_window(datetime.utcnow()) or model_router.healthy_key_ratio() < 0.5:
+            print(f"INFO: [ReportBatch] {cycle_id} retry paused")
+            return False
+        outcome = await generate_scheduled_report(user)
+        if outcome != "failed":
+            job_collection.update_one(
+                {"_id": job_id},
+                {"$pull": {"failed_user_ids": user["user_id"]}, "$inc": {outcome: 1, "failed": -1},
+                 "$set": {"updated_at": datetime.utcnow()}}
+            )
+        consecutive_failures = consecutive_failures + 1 if outcome == "failed" else 0
+        if consecutive_failures >= max_consecutive_failures:
+            print(f"WARNING: [ReportBatch] {cycle_id} retry paused after {consecutive_failures} consecutive failures")
+            return False
+        if outcome == "generated":
+            await asyncio.sleep(REPORT_BATCH_PAUSE_SEC)
+
+    remaining = (job_collection.find_one({"_id": job_id}, {"failed_user_ids": 1}) or {}).get("failed_user_ids") or []
+    if remaining:
+        print(f"INFO: [ReportBatch] {cycle_id} {len(remaining)} users still failing; retrying on the next run")
+        return False
+    return True
+
+async def report_scheduler_loop():
+    while True:
+        try:
+            if in_offpeak_window(datetime.utcnow()):
+                await run_report_batch()
+        except Exception as e:
+            print(f"ERROR: [ReportBatch] {e}")
+        await asyncio.sleep(REPORT_SCHEDULER_POLL_SEC)
+
+background_loop_tasks = []  # 실행 중인 asyncio 백그라운드 루프 (GC 방지용 참조, 종료 시 취소)
+
+async def cancel_tasks(tasks: list):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# =========================================================
+# [Leader] 워커 하나만 실행하는 백그라운드 작업 (Mongo 임대)
+# =========================================================
+# 셀프 핑 / 리포트 배치 / 분석 큐는 워커(또는 인스턴스)가 여러 개여도 한 곳에서만 돌아야 하므로
+# coordination 컬렉션의 임대 문서를 가진 워커만 실행합니다. 리더가 죽으면 임대가 만료된 뒤 다른 워커가 이어받습니다.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+class LeaderLease:
+    def __init__(self, name: str, ttl_sec: int):
+        self.lease_id = f"lease:{name}"
+        self.ttl_sec = ttl_sec
+        self.held = False
+
+    def try_acquire(self) -> bool:
+        """내가 가진 임대는 연장하고, 만료된 임대는 가져옵니다. 다른 워커의 유효한 임대가 있으면 False"""
+        now = datetime.utcnow()
+        try:
+            coordination_collection.find_one_and_update(
+                {"_id": self.lease_id, "$or": [{"holder": WORKER_ID}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"holder": WORKER_ID, "expires_at": now + timedelta(seconds=self.ttl_sec), "renewed_at": now}},
+                upsert=True
+            )
+            self.held = True
+        except pymongo.errors.DuplicateKeyError:
+            # 조건에 맞는 문서가 없어 upsert가 같은 _id로 삽입을 시도함 = 다른 워커가 보유 중
+            self.held = False
+        return self.held
+
+    def release(self):
+        """종료 시 바로 만료시켜 다른 워커가 기다리지 않고 이어받게 함"""
+        coordination_collection.update_one({"_id": self.lease_id, "holder": WORKER_ID}, {"$set": {"expires_at": datetime.utcnow()}})
+        self.held = False
+
+leader_lease = LeaderLease("background", LEADER_LEASE_SEC)
+Gauge("onion_worker_is_leader", "1 if this worker holds the background-duty lease").set_function(lambda: leader_lease.held)
+
+def start_singleton_duties() -> list:
+    tasks = [asyncio.create_task(analysis_queue_loop()), asyncio.create_task(self_ping_loop())]
+    if REPORT_BATCH_ENABLED:
+        tasks.append(asyncio.create_task(report_scheduler_loop()))
+    if LIFECYCLE_ENABLED:
+        tasks.append(asyncio.create_task(lifecycle_compactor_loop()))
+    return tasks
+
+async def leader_election_loop():
+    duties = []
+    try:
+        while True:
+            try:
+                is_leader = await asyncio.to_thread(leader_lease.try_acquire)
+            except pymongo.errors.PyMongoError as e:
+                # 갱신하지 못하면 임대가 곧 만료되므로 미리 내려놓음 (두 워커가 동시에 돌지 않도록)
+                print(f"WARNING: [Leader] lease renewal failed: {e}")
+                is_leader = leader_lease.held = False
+            if is_leader and not duties:
+                print(f"INFO: [Leader] {WORKER_ID} acquired the lease; starting background duties")
+                duties = start_singleton_duties()
+            elif not is_leader and duties:
+                print(f"WARNING: [Leader] {WORKER_ID} lost the lease; stopping background duties")
+                await cancel_tasks(duties)
+                duties = []
+            await asyncio.sleep(LEADER_RENEW_SEC)
+    finally:
+        await cancel_tasks(duties)
+        if leader_lease.held:
+            try:
+                await asyncio.to_thread(leader_lease.release)
+            except pymongo.errors.PyMongoError:
+                pass
+
+def start_background_schedulers():
+    background_loop_tasks.append(asyncio.create_task(leader_election_loop()))
+
+# =========================================================
+# [Startup] 병렬 워밍업 + 준비 상태 (/ready)
+# =========================================================
+startup_state = {"ready": False, "components": {}}
+
+def warm_up_mongo():
+    # connect=False 로 미뤄 둔 SRV 조회 / TLS 접속을 여기서 끝내고 인덱스 확인
+    client.admin.command("ping")
+    ensure_indexes()
+
+def warm_up_gemini():
+    # SDK import + 안전 설정 타입 로드 (재생 백엔드는 SDK가 필요 없음)
+    if AI_BACKEND != "replay":
+        load_genai()
+        gemini_safety_settings()
+        GeminiBackend.check_sdk()
+
+def warm_up_password_hasher():
+    # passlib은 bcrypt 백엔드를 처음 쓸 때 불러오고 자체 검사를 하므로 첫 로그인 전에 미리 실행
+    pwd_context.handler("bcrypt").get_backend()
+
+async def warm_up_component(name: str, func, retry_sec: Optional[float] = None) -> bool:
+    """동기 초기화 함수를 스레드에서 실행하고 결과를 startup_state에 기록. retry_sec이 있으면 성공할 때까지 재시도"""
+    started = time.perf_counter()
+    while True:
+        try:
+            await asyncio.to_thread(func)
+            startup_state["components"][name] = {"status": "ok", "seconds": round(time.perf_counter() - started, 3)}
+            return True
+        except Exception as e:
+            startup_state["components"][name] = {"status": "error", "error": str(e)[:200]}
+            print(f"WARNING: [Startup] {name} warm-up failed: {e}")
+            if retry_sec is None:
+                return False
+            await asyncio.sleep(retry_sec)
+
+async def warm_up_and_start():
+    started = time.perf_counter()
+    mongo_ok, gemini_ok, _ = await asyncio.gather(
+        # 슬립에서 깨어난 직후엔 DNS/TLS가 늦을 수 있으므로 Mongo는 붙을 때까지 재시도
+        warm_up_component("mongo", warm_up_mongo, retry_sec=STARTUP_MONGO_RETRY_SEC),
+        warm_up_component("gemini", warm_up_gemini),
+        warm_up_component("password_hasher", warm_up_password_hasher),
+    )
+    startup_state["ready"] = mongo_ok and gemini_ok
+    log_event("startup", ready=startup_state["ready"], seconds=round(time.perf_counter() - started, 3), components=startup_state["components"])
+    # 리더 선출(배치 / 큐 / 셀프 핑)은 DB 준비가 끝난 뒤 시작
+    start_background_schedulers()
+
 # =========================================================
 # [Self-Ping] Render 슬립 모드 방지 로직
 # =========================================================
-def run_self_ping():
+async def self_ping_loop():
     # TODO: 아래 주소를 본인의 실제 Render 배포 URL로 변경하세요!
     # 예: https://onion-project.onrender.com/health
     target_url = "https://onion-project-fqyt.onrender.com/health" 
     
+    import requests  # 셀프 핑에서만 쓰므로 서버 시작 후에 불러옴
+
+    # 리더 워커에서만 실행 (워커마다 핑을 보내지 않도록)
     print(f"INFO: Self-ping task started for {target_url}")
     while True:
+        # 10분(600초)마다 요청을 보냄 (Render 슬립 기준이 15분)
+        await asyncio.sleep(600)
         try:
-            # 10분(600초)마다 요청을 보냄 (Render 슬립 기준이 15분)
-            time.sleep(600) 
-            response = requests.get(target_url)
+            response = await asyncio.to_thread(requests.get, target_url, timeout=30)
             print(f"INFO: Self-ping signal sent. Status: {response.status_code}")
         except Exception as e:
             print(f"WARNING: Self-ping failed: {e}")
-
-# 서버 시작 시 별도 스레드(Daemon Thread)로 실행
-# 메인 프로세스가 죽으면 이 스레드도 같이 죽으므로 안전합니다.
-threading.Thread(target=run_self_ping, daemon=True).start()
\ No newline at end of file
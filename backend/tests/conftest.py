@@ -0,0 +1,19 @@
+"""
+테스트 공통 준비 (테스트 모듈이 main 을 import 하기 전에 pytest 가 먼저 불러옴).
+
+- backend/ 와 benchmarks/(standins) 를 import 경로에 추가
+- TEST_MONGO_REPLSET_URI 가 있으면 그 레플리카셋(또는 Atlas)에 연결, 없으면 메모리 DB(mongomock) 사용
+"""
+import os
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.join(BACKEND_DIR, "benchmarks"))
+
+REPLSET_URI = os.environ.get("TEST_MONGO_REPLSET_URI")
+os.environ.setdefault("GENAI_API_KEY", "test-key")
+os.environ["MONGO_URI"] = REPLSET_URI or "mongodb://localhost:27017"
+if not REPLSET_URI:
+    from standins import use_in_memory_mongo
+    use_in_memory_mongo()
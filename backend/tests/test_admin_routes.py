@@ -0,0 +1,23 @@
+"""
+운영용 엔드포인트 인증 테스트.
+
+- test_metrics_requires_admin_token : /metrics 는 PROFILE_ADMIN_TOKEN(X-Admin-Token) 없이는 열리지 않는지
+
+실행: cd backend && python -m pytest -q tests
+"""
+from fastapi.testclient import TestClient
+
+import main
+
+
+def test_metrics_requires_admin_token(monkeypatch):
+    client = TestClient(main.app)
+    monkeypatch.setattr(main, "PROFILE_ADMIN_TOKEN", "")
+    assert client.get("/metrics").status_code == 404
+
+    monkeypatch.setattr(main, "PROFILE_ADMIN_TOKEN", "scrape-secret")
+    assert client.get("/metrics").status_code == 403
+    assert client.get("/metrics", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    response = client.get("/metrics", headers={"X-Admin-Token": "scrape-secret"})
+    assert response.status_code == 200
+    assert "onion_analysis_parse" in response.text
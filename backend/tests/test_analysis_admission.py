@@ -0,0 +1,99 @@
+"""
+/analyze-and-save 분석 경로 테스트.
+
+- test_busy_gemini_returns_503          : GeminiAdmission 의 503(Retry-After)이 /analyze-and-save 까지 그대로 전달되고,
+                                          로컬 임시 분석으로 저장되지 않는지 확인
+- test_busy_gemini_life_map_returns_503 : 인생 지도 분석도 503 을 그대로 돌려주고, 미리 올린 월 사용 횟수를 되돌리는지
+- test_model_name_stays_out_of_response : 분석 모델 이름은 응답의 analysis 에 섞이지 않고 analysis_model 로만 저장되는지 (Gemini / 로컬 임시 분석)
+
+실행: cd backend && python -m pytest -q tests
+"""
+import uuid
+from datetime import datetime, timedelta
+
+from fastapi.testclient import TestClient
+from jose import jwt
+
+import main
+from standins import FAKE_ANALYSIS
+
+
+def make_user(prefix):
+    user_id = f"{prefix}-{uuid.uuid4().hex[:8]}"
+    main.user_collection.insert_one({"user_id": user_id, "sync_seq": 0})
+    token = jwt.encode({"sub": user_id, "exp": datetime.utcnow() + timedelta(hours=1)}, main.SECRET_KEY, algorithm="HS256")
+    return user_id, {"Authorization": f"Bearer {token}"}
+
+
+def test_busy_gemini_returns_503(monkeypatch):
+    user_id, headers = make_user("test-busy")
+    calls = []
+
+    async def busy_call(*args, **kwargs):
+        calls.append(1)
+        raise main.gemini_admission._busy("AI server is busy. Please try again later.")
+
+    monkeypatch.setattr(main, "call_gemini_with_fallback", busy_call)
+    monkeypatch.setattr(main, "LOCAL_FALLBACK_ENABLED", True)
+    try:
+        response = TestClient(main.app).post(
+            "/analyze-and-save",
+            headers=headers,
+            json={"title": "t", "content": "A quiet day.", "entry_date": "2026-10-01", "tags": []},
+        )
+
+        assert response.status_code == 503
+        assert response.headers.get("retry-after")
+        assert len(calls) == 1, "a full queue should not be retried inside the request"
+        assert main.diary_collection.count_documents({"user_id": user_id}) == 0
+    finally:
+        main.diary_collection.delete_many({"user_id": user_id})
+        main.user_collection.delete_many({"user_id": user_id})
+
+
+def test_busy_gemini_life_map_returns_503(monkeypatch):
+    user_id, headers = make_user("test-busy-map")
+    main.diary_collection.insert_many([
+        {"user_id": user_id, "entry_date": f"2026-10-0{i}", "content": "x", "event_summary": "e", "is_temporary": False}
+        for i in range(1, 5)
+    ])
+
+    async def busy_call(*args, **kwargs):
+        raise main.gemini_admission._busy("AI server is busy. Please try again later.")
+
+    monkeypatch.setattr(main, "call_gemini_with_fallback", busy_call)
+    try:
+        response = TestClient(main.app).post("/analyze-life-map", headers=headers, json={})
+
+        assert response.status_code == 503
+        assert response.headers.get("retry-after")
+        usage = main.user_collection.find_one({"user_id": user_id}).get("life_map_usage") or {}
+        assert usage.get("count", 0) == 0
+    finally:
+        main.diary_collection.delete_many({"user_id": user_id})
+        main.user_collection.delete_many({"user_id": user_id})
+
+
+def test_model_name_stays_out_of_response(monkeypatch):
+    user_id, headers = make_user("test-model")
+
+    async def analysis(diary_text, user_traits, retries=2):
+        return ({**FAKE_ANALYSIS, "keywords": ["#Calm"]}, "gemini-test") if "gemini" in diary_text else (None, None)
+
+    monkeypatch.setattr(main, "get_gemini_analysis", analysis)
+    monkeypatch.setattr(main, "LOCAL_FALLBACK_ENABLED", True)
+    client = TestClient(main.app)
+    try:
+        for content, model in (("gemini day", "gemini-test"), ("quiet day", main.LOCAL_ANALYSIS_MODEL)):
+            response = client.post(
+                "/analyze-and-save", headers=headers,
+                json={"title": "t", "content": content, "entry_date": "2026-10-01", "tags": []},
+            )
+            assert response.status_code == 200
+            analysis = response.json()["analysis"]
+            assert not {"model_used", "sentiment", "analysis_source"} & set(analysis)
+            saved = main.diary_collection.find_one({"user_id": user_id, "content": content})
+            assert saved["analysis_model"] == model
+    finally:
+        main.diary_collection.delete_many({"user_id": user_id})
+        main.user_collection.delete_many({"user_id": user_id})
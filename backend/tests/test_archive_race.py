@@ -0,0 +1,84 @@
+"""
+콜드 아카이브(archive_old_diaries)와 복원(unarchive_diary)이 겹칠 때 본문이 사라지지 않는지 테스트.
+
+compactor 의 단계 사이(보관 표시 -> 콜드 복사 -> 필드 제거)에 unarchive_diary 를 끼워 넣고,
+어느 시점이든 끝나고 나면 원래 일기에 본문/분석이 온전히 있고 남은 콜드 문서가 없는지 확인합니다.
+
+실행: cd backend && python -m pytest -q tests
+"""
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+
+
+class HookedArchive:
+    """archive_collection.replace_one(콜드 복사) 직전 또는 직후에 hook 을 한 번 실행"""
+    def __init__(self, collection, hook, after):
+        self._collection = collection
+        self._hook = hook
+        self._after = after
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def replace_one(self, *args, **kwargs):
+        if not self._after:
+            self._hook()
+        result = self._collection.replace_one(*args, **kwargs)
+        if self._after:
+            self._hook()
+        return result
+
+
+def seed_old_diary(user_id):
+    created = datetime.utcnow() - timedelta(days=main.ARCHIVE_AFTER_DAYS + 30)
+    return main.diary_collection.insert_one({
+        "user_id": user_id, "title": "old", "content": "an old entry", "is_temporary": False,
+        "analysis": {"theme1": "a"}, "recommend": {"head": "h"}, "embedding": b"\x00",
+        "analysis_status": "fresh", "created_at": created, "updated_at": created,
+    }).inserted_id
+
+
+@pytest.mark.parametrize("after_copy", [False, True], ids=["before-copy", "after-copy"])
+def test_unarchive_during_compaction_keeps_content(monkeypatch, after_copy):
+    user_id = f"test-archive-{uuid.uuid4().hex[:8]}"
+    diary_id = seed_old_diary(user_id)
+    restored = []
+    hooked = HookedArchive(main.archive_collection, lambda: restored.append(main.unarchive_diary(user_id, diary_id)), after_copy)
+    monkeypatch.setattr(main, "archive_collection", hooked)
+    monkeypatch.setattr(main, "COMPACTOR_MAX_BATCHES", 1)
+    try:
+        outcome = main.archive_old_diaries(datetime.utcnow())
+
+        assert restored == [True]
+        assert outcome["items"] == 0
+        diary = main.diary_collection.find_one({"_id": diary_id})
+        assert diary["content"] == "an old entry"
+        assert diary["analysis"] == {"theme1": "a"} and diary["recommend"] == {"head": "h"}
+        assert not diary.get("archived")
+        assert main.archive_collection.count_documents({"_id": diary_id}) == 0
+    finally:
+        monkeypatch.undo()
+        main.diary_collection.delete_many({"user_id": user_id})
+        main.archive_collection.delete_many({"user_id": user_id})
+
+
+def test_archive_then_unarchive_round_trip():
+    user_id = f"test-archive-{uuid.uuid4().hex[:8]}"
+    diary_id = seed_old_diary(user_id)
+    try:
+        assert main.archive_old_diaries(datetime.utcnow())["items"] >= 1
+        diary = main.diary_collection.find_one({"_id": diary_id})
+        assert diary["archived"] and "content" not in diary and "archive_token" not in diary
+
+        assert main.unarchive_diary(user_id, diary_id)
+        diary = main.diary_collection.find_one({"_id": diary_id})
+        assert diary["content"] == "an old entry" and diary["analysis"] == {"theme1": "a"}
+        assert not diary.get("archived")
+        assert main.archive_collection.count_documents({"_id": diary_id}) == 0
+    finally:
+        main.diary_collection.delete_many({"user_id": user_id})
+        main.archive_collection.delete_many({"user_id": user_id})
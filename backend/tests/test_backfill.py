@@ -0,0 +1,111 @@
+"""
+backfill.py 테스트.
+
+- test_clean_text_backfill_reads_archived_content : clean_text 가 없는 옛 일기를 채우고, 보관된 일기는 diary_archive 의 본문을 사용하는지
+- test_failed_diaries_are_kept_for_retry           : 분석에 실패한 일기는 체크포인트가 지나가도 failed_ids 에 남고 --retry-failed 로 다시 분석되는지
+- test_archived_legacy_diaries_are_backfilled       : 보관된 옛 형식 일기도 diary_archive 본문으로 분석되고(보관 해제 후 저장), 이미 새 형식인 보관 일기는 건너뛰는지
+
+실행: cd backend && python -m pytest -q tests
+"""
+import argparse
+import asyncio
+import uuid
+
+import main
+import backfill
+from standins import FAKE_ANALYSIS
+
+
+def test_clean_text_backfill_reads_archived_content():
+    user_id = f"test-backfill-{uuid.uuid4().hex[:8]}"
+    hot_id = main.diary_collection.insert_one({"user_id": user_id, "content": "<p>walked   by the river</p>"}).inserted_id
+    archived_id = main.diary_collection.insert_one({"user_id": user_id, "archived": True}).inserted_id
+    main.archive_collection.insert_one({"_id": archived_id, "user_id": user_id, "content": "<b>old</b> rainy day"})
+    edited_id = main.diary_collection.insert_one({"user_id": user_id, "content": "new text", "clean_text": "new text"}).inserted_id
+    try:
+        backfill.run_clean_text_backfill(argparse.Namespace(user=user_id, page_size=2, pause=0))
+
+        clean = {d["_id"]: d.get("clean_text") for d in main.diary_collection.find({"user_id": user_id})}
+        assert clean == {hot_id: "walked by the river", archived_id: "old rainy day", edited_id: "new text"}
+        assert "content" not in main.diary_collection.find_one({"_id": archived_id}), "archived content must stay cold"
+    finally:
+        main.diary_collection.delete_many({"user_id": user_id})
+        main.archive_collection.delete_many({"user_id": user_id})
+
+
+def backfill_args(**overrides):
+    args = dict(name=None, user=None, before=None, all=False, filter=None, concurrency=2, page_size=0, budget=0,
+                min_healthy_ratio=0.0, pause=0.0, reset=False, clean_text=False, retry_failed=False)
+    args.update(overrides)
+    return argparse.Namespace(**args)
+
+
+def test_failed_diaries_are_kept_for_retry(monkeypatch):
+    user_id = f"test-backfill-{uuid.uuid4().hex[:8]}"
+    main.user_collection.insert_one({"user_id": user_id, "sync_seq": 0})
+    ids = main.diary_collection.insert_many([
+        {"user_id": user_id, "title": f"d{i}", "content": f"entry {i}", "is_temporary": False, "entry_date": "2024-01-0%d" % (i + 1)}
+        for i in range(3)
+    ]).inserted_ids
+    flaky = {"entry 1"}
+
+    async def analysis(diary_text, user_traits, retries=2):
+        if diary_text in flaky:
+            return None, None
+        return {**FAKE_ANALYSIS, "keywords": ["#Calm"]}, "gemini-test"
+
+    monkeypatch.setattr(main, "get_gemini_analysis", analysis)
+    args = backfill_args(name=user_id, user=user_id)
+    job_id = f"backfill:{user_id}"
+    try:
+        asyncio.run(backfill.run_backfill(args))
+        job = main.job_collection.find_one({"_id": job_id})
+        assert job["status"] == "done" and job["last_id"] == ids[-1]
+        assert job["failed_ids"] == [ids[1]] and job["failed"] == 1
+
+        flaky.clear()
+        asyncio.run(backfill.retry_failed(backfill_args(name=user_id, user=user_id, retry_failed=True)))
+        job = main.job_collection.find_one({"_id": job_id})
+        assert job["failed_ids"] == [] and job["failed"] == 0
+        assert main.diary_collection.find_one({"_id": ids[1]})["analysis_model"] == "gemini-test"
+        assert main.user_collection.find_one({"user_id": user_id})["top_traits"] == ["#Calm"]
+    finally:
+        main.diary_collection.delete_many({"user_id": user_id})
+        main.user_collection.delete_many({"user_id": user_id})
+        main.job_collection.delete_many({"_id": job_id})
+
+
+def test_archived_legacy_diaries_are_backfilled(monkeypatch):
+    user_id = f"test-backfill-{uuid.uuid4().hex[:8]}"
+    main.user_collection.insert_one({"user_id": user_id, "sync_seq": 0})
+    legacy_id, current_id = main.diary_collection.insert_many([
+        {"user_id": user_id, "title": "old", "is_temporary": False, "entry_date": "2023-01-01", "archived": True},
+        {"user_id": user_id, "title": "new", "is_temporary": False, "entry_date": "2023-01-02", "archived": True,
+         "event_summary": "done"},
+    ]).inserted_ids
+    main.archive_collection.insert_many([
+        {"_id": legacy_id, "user_id": user_id, "content": "an old rainy day", "analysis": {"summary": "legacy"}},
+        {"_id": current_id, "user_id": user_id, "content": "a newer day", "analysis": {"theme1": "Rest"}},
+    ])
+    analyzed = []
+
+    async def analysis(diary_text, user_traits, retries=2):
+        analyzed.append(diary_text)
+        return {**FAKE_ANALYSIS, "keywords": ["#Calm"]}, "gemini-test"
+
+    monkeypatch.setattr(main, "get_gemini_analysis", analysis)
+    job_id = f"backfill:{user_id}"
+    try:
+        asyncio.run(backfill.run_backfill(backfill_args(name=user_id, user=user_id)))
+
+        assert analyzed == ["an old rainy day"]
+        diary = main.diary_collection.find_one({"_id": legacy_id})
+        assert diary["analysis_model"] == "gemini-test" and diary["content"] == "an old rainy day"
+        assert not diary.get("archived") and main.archive_collection.find_one({"_id": legacy_id}) is None
+        assert main.diary_collection.find_one({"_id": current_id}).get("archived") is True
+        assert main.job_collection.find_one({"_id": job_id})["processed"] == 2
+    finally:
+        main.diary_collection.delete_many({"user_id": user_id})
+        main.archive_collection.delete_many({"user_id": user_id})
+        main.user_collection.delete_many({"user_id": user_id})
+        main.job_collection.delete_many({"_id": job_id})
@@ -0,0 +1,39 @@
+"""
+NDJSON 가져오기(import_diaries_ndjson) 테스트.
+
+- test_invalid_tag_lines_are_skipped : '$'로 시작하거나 '.'이 든 태그/키워드가 있는 줄은 건너뛰고(skipped/errors),
+                                       나머지 줄과 태그/키워드 카운트는 정상 반영되는지
+
+실행: cd backend && python -m pytest -q tests
+"""
+import json
+import uuid
+
+import main
+from standins import FAKE_ANALYSIS
+
+
+def test_invalid_tag_lines_are_skipped():
+    user_id = f"test-import-{uuid.uuid4().hex[:8]}"
+    main.user_collection.insert_one({"user_id": user_id, "sync_seq": 0})
+    restored = {"analysis": FAKE_ANALYSIS, "big5_snapshot": {"openness": 50}, "entry_date": "2024-01-02"}
+    lines = [
+        {"content": "plain day", "tags": ["work"], "entry_date": "2024-01-01"},
+        {"content": "dollar tag", "tags": ["$x"], "entry_date": "2024-01-01"},
+        {"content": "dotted tag", "tags": ["a.b"], "entry_date": "2024-01-01"},
+        {"content": "bad keyword", "tags": ["home"], "keywords_snapshot": ["#Calm", "$inc"], **restored},
+        {"content": "restored day", "tags": ["home"], "keywords_snapshot": ["#Calm"], **restored},
+    ]
+    try:
+        summary = main.import_diaries_ndjson(user_id, [json.dumps(line) for line in lines])
+
+        assert summary["imported"] == 2 and summary["skipped"] == 3
+        assert [e["line"] for e in summary["errors"]] == [2, 3, 4]
+        user = main.user_collection.find_one({"user_id": user_id})
+        assert user["user_tag_counts"] == {"work": 1, "home": 1}
+        assert user["trait_counts"] == {"#Calm": 1}
+        assert user["top_traits"] == ["#Calm"], "restored keywords should reach the prompt context too"
+    finally:
+        main.diary_collection.delete_many({"user_id": user_id})
+        main.user_collection.delete_many({"user_id": user_id})
+        main.trend_collection.delete_many({"user_id": user_id})
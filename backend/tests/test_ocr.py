@@ -0,0 +1,47 @@
+"""
+이미지 OCR(extract_text_from_image_with_fallback) 테스트.
+
+- test_ocr_uses_key_order_and_cooldowns : 일반 호출과 같이 model_router.key_order() 순서로 키를 시도하고,
+                                          쿼터 에러가 난 키는 쿨다운 + 호출 지표에 남는지
+
+실행: cd backend && python -m pytest -q tests
+"""
+import asyncio
+import time
+
+import main
+from standins import FakeResponse
+
+
+class QuotaThenText:
+    """첫 키는 429, 다음 키는 텍스트를 돌려주는 백엔드"""
+    def __init__(self):
+        self.keys = []
+
+    async def generate_with_file(self, key_index, model_name, prompt, file_path, generation_config):
+        self.keys.append(key_index)
+        if len(self.keys) == 1:
+            raise RuntimeError("429 ResourceExhausted")
+        return FakeResponse("dear diary")
+
+
+def error_count(label, key, kind):
+    return main.REGISTRY.get_sample_value("onion_gemini_call_errors_total", {"model": label, "key": key, "kind": kind}) or 0
+
+
+def test_ocr_uses_key_order_and_cooldowns(monkeypatch):
+    router = main.ModelRouter(2)
+    router._next_key = 1  # 이번 순서: 키 2 -> 키 1
+    backend = QuotaThenText()
+    monkeypatch.setattr(main, "model_router", router)
+    monkeypatch.setattr(main, "ai_backend", backend)
+    label = "gemini-3-flash-preview/ocr"
+    quota_before = error_count(label, "key2", "quota")
+
+    text = asyncio.run(main.extract_text_from_image_with_fallback("unused.png"))
+
+    assert text == "dear diary"
+    assert backend.keys == [1, 0]
+    assert router.key_cooldown_until[1] > time.monotonic() and router.key_cooldown_until[0] == 0
+    assert error_count(label, "key2", "quota") == quota_before + 1
+    assert router.key_order()[-1] == 1, "the key in cooldown should be tried last next time"
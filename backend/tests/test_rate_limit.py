@@ -0,0 +1,24 @@
+"""
+유저별 토큰 버킷(TokenBucketLimiter) 테스트.
+
+- test_full_buckets_are_swept : 메모리 모드에서 가득 다시 찬 버킷은 sweep_interval 뒤 지워지고, 비어 있는 버킷은 남는지
+
+실행: cd backend && python -m pytest -q tests
+"""
+import main
+
+
+def test_full_buckets_are_swept(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: clock[0])
+    limiter = main.TokenBucketLimiter({"chat": (2, 1.0), "ocr": (1, 0.01)}, sweep_interval=60)
+
+    for user_id in ("idle", "busy"):
+        assert limiter.acquire(user_id, "chat") == 0
+    assert limiter.acquire("busy", "ocr") == 0
+    assert len(limiter._buckets) == 3
+
+    clock[0] += 61  # chat 버킷은 다시 가득 참, ocr 버킷은 아직 충전 중
+    assert limiter.acquire("busy", "chat") == 0
+    assert set(limiter._buckets) == {("busy", "chat"), ("busy", "ocr")}
+    assert limiter.acquire("busy", "ocr") > 0, "a swept limiter must keep limiting drained buckets"
@@ -0,0 +1,84 @@
+"""
+일기 수정 후 재분석 테스트.
+
+- test_rate_limited_edit_is_queued     : 속도 제한에 걸린 큰 수정도 analysis_status="queued" 로 저장되고 지연 분석 큐가 다시 분석하는지
+- test_failed_reanalysis_stays_queued  : 바로 시도한 재분석이 실패하면 일기가 큐에 남고, 다음 큐 처리에서 반영되는지
+
+실행: cd backend && python -m pytest -q tests
+"""
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+from fastapi.testclient import TestClient
+from jose import jwt
+
+import main
+from standins import FAKE_ANALYSIS
+
+
+NEW_CONTENT = "Spent the whole afternoon hiking up the mountain with old friends and cooking dinner outside."
+
+
+def make_diary():
+    user_id = f"test-requeue-{uuid.uuid4().hex[:8]}"
+    main.user_collection.insert_one({"user_id": user_id, "sync_seq": 0})
+    diary_id = main.diary_collection.insert_one({
+        "user_id": user_id, "title": "t", "content": "A quiet day.", "is_temporary": False, "entry_date": "2026-10-01",
+        "analysis": dict(FAKE_ANALYSIS), "keywords_snapshot": ["#Calm"], "big5_snapshot": {}, "analysis_status": "fresh",
+    }).inserted_id
+    token = jwt.encode({"sub": user_id, "exp": datetime.utcnow() + timedelta(hours=1)}, main.SECRET_KEY, algorithm="HS256")
+    return user_id, str(diary_id), {"Authorization": f"Bearer {token}"}
+
+
+def cleanup(user_id):
+    main.diary_collection.delete_many({"user_id": user_id})
+    main.user_collection.delete_many({"user_id": user_id})
+
+
+def test_rate_limited_edit_is_queued(monkeypatch):
+    user_id, diary_id, headers = make_diary()
+    analyzed = []
+
+    async def analysis(diary_text, user_traits, retries=2):
+        analyzed.append(diary_text)
+        return {**FAKE_ANALYSIS, "keywords": ["#Hike"]}, "gemini-test"
+
+    monkeypatch.setattr(main, "get_gemini_analysis", analysis)
+    monkeypatch.setattr(main.rate_limiter, "acquire", lambda user, bucket: 30)
+    monkeypatch.setattr(main.model_router, "healthy_key_ratio", lambda: 1.0)
+    try:
+        response = TestClient(main.app).patch(f"/diaries/{diary_id}", headers=headers, json={"content": NEW_CONTENT})
+        assert response.status_code == 200 and response.json()["reanalysis_queued"]
+        diary = main.diary_collection.find_one({"user_id": user_id})
+        assert diary["analysis_status"] == "queued" and diary.get("queued_at")
+        assert analyzed == [], "a rate-limited edit must not call Gemini inside the request"
+
+        assert asyncio.run(main.process_next_queued_analysis())
+        diary = main.diary_collection.find_one({"user_id": user_id})
+        assert analyzed == [NEW_CONTENT]
+        assert diary["analysis_status"] == "fresh" and diary["keywords_snapshot"] == ["#Hike"]
+    finally:
+        cleanup(user_id)
+
+
+def test_failed_reanalysis_stays_queued(monkeypatch):
+    user_id, diary_id, headers = make_diary()
+    results = [(None, None), ({**FAKE_ANALYSIS, "keywords": ["#Hike"]}, "gemini-test")]
+
+    async def analysis(diary_text, user_traits, retries=2):
+        return results.pop(0)
+
+    monkeypatch.setattr(main, "get_gemini_analysis", analysis)
+    monkeypatch.setattr(main.rate_limiter, "acquire", lambda user, bucket: 0)
+    monkeypatch.setattr(main.model_router, "healthy_key_ratio", lambda: 1.0)
+    try:
+        response = TestClient(main.app).patch(f"/diaries/{diary_id}", headers=headers, json={"content": NEW_CONTENT})
+        assert response.status_code == 200
+        assert main.diary_collection.find_one({"user_id": user_id})["analysis_status"] == "queued"
+
+        assert asyncio.run(main.process_next_queued_analysis())
+        diary = main.diary_collection.find_one({"user_id": user_id})
+        assert diary["analysis_status"] == "fresh" and diary["analysis_model"] == "gemini-test"
+    finally:
+        cleanup(user_id)
@@ -0,0 +1,51 @@
+"""
+격주 리포트 배치(run_report_batch) 테스트.
+
+- test_failed_users_are_retried_before_done : 생성에 실패한 유저는 failed_user_ids 에 남고, 재시도로 성공하기 전에는 배치가 완료되지 않는지
+
+실행: cd backend && python -m pytest -q tests
+"""
+import asyncio
+import uuid
+from datetime import datetime
+
+import main
+
+
+def test_failed_users_are_retried_before_done(monkeypatch):
+    prefix = f"test-report-{uuid.uuid4().hex[:8]}"
+    user_ids = [f"{prefix}-{name}" for name in ("a", "b", "c")]
+    main.user_collection.insert_many([{"user_id": user_id} for user_id in user_ids])
+    cycle_id, _ = main.report_cycle(datetime.utcnow())
+    job_id = f"report_batch:{cycle_id}"
+    main.job_collection.delete_many({"_id": job_id})
+
+    attempts = []
+    flaky = {user_ids[1]: 2}  # 두 번 실패한 뒤 성공
+
+    async def fake_report(user):
+        attempts.append(user["user_id"])
+        if flaky.get(user["user_id"], 0) > 0:
+            flaky[user["user_id"]] -= 1
+            return "failed"
+        return "generated" if user["user_id"].startswith(prefix) else "skipped"
+
+    monkeypatch.setattr(main, "generate_scheduled_report", fake_report)
+    monkeypatch.setattr(main, "in_offpeak_window", lambda now: True)
+    monkeypatch.setattr(main.model_router, "healthy_key_ratio", lambda: 1.0)
+    monkeypatch.setattr(main, "REPORT_BATCH_PAUSE_SEC", 0)
+    try:
+        asyncio.run(main.run_report_batch())
+        job = main.job_collection.find_one({"_id": job_id})
+        assert job["status"] == "running", "a failed user must not let the batch finish"
+        assert job["failed_user_ids"] == [user_ids[1]]
+
+        asyncio.run(main.run_report_batch())
+        job = main.job_collection.find_one({"_id": job_id})
+        assert job["status"] == "done"
+        assert job["failed_user_ids"] == [] and job["failed"] == 0
+        assert attempts.count(user_ids[1]) == 3
+        assert attempts.count(user_ids[0]) == 1 and attempts.count(user_ids[2]) == 1
+    finally:
+        main.user_collection.delete_many({"user_id": {"$in": user_ids}})
+        main.job_collection.delete_many({"_id": job_id})
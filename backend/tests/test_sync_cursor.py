@@ -0,0 +1,71 @@
+"""
+증분 동기화 커서 테스트.
+
+- test_cursor_waits_for_unfinished_write : 먼저 발급된 번호의 쓰기가 끝나기 전에는 그보다 큰 번호를 커서로 내주지 않는지
+- test_stale_inflight_is_released        : 죽은 프로세스가 남긴 진행 중 표시는 SYNC_INFLIGHT_TIMEOUT_SEC 뒤 풀리는지
+- test_server_fields_stay_out_of_responses : /diaries 와 /sync(전체/증분) 응답에 embedding / clean_text 가 빠지는지
+
+실행: cd backend && python -m pytest -q tests
+"""
+import uuid
+from datetime import datetime, timedelta
+
+from fastapi.testclient import TestClient
+from jose import jwt
+
+import main
+
+
+def cursor_seq(user_id):
+    user = main.user_collection.find_one({"user_id": user_id}, main.SYNC_CURSOR_FIELDS)
+    return main.committed_sync_seq(user)
+
+
+def test_cursor_waits_for_unfinished_write():
+    user_id = f"test-sync-{uuid.uuid4().hex[:8]}"
+    main.user_collection.insert_one({"user_id": user_id, "sync_seq": 0})
+    try:
+        with main.sync_seq_slot(user_id) as first:
+            with main.sync_seq_slot(user_id) as second:
+                assert second > first
+            # 두 번째 쓰기는 끝났지만 첫 번째가 아직 진행 중 -> 커서는 첫 번째 이전에 머묾
+            assert cursor_seq(user_id) < first
+        assert cursor_seq(user_id) == second
+    finally:
+        main.user_collection.delete_many({"user_id": user_id})
+
+
+def test_stale_inflight_is_released():
+    user_id = f"test-sync-{uuid.uuid4().hex[:8]}"
+    main.user_collection.insert_one({"user_id": user_id, "sync_seq": 0})
+    try:
+        seq = main.next_sync_seq(user_id)  # release 되지 않은 채 프로세스가 죽은 상황
+        assert cursor_seq(user_id) < seq
+        started = datetime.utcnow() - timedelta(seconds=main.SYNC_INFLIGHT_TIMEOUT_SEC + 1)
+        main.user_collection.update_one({"user_id": user_id}, {"$set": {"sync_inflight_at": started}})
+        assert cursor_seq(user_id) == seq
+        assert main.user_collection.find_one({"user_id": user_id})["sync_inflight"] == 0
+    finally:
+        main.user_collection.delete_many({"user_id": user_id})
+
+
+def test_server_fields_stay_out_of_responses():
+    user_id = f"test-sync-{uuid.uuid4().hex[:8]}"
+    main.user_collection.insert_one({"user_id": user_id, "sync_seq": 1})
+    main.diary_collection.insert_one({
+        "user_id": user_id, "title": "t", "content": "<b>hi</b>", "clean_text": "hi", "embedding": b"\x00", "sync_seq": 1,
+        "entry_date": "2026-10-01"
+    })
+    token = jwt.encode({"sub": user_id, "exp": datetime.utcnow() + timedelta(hours=1)}, main.SECRET_KEY, algorithm="HS256")
+    client = TestClient(main.app)
+    headers = {"Authorization": f"Bearer {token}"}
+    try:
+        diaries = client.get("/diaries", headers=headers).json()["diaries"]
+        full = client.get("/sync", headers=headers).json()["changes"]
+        delta = client.get("/sync", headers=headers, params={"since": main.encode_sync_cursor(0)}).json()["changes"]
+        for docs in (diaries, full, delta):
+            assert len(docs) == 1 and docs[0]["content"] == "<b>hi</b>"
+            assert not {"embedding", "clean_text"} & set(docs[0])
+    finally:
+        main.diary_collection.delete_many({"user_id": user_id})
+        main.user_collection.delete_many({"user_id": user_id})
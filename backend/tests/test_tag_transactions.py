@@ -0,0 +1,143 @@
+"""
+태그 병합(merge_tags)의 트랜잭션 경로 테스트.
+
+- test_transaction_callback_writes_use_session : with_transaction 콜백 안의 모든 쓰기가 세션을 달고 나가는지 확인
+  (세션 없는 쓰기가 섞이면 레플리카셋에서 WriteConflict -> with_transaction 무한 재시도)
+- test_merge_inside_real_transaction : TEST_MONGO_REPLSET_URI 에 레플리카셋(또는 Atlas)이 있을 때만 실제 트랜잭션으로 실행
+- test_tag_delta_is_one_write       : apply_tag_delta 가 유저 문서를 $inc 한 번으로만 고치고, 0 이 된 태그는 /user/stats 에서 빠지는지
+
+실행: cd backend && python -m pytest -q tests
+      TEST_MONGO_REPLSET_URI="mongodb://localhost:27017/?replicaSet=rs0" python -m pytest -q tests
+"""
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+from jose import jwt
+
+import main
+
+REPLSET_URI = os.environ.get("TEST_MONGO_REPLSET_URI")
+WRITE_METHODS = {"insert_one", "insert_many", "update_one", "update_many", "find_one_and_update", "bulk_write", "delete_one", "delete_many"}
+
+
+class RecordingCollection:
+    """쓰기 호출마다 (메서드, 세션 사용 여부) 를 기록하고 실제 컬렉션에 넘김"""
+    def __init__(self, collection, txn):
+        self._collection = collection
+        self._txn = txn
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, session=None, **kwargs):
+            if self._txn.active and name in WRITE_METHODS:
+                self._txn.writes.append((self._collection.name, name, session is self._txn))
+            if session is not self._txn and session is not None:
+                kwargs["session"] = session
+            return attr(*args, **kwargs)  # 가짜 세션은 빼고 실행 (mongomock 은 세션 미지원)
+        return call
+
+
+class FakeTransactionSession:
+    """start_session / with_transaction 자리. 콜백을 한 번 실행하며 그동안의 쓰기를 기록"""
+    def __init__(self):
+        self.active = False
+        self.writes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def with_transaction(self, callback):
+        self.active = True
+        try:
+            return callback(self)
+        finally:
+            self.active = False
+
+
+def seed_user(user_id, tags_per_diary):
+    main.user_collection.insert_one({"user_id": user_id, "sync_seq": 0})
+    main.diary_collection.insert_many([
+        {"user_id": user_id, "title": f"d{i}", "content": "x", "tags": tags, "is_temporary": False}
+        for i, tags in enumerate(tags_per_diary)
+    ])
+    main.recount_user_tags(user_id)
+
+
+def cleanup(user_id):
+    main.diary_collection.delete_many({"user_id": user_id})
+    main.user_collection.delete_many({"user_id": user_id})
+
+
+def test_transaction_callback_writes_use_session(monkeypatch):
+    user_id = f"test-tags-{uuid.uuid4().hex[:8]}"
+    seed_user(user_id, [["work"], ["work", "home"], ["home"]])
+    txn = FakeTransactionSession()
+    monkeypatch.setattr(main, "tag_transactions_supported", True)
+    monkeypatch.setattr(main.client, "start_session", lambda: txn, raising=False)
+    monkeypatch.setattr(main, "user_collection", RecordingCollection(main.user_collection, txn))
+    monkeypatch.setattr(main, "diary_collection", RecordingCollection(main.diary_collection, txn))
+    try:
+        modified = main.run_tag_merge(user_id, ["work"], "job")
+
+        assert modified == 2
+        assert txn.writes, "merge should write inside the transaction"
+        outside = [(coll, method) for coll, method, with_session in txn.writes if not with_session]
+        assert outside == [], f"writes inside the transaction without the session: {outside}"
+        counts = main.user_collection.find_one({"user_id": user_id})["user_tag_counts"]
+        assert counts == {"job": 2, "home": 2}
+        seqs = {d.get("sync_seq") for d in main.diary_collection.find({"user_id": user_id, "tags": "job"})}
+        assert len(seqs) == 1 and seqs.pop() > 0
+    finally:
+        monkeypatch.undo()
+        cleanup(user_id)
+
+
+@pytest.mark.skipif(not REPLSET_URI, reason="TEST_MONGO_REPLSET_URI (replica set) not set")
+def test_merge_inside_real_transaction():
+    user_id = f"test-tags-{uuid.uuid4().hex[:8]}"
+    seed_user(user_id, [["work"], ["work", "home"], ["home"], ["job"]])
+    main.tag_transactions_supported = True
+    result = {}
+    try:
+        # WriteConflict 가 나면 with_transaction 이 120초까지 재시도하므로 스레드로 돌려 시간 제한
+        worker = threading.Thread(target=lambda: result.update(modified=main.run_tag_merge(user_id, ["work"], "job")))
+        worker.start()
+        worker.join(timeout=15)
+        assert not worker.is_alive(), "tag merge did not finish: transaction kept retrying"
+
+        assert main.tag_transactions_supported, "expected the replica set to support transactions"
+        assert result["modified"] == 2
+        counts = main.user_collection.find_one({"user_id": user_id})["user_tag_counts"]
+        assert counts == {"job": 3, "home": 2}
+    finally:
+        cleanup(user_id)
+
+
+def test_tag_delta_is_one_write(monkeypatch):
+    user_id = f"test-tags-{uuid.uuid4().hex[:8]}"
+    seed_user(user_id, [["work"], ["home"]])
+    recorder = FakeTransactionSession()
+    recorder.active = True  # 트랜잭션 없이 쓰기 호출만 기록
+    monkeypatch.setattr(main, "user_collection", RecordingCollection(main.user_collection, recorder))
+    try:
+        main.apply_tag_delta(user_id, ["work"], ["home", "gym"])
+        assert [method for _, method, _ in recorder.writes] == ["update_one"]
+        monkeypatch.undo()
+
+        assert main.user_collection.find_one({"user_id": user_id})["user_tag_counts"] == {"work": 0, "home": 2, "gym": 1}
+        token = jwt.encode({"sub": user_id, "exp": datetime.utcnow() + timedelta(hours=1)}, main.SECRET_KEY, algorithm="HS256")
+        stats = TestClient(main.app).get("/user/stats", headers={"Authorization": f"Bearer {token}"}).json()
+        assert stats["user_tag_counts"] == {"home": 2, "gym": 1}
+    finally:
+        monkeypatch.undo()
+        cleanup(user_id)
@@ -0,0 +1,91 @@
+"""
+재분석 시 trait_counts 증감 테스트.
+
+- test_reanalysis_updates_traits_in_one_write : 키워드 차이가 유저 문서 쓰기 한 번(trait_counts $inc + top_traits)으로 반영되고,
+                                                0 이 된 키워드는 읽을 때(positive_trait_counts)와 top_traits 에서 빠지는지 확인
+- test_stats_update_keeps_concurrent_inc      : update_user_stats_bg 가 읽은 뒤 쓰기 전에 들어온 다른 $inc 를 덮어쓰지 않는지
+
+실행: cd backend && python -m pytest -q tests
+"""
+import uuid
+
+import main
+from standins import FAKE_ANALYSIS
+
+
+USER_WRITES = {"update_one", "update_many", "find_one_and_update", "bulk_write"}
+
+
+class CountingCollection:
+    """유저 컬렉션 쓰기 호출 수를 셈"""
+    def __init__(self, collection):
+        self._collection = collection
+        self.writes = []
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name in USER_WRITES:
+            def call(*args, **kwargs):
+                self.writes.append((name, args[1] if len(args) > 1 else kwargs.get("update")))
+                return attr(*args, **kwargs)
+            return call
+        return attr
+
+
+def test_reanalysis_updates_traits_in_one_write(monkeypatch):
+    user_id = f"test-traits-{uuid.uuid4().hex[:8]}"
+    main.user_collection.insert_one({"user_id": user_id, "sync_seq": 0, "trait_counts": {"#Old": 1, "#Calm": 2}})
+    diary_id = main.diary_collection.insert_one({
+        "user_id": user_id, "title": "t", "content": "a calm day", "is_temporary": False,
+        "entry_date": "2026-10-01", "keywords_snapshot": ["#Old", "#Calm"], "big5_snapshot": {},
+    }).inserted_id
+    counting = CountingCollection(main.user_collection)
+    monkeypatch.setattr(main, "user_collection", counting)
+    try:
+        result = {**FAKE_ANALYSIS, "keywords": ["#Calm", "#Joy", "#Rest"]}
+        assert main.apply_analysis_result(user_id, str(diary_id), "a calm day", result, "gemini-test", recompute_big5=False)
+
+        trait_writes = [update for _, update in counting.writes if any("trait_counts" in k for op in update.values() for k in op)]
+        assert len(trait_writes) == 1 and all(k.startswith("trait_counts.") for k in trait_writes[0]["$inc"])
+        assert set(trait_writes[0].get("$set", {})) <= {"trait_index", "top_traits"}, "trait_counts itself must only be $inc'd"
+        user = main.user_collection.find_one({"user_id": user_id})
+        assert user["trait_counts"]["#Old"] == 0
+        assert main.positive_trait_counts(user["trait_counts"]) == {"#Calm": 2, "#Joy": 1, "#Rest": 1}
+        # 프롬프트용 색인도 같은 차이로: 빠진 #Old 는 사라지고 새 키워드가 들어옴
+        assert user["top_traits"][0] == "#Calm" and set(user["top_traits"]) == {"#Calm", "#Joy", "#Rest"}
+    finally:
+        monkeypatch.undo()
+        main.diary_collection.delete_many({"user_id": user_id})
+        main.user_collection.delete_many({"user_id": user_id})
+
+
+class IncAfterRead:
+    """유저 문서를 읽은 직후(쓰기 전에) 다른 경로의 $inc 가 끼어드는 상황을 재현"""
+    def __init__(self, collection, user_id, inc):
+        self._collection = collection
+        self._user_id = user_id
+        self._inc = inc
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def find_one(self, *args, **kwargs):
+        doc = self._collection.find_one(*args, **kwargs)
+        if self._inc:
+            self._collection.update_one({"user_id": self._user_id}, {"$inc": self._inc})
+            self._inc = None
+        return doc
+
+
+def test_stats_update_keeps_concurrent_inc(monkeypatch):
+    user_id = f"test-traits-{uuid.uuid4().hex[:8]}"
+    main.user_collection.insert_one({"user_id": user_id, "trait_counts": {"#Calm": 2}})
+    monkeypatch.setattr(main, "user_collection", IncAfterRead(main.user_collection, user_id, {"trait_counts.#Calm": 1, "trait_counts.#Joy": 1}))
+    try:
+        main.update_user_stats_bg(user_id, ["#Calm", "#Rest"], {})
+
+        counts = main.user_collection.find_one({"user_id": user_id})["trait_counts"]
+        assert counts == {"#Calm": 4, "#Joy": 1, "#Rest": 1}
+    finally:
+        monkeypatch.undo()
+        main.user_collection.delete_many({"user_id": user_id})